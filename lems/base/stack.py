@@ -20,7 +20,8 @@ class Stack(LEMSBase):
         """
 
         self.stack = []
-        """ List used to store the stack contents.
+        """ List used to store the stack contents, with the top of the
+        stack at the end.
 
         :type: list """
 
@@ -32,7 +33,7 @@ class Stack(LEMSBase):
         :type val: *
         """
 
-        self.stack = [val] + self.stack
+        self.stack.append(val)
 
     def pop(self):
         """
@@ -45,9 +46,7 @@ class Stack(LEMSBase):
         """
 
         if self.stack:
-            val = self.stack[0]
-            self.stack = self.stack[1:]
-            return val
+            return self.stack.pop()
         else:
             raise StackError("Stack empty")
 
@@ -62,7 +61,7 @@ class Stack(LEMSBase):
         """
 
         if self.stack:
-            return self.stack[0]
+            return self.stack[-1]
         else:
             raise StackError("Stack empty")
 
@@ -84,14 +83,7 @@ class Stack(LEMSBase):
         string representations.
         """
 
-        if len(self.stack) == 0:
-            s = "[]"
-        else:
-            s = "[" + str(self.stack[0])
-            for i in range(1, len(self.stack)):
-                s += ", " + str(self.stack[i])
-            s += "]"
-        return s
+        return "[" + ", ".join(str(val) for val in reversed(self.stack)) + "]"
 
     def __repr__(self):
         return self.__str__()
@@ -844,6 +844,7 @@ class Model(LEMSBase):
                     target_port,
                     receiver,
                     receiver_container,
+                    ev.delay,
                 )
                 if self.debug:
                     print("Created EC: " + ev2.toxml())
@@ -112,7 +112,14 @@ class EventConnection(LEMSBase):
     """
 
     def __init__(
-        self, from_, to, source_port, target_port, receiver, receiver_container
+        self,
+        from_,
+        to,
+        source_port,
+        target_port,
+        receiver,
+        receiver_container,
+        delay="",
     ):
         """
         Constructor.
@@ -150,12 +157,19 @@ class EventConnection(LEMSBase):
 
         :type: str """
 
+        self.delay = delay
+        """ Name of the parameter holding the delay before events are
+        delivered. Events are delivered without delay if not set.
+
+        :type: str """
+
     def __eq__(self, o):
         return (
             self.from_ == o.from_
             and self.to == o.to
             and self.source_port == o.source_port
             and self.target_port == o.target_port
+            and self.delay == o.delay
         )
 
     def toxml(self):
@@ -175,6 +189,7 @@ class EventConnection(LEMSBase):
                 if self.receiver_container
                 else ""
             )
+            + (' delay="{0}"'.format(self.delay) if self.delay else "")
             + "/>"
         )
 
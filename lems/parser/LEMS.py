@@ -929,9 +929,10 @@ class LEMSFileParser(LEMSBase):
         target_port = node.lattrib.get("targetport", "")
         receiver = node.lattrib.get("receiver", "")
         receiver_container = node.lattrib.get("receivercontainer", "")
+        delay = node.lattrib.get("delay", "")
 
         ec = EventConnection(
-            from_, to, source_port, target_port, receiver, receiver_container
+            from_, to, source_port, target_port, receiver, receiver_container, delay
         )
         self.current_structure.add_event_connection(ec)
 
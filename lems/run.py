@@ -6,9 +6,16 @@ Command line simulation driver.
 """
 
 import argparse
+import json
+import os
 
 from lems.model.model import Model
 from lems.sim.build import SimulationBuilder
+from lems.sim.integrators import integration_methods
+from lems.sim.output import create_output_writers
+from lems.sim.sweep import run_sweep, run_ensemble
+from lems.sim.comm import MPICommunicator
+from lems.sim.partition import get_runs, run_partitioned, run_shard
 from lems.model.simulation import DataDisplay, DataWriter
 
 
@@ -45,10 +52,109 @@ def process_args():
         help="If this is specified, export the LEMS file as " + dlems_info,
     )
 
+    parser.add_argument(
+        "-vectorize",
+        action="store_true",
+        help="If this is specified, simulate populations of simple components as NumPy arrays",
+    )
+
+    parser.add_argument(
+        "-integrator",
+        choices=integration_methods,
+        default="euler",
+        help="Method integrating time derivatives: forward Euler (default), exponential Euler for time derivatives linear in their variable such as those of gating variables (expeuler), or explicit Runge-Kutta of second (rk2) or fourth (rk4) order",
+    )
+
+    parser.add_argument(
+        "-prune",
+        action="store_true",
+        help="If this is specified, remove the components that cannot affect any recorded quantity before running the simulation, and print what was removed",
+    )
+
+    parser.add_argument(
+        "-demanddriven",
+        action="store_true",
+        help="If this is specified, only compute the derived variables that are recorded or needed by the dynamics (always the case with -prune)",
+    )
+
+    parser.add_argument(
+        "-inlineparameters",
+        action="store_true",
+        help="If this is specified, substitute the values of parameters and constants into the generated code of the dynamics. Their values are then frozen when the simulation is built",
+    )
+
+    parser.add_argument(
+        "-compact",
+        action="store_true",
+        help="If this is specified, reduce the memory held by each component once the simulation is built, for large networks",
+    )
+
+    parser.add_argument(
+        "-partitions",
+        type=int,
+        metavar="<count>",
+        help="Divide the simulation between this number of worker processes, which exchange the events crossing them at intervals no longer than their delays. Results are the same as those of a single process",
+    )
+
+    parser.add_argument(
+        "-mpi",
+        action="store_true",
+        help="If this is specified, divide the simulation between the processes started by mpiexec, as with -partitions. The first process saves the results. Requires mpi4py",
+    )
+
+    parser.add_argument(
+        "-flushinterval",
+        type=int,
+        default=1000,
+        metavar="<rows>",
+        help="Number of rows of output files buffered in memory before they are written (default: 1000)",
+    )
+
+    parser.add_argument(
+        "-format",
+        choices=["text", "npy", "npz", "hdf5"],
+        help="Format of all output files. By default, files ending in .npy, .npz, .h5 or .hdf5 are saved in binary formats and others as text",
+    )
+
+    parser.add_argument(
+        "-sweep",
+        type=str,
+        metavar="<JSON file>",
+        help='Run the simulation once for each set of parameter values in a JSON file, holding a list of objects mapping component ids to objects of parameter values (e.g. [{"iaf": {"threshold": "-40mV"}}]). Recordings are saved to an .npz file with the same base name',
+    )
+
+    parser.add_argument(
+        "-processes",
+        type=int,
+        metavar="<count>",
+        help="Number of worker processes used for a sweep (default: number of CPUs). If this is more than 1, the independent runs of several simulation components are also run in parallel, with the same results as a single process unless random numbers are drawn during the runs",
+    )
+
+    parser.add_argument(
+        "-ensemble",
+        action="store_true",
+        help="If this is specified, run the parameter sets of a sweep as the trials of a single simulation, with one NumPy array per variable holding the values of all trials",
+    )
+
     return parser.parse_args()
 
 
-def run(file_path, include_dirs=[], dlems=False, nogui=False):
+def run(
+    file_path,
+    include_dirs=[],
+    dlems=False,
+    nogui=False,
+    vectorize=False,
+    flush_interval=1000,
+    format=None,
+    integrator="euler",
+    prune=False,
+    compact=False,
+    partitions=None,
+    processes=None,
+    demand_driven=False,
+    inline_parameters=False,
+):
     """
     Function for running from a script or shell.
     """
@@ -59,9 +165,88 @@ def run(file_path, include_dirs=[], dlems=False, nogui=False):
     args.I = include_dirs
     args.dlems = dlems
     args.nogui = nogui
+    args.vectorize = vectorize
+    args.flushinterval = flush_interval
+    args.format = format
+    args.integrator = integrator
+    args.prune = prune
+    args.compact = compact
+    args.partitions = partitions
+    args.processes = processes
+    args.demanddriven = demand_driven
+    args.inlineparameters = inline_parameters
     main(args=args)
 
 
+def sweep(
+    file_path,
+    parameter_sets,
+    include_dirs=[],
+    processes=None,
+    vectorize=False,
+    ensemble=False,
+    integrator="euler",
+):
+    """
+    Function for running a parameter sweep from a script. The model is parsed
+    and resolved once and simulated for each set of parameter values in a
+    pool of worker processes, or as the trials of an ensemble simulation.
+
+    :param file_path: LEMS file to be simulated.
+    :type file_path: string
+
+    :param parameter_sets: Parameter values for each simulation, by
+    parameter name by component id. Values are numbers in SI units or
+    strings with units.
+    :type parameter_sets: list(dict(string, dict(string, float or string)))
+
+    :param include_dirs: Directories to be searched for included files.
+    :type include_dirs: list(string)
+
+    :param processes: Number of worker processes (default: number of CPUs).
+    :type processes: int
+
+    :param vectorize: Simulate populations of simple components as arrays.
+    :type vectorize: Boolean
+
+    :param ensemble: Simulate all parameter sets at once in the calling
+    process (see lems.sim.sweep.run_ensemble).
+    :type ensemble: Boolean
+
+    :param integrator: Method integrating time derivatives, see
+    lems.sim.integrators.integration_methods.
+    :type integrator: string
+
+    :return: Sample times and values by recorded quantity, for each
+    parameter set.
+    :rtype: list(dict(string, (numpy.ndarray, numpy.ndarray)))
+    """
+
+    model = Model()
+    for dir in include_dirs:
+        model.add_include_directory(dir)
+    model.import_from_file(file_path)
+
+    if ensemble:
+        return run_ensemble(model.resolve(), parameter_sets, integrator)
+    return run_sweep(model.resolve(), parameter_sets, processes, vectorize, integrator)
+
+
+def save_sweep(file_name, results):
+    """
+    Saves the recordings of a sweep to an .npz file, with one two column
+    array (time, value) named "<run index>/<quantity>" per recording.
+    """
+
+    import numpy
+
+    arrays = {}
+    for i, recordings in enumerate(results):
+        for path, (times, values) in recordings.items():
+            arrays["{0}/{1}".format(i, path)] = numpy.column_stack((times, values))
+    numpy.savez(file_name, **arrays)
+
+
 def main(args=None):
     """
     Program entry point.
@@ -79,8 +264,45 @@ def main(args=None):
 
     resolved_model = model.resolve()
 
+    if getattr(args, "sweep", None):
+        with open(args.sweep) as f:
+            parameter_sets = json.load(f)
+
+        print("Running {0} simulations".format(len(parameter_sets)))
+        if getattr(args, "ensemble", False):
+            results = run_ensemble(
+                resolved_model, parameter_sets, getattr(args, "integrator", "euler")
+            )
+        else:
+            results = run_sweep(
+                resolved_model,
+                parameter_sets,
+                getattr(args, "processes", None),
+                getattr(args, "vectorize", False),
+                getattr(args, "integrator", "euler"),
+            )
+
+        file_name = os.path.splitext(args.sweep)[0] + ".npz"
+        save_sweep(file_name, results)
+        print(
+            "Saved recordings of {0} simulations to {1}".format(len(results), file_name)
+        )
+        return
+
     print("Building simulation")
-    sim = SimulationBuilder(resolved_model).build()
+    # Also used by the processes of partitioned simulations
+    options = {
+        "vectorize": getattr(args, "vectorize", False),
+        "integrator": getattr(args, "integrator", "euler"),
+        "demand_driven": getattr(args, "demanddriven", False) or None,
+        "prune": getattr(args, "prune", False),
+        "inline_parameters": getattr(args, "inlineparameters", False),
+        "compact": getattr(args, "compact", False),
+    }
+    builder = SimulationBuilder(resolved_model, **options)
+    sim = builder.build()
+    if builder.pruning_report is not None:
+        print(builder.pruning_report)
     # sim.dump("Afterbuild:")
 
     if args.dlems:
@@ -112,8 +334,30 @@ def main(args=None):
             export_component(model, sim_comp, target_comp)
 
     else:
+        create_output_writers(
+            sim,
+            model,
+            getattr(args, "flushinterval", 1000),
+            getattr(args, "format", None),
+        )
+
         print("Running simulation")
-        sim.run()
+        if getattr(args, "mpi", False):
+            sim = run_shard(resolved_model, MPICommunicator(), sim, options)
+            if sim is None:
+                return
+        elif getattr(args, "partitions", None):
+            run_partitioned(resolved_model, sim, args.partitions, options)
+        elif (getattr(args, "processes", None) or 1) > 1 and len(get_runs(sim)) > 1:
+            run_partitioned(
+                resolved_model,
+                sim,
+                getattr(args, "processes", None),
+                options,
+                independent=True,
+            )
+        else:
+            sim.run()
         process_simulation_output(sim, model, args)
 
 
@@ -130,6 +374,10 @@ def process_simulation_output(sim, model, options):
     file_times = {}
     file_outs = {}
 
+    # Files already saved during the run, by the names given in the model
+    # (writers of a forced format change the extension)
+    streamed = set(writer.data_output.file_name for writer in sim.output_writers)
+
     display_order = {}
     file_column_order = {}
 
@@ -168,11 +416,10 @@ def process_simulation_output(sim, model, options):
                         recordings[data_output.title][recording.full_path] = recording
                 elif isinstance(recording.data_output, DataWriter):
                     data_output = recording.data_output
-                    times = []
-                    vals = []
-                    for x, y in recording.values:
-                        times.append(x)
-                        vals.append(y)
+                    if data_output.file_name in streamed:
+                        continue
+                    times = recording.get_time_list()
+                    vals = recording.get_value_list()
                     file_times[data_output.file_name] = times
                     if data_output.file_name not in file_outs:
                         file_outs[data_output.file_name] = {}
@@ -184,6 +431,8 @@ def process_simulation_output(sim, model, options):
                     )
 
     for file_out_name in file_column_order.keys():
+        if file_out_name in streamed:
+            continue
         times = file_times[file_out_name]
         vals = file_outs[file_out_name]
         print(
@@ -238,13 +487,8 @@ def plot_recording(recording):
     data_output = recording.data_output
     recorder = recording.recorder
 
-    x = numpy.empty(len(recording.values))
-    y = numpy.empty(len(recording.values))
-    i = 0
-    for xv, yv in recording.values:
-        x[i] = xv / data_output.timeScale
-        y[i] = yv / recorder.scale
-        i = i + 1
+    x = numpy.asarray(recording.get_times()) / data_output.timeScale
+    y = numpy.asarray(recording.get_values()) / recorder.scale
 
     if data_output.title in displays:
         fig = displays[data_output.title].fig
@@ -5,13 +5,24 @@ Simulation builder.
 :organization: LEMS (https://github.com/organizations/LEMS)
 """
 
-import re
+import copy
 
 from lems.base.base import LEMSBase
 from lems.base.errors import SimBuildError
-from lems.sim.runnable import Runnable
+from lems.sim.runnable import Runnable, Prototype, get_required_variable_reference
+from lems.sim.runnable import get_reduction_reference
+from lems.sim.vector import VectorRunnable, EnsembleRunnable
+from lems.sim.vector import is_vectorizable, require_numpy
 from lems.sim.sim import Simulation
-from lems.parser.expr import ExprNode
+from lems.sim.events import get_event_delay
+from lems.sim.integrators import integration_methods, runge_kutta_tableaus
+from lems.sim.demand import find_needed_derived_variables
+from lems.sim.prune import prune_simulation
+from lems.sim.reduction import Reduction
+from lems.sim.optimize import is_literal, make_literal, get_literal_precedence
+from lems.sim.optimize import format_binary_op, format_negation
+from lems.sim.optimize import CommonSubexpressions, ATOM_PRECEDENCE
+from lems.parser.expr import ExprNode, OpNode, Func1Node
 from lems.model.dynamics import *
 from lems.sim.runnable import Regime as RunnableRegime
 
@@ -23,12 +34,69 @@ class SimulationBuilder(LEMSBase):
 
     debug = False
 
-    def __init__(self, model):
+    def __init__(
+        self,
+        model,
+        vectorize=False,
+        ensemble=None,
+        integrator="euler",
+        demand_driven=None,
+        prune=False,
+        inline_parameters=False,
+        compact=False,
+    ):
         """
         Constructor.
 
         :param model: Model upon which the simulation is to be generated.
         :type model: lems.model.model.Model
+
+        :param vectorize: If True, simulate populations of flat components as
+        NumPy arrays (see lems.sim.vector.VectorRunnable).
+        :type vectorize: Boolean
+
+        :param ensemble: Number of trials to be simulated at once. If given,
+        every runnable holds one value per trial for each of its variables
+        (see lems.sim.vector.EnsembleRunnable).
+        :type ensemble: int
+
+        :param integrator: Method integrating time derivatives: "euler"
+        (forward Euler), "expeuler" (exponential Euler for time derivatives
+        linear in their variable, such as those of gating variables, and
+        forward Euler otherwise), "rk2" (midpoint) or "rk4" (classic
+        Runge-Kutta).
+        :type integrator: string
+
+        :param demand_driven: If True, only compute the derived variables read
+        by time derivatives, event handlers, recordings or other needed
+        derived variables. The others keep their initial value, so they can
+        no longer be read through the runnables, for instance with
+        lems.sim.sim.Simulation.resolve_variable. Defaults to True when
+        pruning and False otherwise.
+        :type demand_driven: Boolean
+
+        :param prune: If True, remove the runnables which cannot affect any
+        recording (see lems.sim.prune). A report is kept in pruning_report.
+        :type prune: Boolean
+
+        :param inline_parameters: If True, substitute the values of
+        parameters and constants into the generated expressions of scalar
+        runnables, and fold the resulting constant subexpressions. Inlined
+        values are frozen at build time: later changes to the parameters of
+        a runnable are ignored, and components of the same type with
+        different values no longer share compiled methods. Parameters are
+        never inlined in ensembles, whose trials are given their own values.
+        :type inline_parameters: Boolean
+
+        :param compact: If True, reduce the memory held by each runnable once
+        the simulation is built (see lems.sim.runnable.Runnable.compact).
+        Runnables can then no longer be extended, for instance with new
+        recordings.
+        :type compact: Boolean
+
+        :raises SimBuildError: Raised if both vectorize and ensemble are
+        given, if the integration method is not known or if pruning is
+        requested without demand-driven derived variables.
         """
 
         self.model = model
@@ -45,6 +113,73 @@ class SimulationBuilder(LEMSBase):
 
         self.current_data_output = None
 
+        self.vectorize = vectorize
+        """ Simulate eligible MultiInstantiate populations as arrays.
+
+        :type: Boolean """
+
+        self.ensemble = ensemble
+        """ Number of trials simulated at once, or None.
+
+        :type: int """
+
+        if vectorize and ensemble is not None:
+            raise SimBuildError(
+                "Vectorized populations cannot be simulated as an ensemble"
+            )
+        if vectorize or ensemble is not None:
+            require_numpy()
+
+        if integrator not in integration_methods:
+            raise SimBuildError("Unknown integration method '{0}'".format(integrator))
+        self.integrator = integrator
+        """ Method integrating time derivatives, see integration_methods.
+
+        :type: string """
+
+        if demand_driven is None:
+            demand_driven = prune
+        self.demand_driven = demand_driven
+        """ Only compute the derived variables that are read.
+
+        :type: Boolean """
+
+        if prune and not demand_driven:
+            raise SimBuildError("Pruning requires demand-driven derived variables")
+        self.prune = prune
+        """ Remove the runnables which cannot affect any recording.
+
+        :type: Boolean """
+
+        self.pruning_report = None
+        """ Runnables and connections removed by the last build, if pruning.
+
+        :type: lems.sim.prune.PruningReport """
+
+        self.inline_parameters = inline_parameters and ensemble is None
+        """ Substitute the values of parameters and constants into
+        generated expressions.
+
+        :type: Boolean """
+
+        self.compact = compact
+        """ Reduce the memory held by each runnable once built.
+
+        :type: Boolean """
+
+        self.fixed_values = {}
+        """ Literals substituted for the parameters, constants and derived
+        parameters of each runnable, by runnable uid and variable name.
+
+        :type: dict(int, dict(string, lems.parser.expr.ValueNode)) """
+
+        self.template_depth = 0
+        """ Nesting depth of templates being built for copying. Vectorized
+        populations cannot be copied, so they are only built outside
+        templates.
+
+        :type: int """
+
     def build(self):
         """
         Build the simulation components from the model.
@@ -65,9 +200,94 @@ class SimulationBuilder(LEMSBase):
             runnable = self.build_runnable(component)
             self.sim.add_runnable(runnable)
 
+        if self.integrator in runge_kutta_tableaus:
+            for runnable in self.sim.runnables.values():
+                runnable.integrator = runge_kutta_tableaus[self.integrator]
+
+        if self.demand_driven:
+            runnables = []
+            for runnable in self.sim.runnables.values():
+                runnables += runnable.iter_subtree()
+            needed = find_needed_derived_variables(runnables)
+
+            if self.prune:
+                self.pruning_report = prune_simulation(self.sim, needed)
+            removed = self.remove_unneeded_derived_variables(needed)
+            if self.prune:
+                self.pruning_report.derived_variables = removed
+
+        for runnable in self.sim.runnables.values():
+            for r in runnable.iter_subtree():
+                r.bind_required_variables()
+                r.bind_reductions()
+
+        if self.compact:
+            shared = {}
+            for runnable in self.sim.runnables.values():
+                for r in runnable.iter_subtree():
+                    r.compact(shared)
+
         return self.sim
 
-    def build_runnable(self, component, parent=None, id_=None):
+    def remove_unneeded_derived_variables(self, needed):
+        """
+        Regenerates the update_derived_variables methods of all runnables of
+        the simulation so that they only compute the needed derived
+        variables.
+
+        :param needed: Names of the needed derived variables by runnable uid,
+        see lems.sim.demand.find_needed_derived_variables.
+        :type needed: dict(int, set(string))
+
+        :return: Number of derived variables no longer computed.
+        :rtype: int
+        """
+
+        removed = 0
+        for root in self.sim.runnables.values():
+            for runnable in root.iter_subtree():
+                removed += self.remove_derived_variables(runnable, needed[runnable.uid])
+        return removed
+
+    def remove_derived_variables(self, runnable, names):
+        """
+        Regenerates the update_derived_variables methods of a runnable and
+        its regimes so that they only compute the given derived variables.
+
+        :return: Number of derived variables no longer computed.
+        :rtype: int
+        """
+
+        removed = 0
+        for suffix, code in runnable.derived_variable_code.items():
+            statements = []
+            for name, lines in code:
+                if name in names:
+                    statements += lines
+                else:
+                    removed += 1
+                    skipped = self.sim.skipped_derived_variables
+                    skipped.setdefault(runnable.uid, set()).add(name)
+            if len(statements) == sum(len(lines) for name, lines in code):
+                continue
+
+            method_name = "update_derived_variables" + suffix
+            if suffix == "":
+                runnable.__dict__.pop(method_name, None)
+                runnable.add_method(method_name, ["self"], statements)
+            else:
+                # Regimes are shared between copies of a runnable
+                regime_name = suffix[len("_regime_") :]
+                if regime_name not in runnable.regimes:
+                    continue
+                regime = copy.copy(runnable.regimes[regime_name])
+                runnable.__dict__.pop(method_name, None)
+                runnable.add_method(method_name, ["self"], statements)
+                regime.update_derived_variables = runnable.__dict__.get(method_name)
+                runnable.regimes[regime_name] = regime
+        return removed
+
+    def build_runnable(self, component, parent=None, id_=None, size=None):
         """
         Build a runnable component from a component specification and add
         it to the simulation.
@@ -80,6 +300,9 @@ class SimulationBuilder(LEMSBase):
 
         :param id_: Optional id for therunnable. If it's not passed in, the runnable will inherit the id of the component.
 
+        :param size: Optional population size. If given, a vectorized population of this size is built.
+        :type size: int
+
         :raises SimBuildError: Raised when a component reference cannot be resolved.
         """
         if self.debug:
@@ -88,7 +311,15 @@ class SimulationBuilder(LEMSBase):
                 % (component, parent)
             )
 
-        if id_ == None:
+        if size is not None:
+            runnable = VectorRunnable(
+                component.id if id_ is None else id_, component, size, parent
+            )
+        elif self.ensemble is not None:
+            runnable = EnsembleRunnable(
+                component.id if id_ is None else id_, component, self.ensemble, parent
+            )
+        elif id_ == None:
             runnable = Runnable(component.id, component, parent)
         else:
             runnable = Runnable(id_, component, parent)
@@ -120,6 +351,15 @@ class SimulationBuilder(LEMSBase):
             )
             runnable.add_instance_variable(property.name, property.default_value)
 
+        fixed = {}
+        inline = self.inline_parameters and not runnable.vectorized
+        if inline:
+            for value in list(component.parameters) + list(component.constants):
+                literal = make_literal(value.numeric_value)
+                if literal is not None:
+                    fixed[value.name] = literal
+        self.fixed_values[runnable.uid] = fixed
+
         derived_parameter_code = []
 
         derived_parameter_ordering = order_derived_parameters(component)
@@ -128,15 +368,20 @@ class SimulationBuilder(LEMSBase):
             derived_parameter = component.derived_parameters[dpn]
             runnable.add_derived_variable(derived_parameter.name)
 
-            expression = self.build_expression_from_tree(
+            tree = self.fold_expression_tree(
                 runnable, None, derived_parameter.expression_tree
             )
+            if inline and is_literal(tree):
+                fixed[derived_parameter.name] = tree
+            expression = self.build_expression_from_tree(runnable, None, tree)
 
             derived_parameter_code += [
                 "self.{0} = ({1})".format(derived_parameter.name, expression)
             ]
             derived_parameter_code += [
-                "self.{0}_shadow = ({1})".format(derived_parameter.name, expression)
+                "self.shadow[{0}] = ({1})".format(
+                    runnable.shadow_index(derived_parameter.name), expression
+                )
             ]
 
         suffix = ""
@@ -166,7 +411,7 @@ class SimulationBuilder(LEMSBase):
             self.add_dynamics_1(component, runnable, regime, dynamics)
 
             if regime.initial:
-                runnable.current_regime = regime.name
+                runnable.set_initial_regime(regime.name)
 
             rn = regime.name
             if rn not in runnable.regimes:
@@ -238,6 +483,8 @@ class SimulationBuilder(LEMSBase):
 
         self.add_recording_behavior(component, runnable)
 
+        runnable.build_shadow_copy()
+
         self.current_data_output = data_output_backup
         self.current_record_target = record_target_backup
 
@@ -269,7 +516,9 @@ class SimulationBuilder(LEMSBase):
             source = runnable.parent.resolve_path(ec.from_)
             target = runnable.parent.resolve_path(ec.to)
             if ec.receiver:
+                self.template_depth += 1
                 receiver_template = self.build_runnable(ec.receiver, target)
+                self.template_depth -= 1
 
                 # receiver = copy.deepcopy(receiver_template)
                 receiver = receiver_template.copy()
@@ -309,11 +558,11 @@ class SimulationBuilder(LEMSBase):
 
             if self.debug:
                 print(
-                    "register_event_out_callback\n   Source: %s, %s (port: %s) \n   -> %s, %s (port: %s)"
+                    "connect_event_out\n   Source: %s, %s (port: %s) \n   -> %s, %s (port: %s)"
                     % (source, id(source), source_port, target, id(target), target_port)
                 )
-            source.register_event_out_callback(
-                source_port, lambda: target.inc_event_in(target_port)
+            source.connect_event_out(
+                source_port, target, target_port, get_event_delay(component, ec)
             )
 
     def build_structure(self, component, runnable, structure):
@@ -345,11 +594,29 @@ class SimulationBuilder(LEMSBase):
 
         # Process multi-child instatiantions
         for mi in structure.multi_instantiates:
+            if (
+                self.vectorize
+                and self.template_depth == 0
+                and is_vectorizable(mi.component)
+            ):
+                population = self.build_runnable(
+                    mi.component,
+                    runnable,
+                    "{0}__{1}__".format(component.id, mi.component.id),
+                    mi.number,
+                )
+                for i, view in enumerate(population.views):
+                    view.id = "{0}__{1}__{2}".format(component.id, mi.component.id, i)
+                runnable.add_population(population)
+                continue
+
+            self.template_depth += 1
             template = self.build_runnable(mi.component, runnable)
+            self.template_depth -= 1
 
+            prototype = Prototype(template)
             for i in range(mi.number):
-                # instance = copy.deepcopy(template)
-                instance = template.copy()
+                instance = prototype.instantiate()
                 instance.id = "{0}__{1}__{2}".format(component.id, template.id, i)
                 runnable.array.append(instance)
 
@@ -388,14 +655,10 @@ class SimulationBuilder(LEMSBase):
                 )
             name_mappings[foreach.as_] = target_runnable
 
-            # Process foreach statements
+            # Process foreach statements. The nested ForEach iterates over
+            # its own instances.
             for fe2 in foreach.for_eachs:
-                # print fe2.toxml()
-                target_array2 = runnable.resolve_path(fe2.instances)
-
-                for target_runnable2 in target_array2:
-                    name_mappings[fe2.as_] = target_runnable2
-                    self.build_foreach(component, runnable, fe2, name_mappings)
+                self.build_foreach(component, runnable, fe2, name_mappings)
 
             # Process event connections
             for ec in foreach.event_connections:
@@ -430,7 +693,7 @@ class SimulationBuilder(LEMSBase):
 
                 if self.debug:
                     print(
-                        "register_event_out_callback\n   Source: %s, %s (port: %s) \n   -> %s, %s (port: %s)"
+                        "connect_event_out\n   Source: %s, %s (port: %s) \n   -> %s, %s (port: %s)"
                         % (
                             source,
                             id(source),
@@ -440,8 +703,8 @@ class SimulationBuilder(LEMSBase):
                             target_port,
                         )
                     )
-                source.register_event_out_callback(
-                    source_port, lambda: target.inc_event_in(target_port)
+                source.connect_event_out(
+                    source_port, target, target_port, get_event_delay(component, ec)
                 )
 
     def add_dynamics_1(self, component, runnable, regime, dynamics):
@@ -475,16 +738,21 @@ class SimulationBuilder(LEMSBase):
         else:
             suffix = "_regime_" + regime.name
 
-        if isinstance(regime, Regime) and regime.initial:
-            runnable.new_regime = regime.name
-
         # Process state variables
         for sv in regime.state_variables:
             runnable.add_instance_variable(sv.name, 0)
 
         # Process time derivatives
         time_step_code = []
-        for td in regime.time_derivatives:
+        derivatives = []
+        trees = [
+            self.fold_expression_tree(runnable, regime, td.expression_tree)
+            for td in regime.time_derivatives
+        ]
+        # Time derivatives only read shadow and derived variables, which
+        # they do not change: subexpressions are shared between them.
+        common = self.find_common_subexpressions(runnable, regime, trees)
+        for td, tree in zip(regime.time_derivatives, trees):
             if (
                 td.variable not in regime.state_variables
                 and td.variable not in dynamics.state_variables
@@ -496,32 +764,85 @@ class SimulationBuilder(LEMSBase):
                     ).format(td.variable, component.id)
                 )
 
-            exp = self.build_expression_from_tree(runnable, regime, td.expression_tree)
-            time_step_code += ["self.{0} += dt * ({1})".format(td.variable, exp)]
-        runnable.add_method(
-            "update_state_variables" + suffix, ["self", "dt"], time_step_code
-        )
+            exp = self.build_expression_from_tree(runnable, regime, tree, common)
+            derivatives.append(exp)
+
+            if self.integrator == "expeuler":
+                coefficient = self.build_linear_coefficient(
+                    runnable,
+                    regime,
+                    tree,
+                    td.variable,
+                    self.get_dependent_variables(regime, dynamics, td.variable),
+                    common,
+                )
+                if coefficient not in (None, "0"):
+                    exp = "({0}) * exp_euler_factor(dt * ({1}))".format(
+                        exp, coefficient
+                    )
+
+            if runnable.vectorized:
+                # Never update arrays in place: shadows may alias them.
+                statement = "self.{0} = {1}".format(
+                    td.variable,
+                    self.mask_regime(
+                        runnable,
+                        regime,
+                        td.variable,
+                        "self.{0} + dt * ({1})".format(td.variable, exp),
+                    ),
+                )
+                if self.is_regime_masked(runnable, regime):
+                    time_step_code += self.mask_errors([statement])
+                else:
+                    time_step_code += [statement]
+            else:
+                time_step_code += ["self.{0} += dt * ({1})".format(td.variable, exp)]
+
+        if suffix == "" and self.integrator in runge_kutta_tableaus:
+            # Integrated by lems.sim.integrators.RungeKuttaStep
+            runnable.integrated_variables = [
+                td.variable for td in regime.time_derivatives
+            ]
+            runnable.add_method(
+                "time_derivatives",
+                ["self"],
+                ["return ({0},)".format(", ".join(derivatives))] if derivatives else [],
+            )
+        else:
+            runnable.add_method(
+                "update_state_variables" + suffix, ["self", "dt"], time_step_code
+            )
 
         # Process derived variables
         derived_variable_code = []
+        runnable.derived_variable_code[suffix] = []
         derived_variables_ordering = order_derived_variables(regime)
         for dvn in derived_variables_ordering:  # regime.derived_variables:
+            start = len(derived_variable_code)
             if dvn in dynamics.derived_variables:
                 dv = dynamics.derived_variables[dvn]
                 runnable.add_derived_variable(dv.name)
                 if dv.value:
-                    derived_variable_code += [
-                        "self.{0} = ({1})".format(
+                    statement = "self.{0} = ({1})".format(
+                        dv.name,
+                        self.mask_regime(
+                            runnable,
+                            regime,
                             dv.name,
                             self.build_expression_from_tree(
                                 runnable, regime, dv.expression_tree
                             ),
-                        )
-                    ]
+                        ),
+                    )
+                    if self.is_regime_masked(runnable, regime):
+                        derived_variable_code += self.mask_errors([statement])
+                    else:
+                        derived_variable_code += [statement]
                 elif dv.select:
                     if dv.reduce:
                         derived_variable_code += self.build_reduce_code(
-                            dv.name, dv.select, dv.reduce
+                            runnable, dv.name, dv.select, dv.reduce, dv.required
                         )
                     else:
                         derived_variable_code += [
@@ -543,6 +864,9 @@ class SimulationBuilder(LEMSBase):
                 raise SimBuildError(
                     "Unknown derived variable '{0}' in '{1}'", dvn, runnable.id
                 )
+            runnable.derived_variable_code[suffix].append(
+                (dvn, derived_variable_code[start:])
+            )
         runnable.add_method(
             "update_derived_variables" + suffix, ["self"], derived_variable_code
         )
@@ -785,9 +1109,11 @@ class SimulationBuilder(LEMSBase):
         else:
             return func
 
-    def build_expression_from_tree(self, runnable, regime, tree_node):
+    def build_expression_from_tree(self, runnable, regime, tree_node, common=None):
         """
-        Recursively builds a Python expression from a parsed expression tree.
+        Builds a Python expression from a parsed expression tree, after
+        substituting the values of fixed parameters and constants and folding
+        constant subexpressions (see fold_expression_tree).
 
         :param runnable: Runnable object to which this expression would be added.
         :type runnable: lems.sim.runnable.Runnable
@@ -798,56 +1124,227 @@ class SimulationBuilder(LEMSBase):
         :param tree_node: Root node for the tree from which the expression is to be built.
         :type tree_node: lems.parser.expr.ExprNode
 
+        :param common: Common subexpressions of the generated method, see
+        find_common_subexpressions. By default, those of this expression.
+        :type common: lems.sim.optimize.CommonSubexpressions
+
         :return: Generated Python expression.
         :rtype: string
         """
 
+        tree_node = self.fold_expression_tree(runnable, regime, tree_node)
+        if common is None:
+            common = self.find_common_subexpressions(runnable, regime, [tree_node])
+        return self.build_expression_code(runnable, regime, tree_node, common)[0]
+
+    def fold_expression_tree(self, runnable, regime, tree_node):
+        """
+        Substitutes literals for the fixed parameters and constants of a
+        runnable (see fixed_values) and evaluates the subexpressions of an
+        expression tree whose operands are all literals.
+
+        :return: Folded expression tree. Unchanged subtrees are shared with
+        the original tree.
+        :rtype: lems.parser.expr.ExprNode
+        """
+
+        if tree_node.type == ExprNode.VALUE:
+            fixed = self.fixed_values.get(runnable.uid, {})
+            if tree_node.value in fixed and self.resolve_variable(
+                runnable, regime, tree_node.value
+            ).startswith("self.shadow"):
+                return fixed[tree_node.value]
+            return tree_node
+        elif tree_node.type == ExprNode.FUNC1:
+            param = self.fold_expression_tree(runnable, regime, tree_node.param)
+            if param is not tree_node.param:
+                tree_node = Func1Node(tree_node.func, param)
+            if tree_node.func == "random" or not is_literal(param):
+                return tree_node
+        else:
+            left = self.fold_expression_tree(runnable, regime, tree_node.left)
+            right = self.fold_expression_tree(runnable, regime, tree_node.right)
+            if left is not tree_node.left or right is not tree_node.right:
+                tree_node = OpNode(tree_node.op, left, right)
+            if not (is_literal(left) and is_literal(right)):
+                return tree_node
+
+        code = self.build_expression_code(runnable, regime, tree_node, None)[0]
+        try:
+            literal = make_literal(runnable.evaluate(code))
+        except Exception:
+            # Left for the simulation to report
+            literal = None
+        return tree_node if literal is None else literal
+
+    def resolve_variable(self, runnable, regime, name):
+        """
+        Builds the Python code reading a variable in a generated expression.
+
+        :param name: Variable name.
+        :type name: string
+
+        :return: Python code.
+        :rtype: string
+
+        :raises SimBuildError: Raised if a required variable cannot be found.
+        """
+
         component_type = self.model.component_types[runnable.component.type]
         dynamics = component_type.dynamics
 
-        if tree_node.type == ExprNode.VALUE:
-            if tree_node.value[0].isalpha():
-                if tree_node.value == "t":
-                    return "self.time_completed"
-                elif tree_node.value in component_type.requirements:
-                    var_prefix = "self"
-                    v = tree_node.value
-
-                    r = runnable
-
-                    while (
-                        v not in r.instance_variables and v not in r.derived_variables
-                    ):
-                        var_prefix = "{0}.{1}".format(var_prefix, "parent")
-                        r = r.parent
-                        if r == None:
-                            raise SimBuildError(
-                                "Unable to resolve required " "variable '{0}'".format(v)
-                            )
+        if name == "t":
+            return "self.time_completed"
+        elif name in component_type.requirements:
+            var_prefix = "self"
+            v = name
 
-                    return "{0}.{1}".format(var_prefix, v)
-                elif tree_node.value in dynamics.derived_variables or (
-                    regime is not None and tree_node.value in regime.derived_variables
-                ):
-                    return "self.{0}".format(tree_node.value)
-                else:
-                    return "self.{0}_shadow".format(tree_node.value)
+            r = runnable
+            depth = 0
+
+            while v not in r.instance_variables and v not in r.derived_variables:
+                var_prefix = "{0}.{1}".format(var_prefix, "parent")
+                r = r.parent
+                depth += 1
+                if r == None:
+                    raise SimBuildError(
+                        "Unable to resolve required " "variable '{0}'".format(v)
+                    )
+
+            if depth > 1:
+                # Read through a direct reference to the ancestor, see
+                # lems.sim.runnable.Runnable.bind_required_variables
+                runnable.required_variables[v] = depth
+                var_prefix = "self." + get_required_variable_reference(v)
+
+            return "{0}.{1}".format(var_prefix, v)
+        elif name in dynamics.derived_variables or (
+            regime is not None and name in regime.derived_variables
+        ):
+            return "self.{0}".format(name)
+        else:
+            return "self.shadow[{0}]".format(runnable.shadow_index(name))
+
+    def find_common_subexpressions(self, runnable, regime, tree_nodes):
+        """
+        Finds the subexpressions occurring more than once in a sequence of
+        folded expression trees, evaluated in that order by a generated
+        method. Operands of short-circuiting operators and random numbers
+        are not shared.
+
+        :param tree_nodes: Folded expression trees.
+        :type tree_nodes: list(lems.parser.expr.ExprNode)
+
+        :rtype: lems.sim.optimize.CommonSubexpressions
+        """
+
+        counts = {}
+
+        def count(tree_node):
+            if tree_node.type == ExprNode.VALUE:
+                return
+            if tree_node.type == ExprNode.OP and self.is_short_circuit(
+                runnable, tree_node.op
+            ):
+                return
+
+            code = self.build_expression_code(runnable, regime, tree_node, None)[0]
+            if code in counts:
+                # Its subexpressions were counted at the first occurrence
+                counts[code] += 1
+                return
+            counts[code] = 1
+
+            if tree_node.type == ExprNode.FUNC1:
+                count(tree_node.param)
             else:
-                return tree_node.value
+                count(tree_node.left)
+                count(tree_node.right)
+
+        for tree_node in tree_nodes:
+            count(tree_node)
+
+        return CommonSubexpressions(
+            set(code for code, n in counts.items() if n > 1 and "random" not in code)
+        )
+
+    def is_short_circuit(self, runnable, op):
+        """
+        Checks if the right operand of an operator is not always evaluated.
+        """
+
+        return self.convert_op(op) in ["and", "or"] and not runnable.vectorized
+
+    def build_expression_code(self, runnable, regime, tree_node, common):
+        """
+        Recursively builds a Python expression from a parsed expression tree,
+        only parenthesizing subexpressions where needed.
+
+        :param common: Common subexpressions of the generated method, or
+        None.
+        :type common: lems.sim.optimize.CommonSubexpressions
+
+        :return: Generated Python expression and its precedence.
+        :rtype: (string, int)
+        """
+
+        if tree_node.type == ExprNode.VALUE:
+            if not is_literal(tree_node):
+                return (
+                    self.resolve_variable(runnable, regime, tree_node.value),
+                    ATOM_PRECEDENCE,
+                )
+            else:
+                return (tree_node.value, get_literal_precedence(tree_node.value))
         elif tree_node.type == ExprNode.FUNC1:
-            pattern = "({0}({1}))"
+            pattern = "{0}({1})"
             func = self.convert_func(tree_node.func)
             if "random.uniform" in func:
-                pattern = "({0}(0,{1}))"
-            return pattern.format(
-                func, self.build_expression_from_tree(runnable, regime, tree_node.param)
+                if runnable.vectorized:
+                    pattern = "self.random_uniform({1})"
+                else:
+                    pattern = "{0}(0,{1})"
+            (param, precedence) = self.build_expression_code(
+                runnable, regime, tree_node.param, common
             )
-        else:
-            return "({0}) {1} ({2})".format(
-                self.build_expression_from_tree(runnable, regime, tree_node.left),
+            result = (pattern.format(func, param), ATOM_PRECEDENCE)
+        elif self.is_short_circuit(runnable, tree_node.op):
+            # Subexpressions cannot be shared with operands which may not be
+            # evaluated.
+            return format_binary_op(
                 self.convert_op(tree_node.op),
-                self.build_expression_from_tree(runnable, regime, tree_node.right),
+                self.build_expression_code(runnable, regime, tree_node.left, None),
+                self.build_expression_code(runnable, regime, tree_node.right, None),
             )
+        else:
+            op = self.convert_op(tree_node.op)
+            if runnable.vectorized:
+                op = {"and": "&", "or": "|"}.get(op, op)
+            if (
+                op == "-"
+                and tree_node.left.type == ExprNode.VALUE
+                and tree_node.left.value == "0"
+            ):
+                # Unary minus, parsed as 0 - x
+                result = format_negation(
+                    self.build_expression_code(
+                        runnable, regime, tree_node.right, common
+                    )
+                )
+            else:
+                result = format_binary_op(
+                    op,
+                    self.build_expression_code(
+                        runnable, regime, tree_node.left, common
+                    ),
+                    self.build_expression_code(
+                        runnable, regime, tree_node.right, common
+                    ),
+                )
+
+        if common is not None and result[0] in common.codes:
+            return common.reference(result[0])
+        return result
 
     def build_event_handler(self, runnable, regime, event_handler):
         """
@@ -882,6 +1379,16 @@ class SimulationBuilder(LEMSBase):
         :rtype: list(string)
         """
 
+        if runnable.vectorized:
+            return self.build_vector_event_handler(
+                runnable,
+                regime,
+                self.build_expression_from_tree(
+                    runnable, regime, on_condition.expression_tree
+                ),
+                on_condition.actions,
+            )
+
         on_condition_code = []
 
         on_condition_code += [
@@ -909,6 +1416,15 @@ class SimulationBuilder(LEMSBase):
         :return: Generated OnEvent code
         :rtype: list(string)
         """
+        if runnable.vectorized:
+            code = ["count = self.event_in_counters['{0}']".format(on_event.port)]
+            code += self.build_vector_event_handler(
+                runnable, regime, "count > 0", on_event.actions, "count"
+            )
+            # Events wait for the trials in other regimes to handle them.
+            code += ["count[mask] = 0"]
+            return code
+
         on_event_code = []
 
         if self.debug:
@@ -935,6 +1451,63 @@ class SimulationBuilder(LEMSBase):
 
         return on_event_code
 
+    def build_vector_event_handler(
+        self, runnable, regime, condition, actions, event_count=None
+    ):
+        """
+        Build masked event handler code for a vectorized runnable.
+
+        :param condition: Python expression evaluating to a boolean mask.
+        :type condition: string
+
+        :param actions: Event handler actions.
+        :type actions: list(lems.model.dynamics.Action)
+
+        :param event_count: Name of the per-member count of events to emit for
+        each EventOut action. Defaults to the mask.
+        :type event_count: string
+
+        :return: Generated event handler code
+        :rtype: list(string)
+        """
+
+        if self.is_regime_masked(runnable, regime):
+            condition = "({0}) & self.in_regime".format(condition)
+        code = ["mask = {0}".format(condition)]
+
+        for action in actions:
+            if isinstance(action, StateAssignment):
+                code += self.mask_errors(
+                    [
+                        "self.{0} = where(mask, {1}, self.{0})".format(
+                            action.variable,
+                            self.build_expression_from_tree(
+                                runnable, regime, action.expression_tree
+                            ),
+                        )
+                    ]
+                )
+            elif isinstance(action, EventOut):
+                code += [
+                    "self.emit('{0}', {1})".format(
+                        action.port, event_count if event_count else "mask"
+                    )
+                ]
+            elif isinstance(action, Transition):
+                code += [
+                    "self.new_regime = where(mask, {0}, self.new_regime)".format(
+                        runnable.regime_index(action.regime)
+                    )
+                ]
+            else:
+                raise SimBuildError(
+                    "Unsupported action in vectorized component '{0}'".format(
+                        runnable.id
+                    )
+                )
+
+        return code
+
     def build_on_start(self, runnable, regime, on_start):
         """
         Build OnStart start handler code.
@@ -966,6 +1539,19 @@ class SimulationBuilder(LEMSBase):
         :rtype: list(string)
         """
 
+        if runnable.vectorized:
+            code = self.build_vector_event_handler(
+                runnable,
+                regime,
+                "self.current_regime != self.last_regime",
+                on_entry.actions,
+            )
+            code.insert(
+                1,
+                "self.last_regime = where(mask, self.current_regime, self.last_regime)",
+            )
+            return code
+
         on_entry_code = []
 
         on_entry_code += ["if self.current_regime != self.last_regime:"]
@@ -1030,9 +1616,8 @@ class SimulationBuilder(LEMSBase):
         """
 
         event_out_code = [
-            'if "{0}" in self.event_out_callbacks:'.format(event_out.port),
-            "    for c in self.event_out_callbacks['{0}']:".format(event_out.port),
-            "        c()",
+            'if "{0}" in self.event_out_fanouts:'.format(event_out.port),
+            "    self.event_out_fanouts['{0}']()".format(event_out.port),
         ]
 
         return event_out_code
@@ -1050,68 +1635,27 @@ class SimulationBuilder(LEMSBase):
 
         return ["self.new_regime = '{0}'".format(transition.regime)]
 
-    def build_reduce_code(self, result, select, reduce):
+    def build_reduce_code(self, runnable, result, select, reduce, required=None):
         """
         Builds a reduce operation on the selected target range.
+
+        The selected runnables are resolved once the simulation is built,
+        see lems.sim.runnable.Runnable.bind_reductions.
         """
 
-        select = select.replace("/", ".")
-        select = select.replace(" ", "")
-        if reduce == "add":
-            reduce_op = "+"
-            acc_start = 0
-        else:
-            reduce_op = "*"
-            acc_start = 1
-
-        # bits = select.split('[*]')
-        bits = re.split("\[.*\]", select)
-        seps = re.findall("\[.*\]", select)
-
-        code = ["self.{0} = {1}".format(result, acc_start)]
-        code += ["self.{0}_shadow = {1}".format(result, acc_start)]
-
-        code += ["try:"]
-
-        if len(bits) == 1:
-            target = select
-            code += ["    self.{0} = self.{1}".format(result, target)]
-            code += ["    self.{0}_shadow = self.{1}".format(result, target)]
-        elif len(bits) == 2:
-            sep = seps[0][1:-1]
-
-            if sep == "*":
-                array = bits[0]
-                ref = bits[1]
-
-                code += ["    acc = {0}".format(acc_start)]
-                code += ["    for o in self.{0}:".format(array)]
-                code += ["        acc = acc {0} o{1}".format(reduce_op, ref)]
-                code += ["    self.{0} = acc".format(result)]
-                code += ["    self.{0}_shadow = acc".format(result)]
-            else:
-                bits2 = sep.split("=")
-                if len(bits2) > 1:
-                    array = bits[0]
-                    ref = bits[1]
-
-                    code += ["    acc = {0}".format(acc_start)]
-                    code += ["    for o in self.{0}:".format(array)]
-                    code += ["        if o.{0} == {1}:".format(bits2[0], bits2[1])]
-                    code += ["            acc = acc {0} o{1}".format(reduce_op, ref)]
-                    code += ["    self.{0} = acc".format(result)]
-                    code += ["    self.{0}_shadow = acc".format(result)]
-                else:
-                    raise SimbuildError("Invalid reduce target - '{0}'".format(select))
-        else:
-            raise SimbuildError("Invalid reduce target - '{0}'".format(select))
+        shadow = "self.shadow[{0}]".format(runnable.shadow_index(result))
+
+        runnable.reductions[result] = Reduction(result, select, reduce, required)
 
-        code += ["except:"]
-        code += ["    pass"]
+        code = ["self.{0} = self.{1}()".format(result, get_reduction_reference(result))]
+        code += ["{0} = self.{1}".format(shadow, result)]
 
         return code
 
     def build_conditional_derived_var_code(self, runnable, regime, dv):
+        if runnable.vectorized:
+            return self.build_vector_conditional_derived_var_code(runnable, regime, dv)
+
         code = []
         el = ""
         for case in dv.cases:
@@ -1147,6 +1691,211 @@ class SimulationBuilder(LEMSBase):
                 ]
         return code
 
+    def build_vector_conditional_derived_var_code(self, runnable, regime, dv):
+        """
+        Builds a conditional derived variable as nested NumPy selections.
+        Members matching no case keep their previous value.
+        """
+
+        value = "self.{0}".format(dv.name)
+        for case in dv.cases:
+            if case.condition_expression_tree is None:
+                value = self.build_expression_from_tree(
+                    runnable, regime, case.value_expression_tree
+                )
+
+        for case in reversed(dv.cases):
+            if case.condition_expression_tree:
+                value = "where({0}, {1}, {2})".format(
+                    self.build_expression_from_tree(
+                        runnable, regime, case.condition_expression_tree
+                    ),
+                    self.build_expression_from_tree(
+                        runnable, regime, case.value_expression_tree
+                    ),
+                    value,
+                )
+
+        return self.mask_errors(
+            [
+                "self.{0} = {1}".format(
+                    dv.name, self.mask_regime(runnable, regime, dv.name, value)
+                )
+            ]
+        )
+
+    def get_dependent_variables(self, regime, dynamics, variable):
+        """
+        Finds the variables whose value depends on a state variable: the
+        variable itself and the derived variables computed from it, directly
+        or through other derived variables.
+
+        :param regime: Dynamics regime being built.
+        :type regime: lems.model.dynamics.Regime
+
+        :param dynamics: Shared dynamics specifications.
+        :type dynamics: lems.model.dynamics.Dynamics
+
+        :param variable: Name of the state variable.
+        :type variable: string
+
+        :return: Names of the dependent variables.
+        :rtype: set(string)
+        """
+
+        trees = {}
+        for r in [dynamics, regime]:
+            for dv in r.derived_variables:
+                if dv.expression_tree is not None:
+                    trees[dv.name] = [dv.expression_tree]
+            for dv in r.conditional_derived_variables:
+                trees[dv.name] = [
+                    tree
+                    for case in dv.cases
+                    for tree in [
+                        case.condition_expression_tree,
+                        case.value_expression_tree,
+                    ]
+                    if tree is not None
+                ]
+
+        dependent = set([variable])
+        found = True
+        while found:
+            found = False
+            for name in trees:
+                if name not in dependent and any(
+                    is_var_in_exp_tree(v, tree)
+                    for v in dependent
+                    for tree in trees[name]
+                ):
+                    dependent.add(name)
+                    found = True
+
+        return dependent
+
+    def build_linear_coefficient(
+        self, runnable, regime, tree_node, variable, dependent, common=None
+    ):
+        """
+        Builds the coefficient b of an expression of the form a + b * x,
+        where a and b do not depend on the state variable x.
+
+        :param runnable: Runnable object to which this expression would be added.
+        :type runnable: lems.sim.runnable.Runnable
+
+        :param regime: Dynamics regime being built.
+        :type regime: lems.model.dynamics.Regime
+
+        :param tree_node: Root node of the expression.
+        :type tree_node: lems.parser.expr.ExprNode
+
+        :param variable: Name of the state variable x.
+        :type variable: string
+
+        :param dependent: Variables depending on x, see
+        get_dependent_variables.
+        :type dependent: set(string)
+
+        :param common: Common subexpressions of the generated method, see
+        build_expression_from_tree.
+        :type common: lems.sim.optimize.CommonSubexpressions
+
+        :return: Python expression of the coefficient, "0" if the expression
+        does not depend on x, or None if it is not linear in x.
+        :rtype: string
+        """
+
+        if not any(is_var_in_exp_tree(v, tree_node) for v in dependent):
+            return "0"
+
+        if tree_node.type == ExprNode.VALUE:
+            # Derived variables depending on x are not expanded.
+            return "1" if tree_node.value == variable else None
+        elif tree_node.type != ExprNode.OP:
+            return None
+
+        left = self.build_linear_coefficient(
+            runnable, regime, tree_node.left, variable, dependent, common
+        )
+        right = self.build_linear_coefficient(
+            runnable, regime, tree_node.right, variable, dependent, common
+        )
+        if left is None or right is None:
+            return None
+
+        if tree_node.op in ["+", "-"]:
+            if right == "0":
+                return left
+            elif left == "0":
+                return right if tree_node.op == "+" else "-({0})".format(right)
+            return "({0}) {1} ({2})".format(left, tree_node.op, right)
+        elif tree_node.op == "*":
+            if left == "0":
+                (left, right) = (right, left)
+                factor = tree_node.left
+            elif right == "0":
+                factor = tree_node.right
+            else:
+                return None
+            return "({0}) * ({1})".format(
+                left, self.build_expression_from_tree(runnable, regime, factor, common)
+            )
+        elif tree_node.op == "/" and right == "0":
+            return "({0}) / ({1})".format(
+                left,
+                self.build_expression_from_tree(
+                    runnable, regime, tree_node.right, common
+                ),
+            )
+        else:
+            return None
+
+    def is_regime_masked(self, runnable, regime):
+        """
+        Checks if the code generated for a regime must be restricted to the
+        trials in that regime, which is the case for the regimes of ensemble
+        runnables (see lems.sim.vector.EnsembleRunnable.in_regime).
+        """
+
+        return runnable.vectorized and isinstance(regime, Regime) and regime.name != ""
+
+    def mask_errors(self, code):
+        """
+        Ignores the floating point errors of vectorized statements
+        selecting values with where, which are also computed for the
+        members whose values are discarded (see
+        lems.sim.vector.masked_errors).
+
+        :param code: Lines of generated code.
+        :type code: list(string)
+
+        :return: Lines of generated code run with these errors ignored.
+        :rtype: list(string)
+        """
+
+        return ["with masked_errors():"] + ["    " + line for line in code]
+
+    def mask_regime(self, runnable, regime, variable, value):
+        """
+        Restricts an assignment generated for a regime to the trials in
+        that regime, see is_regime_masked.
+
+        :param variable: Variable assigned.
+        :type variable: string
+
+        :param value: Python expression of the new value.
+        :type value: string
+
+        :return: Python expression of the masked value.
+        :rtype: string
+        """
+
+        if not self.is_regime_masked(runnable, regime):
+            return value
+
+        return "where(self.in_regime, {0}, self.{1})".format(value, variable)
+
     def add_recording_behavior(self, component, runnable):
         """
         Adds recording-related dynamics to a runnable component based on
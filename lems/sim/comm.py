@@ -0,0 +1,412 @@
+"""
+Communicators passing the events exchanged by the parts of a partitioned
+simulation (see lems.sim.partition), whether the parts run in worker
+processes of one machine or on several nodes.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import os
+import sys
+import time
+from multiprocessing.connection import Client, Listener
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimError
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+
+def route(messages):
+    """
+    Routes the events sent by each part of a partitioned simulation to
+    their destination parts.
+
+    :param messages: Events sent by each part to each part, as
+    (step, destination, count), and whether the part has completed.
+    :type messages: list((list(list((int, int, int))), Boolean))
+
+    :return: Events received by each part, in order of the sending parts,
+    and whether all parts have completed.
+    :rtype: list((list((int, int, int)), Boolean))
+    """
+
+    done = all(message[1] for message in messages)
+    replies = []
+    for part in range(len(messages)):
+        events = []
+        for message in messages:
+            events += message[0][part]
+        replies.append((events, done))
+    return replies
+
+
+def receive(connection, part):
+    """
+    Receives a message sent by a part through a connection.
+
+    :param connection: Connection to the part.
+    :type connection: multiprocessing.connection.Connection
+
+    :param part: Index of the part.
+    :type part: int
+
+    :return: Kind of the message, followed by its content.
+    :rtype: tuple
+
+    :raises SimError: Raised if the part failed or stopped.
+    """
+
+    try:
+        message = connection.recv()
+    except (EOFError, OSError):
+        raise SimError("Part {0} of the simulation stopped".format(part))
+    if message[0] == "error":
+        raise SimError("Partitioned simulation failed:\n" + message[1])
+    return message
+
+
+class Communicator(LEMSBase):
+    """
+    Base class for communicators, exchanging the events of one part of a
+    partitioned simulation with the other parts.
+    """
+
+    def __init__(self, part, size):
+        """
+        Constructor.
+
+        :param part: Index of the part.
+        :type part: int
+
+        :param size: Number of parts.
+        :type size: int
+        """
+
+        self.part = part
+        """ Index of the part.
+
+        :type: int """
+
+        self.size = size
+        """ Number of parts.
+
+        :type: int """
+
+    def exchange(self, batches, done):
+        """
+        Sends the events sent to each part and receives those sent to this
+        part. Blocks until all parts have made the same exchange.
+
+        :param batches: Events sent to each part since the last exchange,
+        as (step, destination, count).
+        :type batches: list(list((int, int, int)))
+
+        :param done: True if this part has completed.
+        :type done: Boolean
+
+        :return: Events sent to this part, in order of the sending parts,
+        and True if all parts have completed.
+        :rtype: (list((int, int, int)), Boolean)
+        """
+
+        raise NotImplementedError()
+
+    def gather(self, result):
+        """
+        Collects the results of all parts in the first part.
+
+        :param result: Result of this part.
+
+        :return: Results of all parts in the first part, None in the others.
+        :rtype: list
+        """
+
+        raise NotImplementedError()
+
+    def fail(self, message):
+        """
+        Reports the failure of this part to the other parts.
+
+        :param message: Description of the failure.
+        :type message: string
+        """
+
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Releases the resources held by the communicator.
+        """
+
+        pass
+
+
+class PipeCommunicator(Communicator):
+    """
+    Communicator of a part run in a worker process, through a pipe to the
+    process which started the parts (see
+    lems.sim.partition.route_events).
+    """
+
+    def __init__(self, part, size, connection):
+        """
+        Constructor.
+
+        :param part: Index of the part.
+        :type part: int
+
+        :param size: Number of parts.
+        :type size: int
+
+        :param connection: End of the pipe held by the part.
+        :type connection: multiprocessing.connection.Connection
+        """
+
+        Communicator.__init__(self, part, size)
+
+        self.connection = connection
+        """ End of the pipe held by the part.
+
+        :type: multiprocessing.connection.Connection """
+
+    def exchange(self, batches, done):
+        self.connection.send(("exchange", batches, done))
+        try:
+            return self.connection.recv()
+        except EOFError:
+            raise SimError("The partitioned simulation stopped")
+
+    def gather(self, result):
+        self.connection.send(("result", result))
+        return None
+
+    def fail(self, message):
+        self.connection.send(("error", message))
+
+    def close(self):
+        self.connection.close()
+
+
+def connect(address, authkey, timeout=60):
+    """
+    Connects to a listening socket, waiting for it to be opened.
+
+    :param address: Host name and port of a TCP socket, or path of a Unix
+    socket.
+    :type address: (string, int) or string
+
+    :param authkey: Key authenticating the connection, shared with the
+    listening process.
+    :type authkey: bytes
+
+    :param timeout: Time in seconds to wait for the socket.
+    :type timeout: float
+
+    :rtype: multiprocessing.connection.Connection
+
+    :raises SimError: Raised if the socket is not opened in time.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise SimError("Could not connect to {0}".format(address))
+            time.sleep(0.05)
+
+
+class SocketCommunicator(Communicator):
+    """
+    Communicator of parts connected by TCP or Unix sockets, which may run
+    on different nodes.
+
+    The first part listens on the address and routes the events of all
+    parts; the others connect to it. Each part builds the simulation from
+    the same resolved model, so that all parts divide it in the same way.
+
+    Messages are pickled, so connections are authenticated with a secret
+    key: the key of the first part (see the authkey attribute) must be
+    passed to the other parts, for instance through the launcher starting
+    them.
+    """
+
+    def __init__(self, part, size, address, authkey=None, timeout=60):
+        """
+        Constructor. The first part starts listening on the address, and
+        the others connect to it.
+
+        :param part: Index of the part.
+        :type part: int
+
+        :param size: Number of parts.
+        :type size: int
+
+        :param address: Host name and port of a TCP socket, or path of a
+        Unix socket, opened by the first part. A port of 0 lets the first
+        part choose a free port, see the address attribute.
+        :type address: (string, int) or string
+
+        :param authkey: Key authenticating the connections. Generated by
+        the first part if not given, and required by the others.
+        :type authkey: bytes
+
+        :param timeout: Time in seconds the other parts wait for the first
+        part to listen.
+        :type timeout: float
+
+        :raises SimError: Raised if no key is given to a part other than
+        the first.
+        """
+
+        Communicator.__init__(self, part, size)
+
+        if authkey is None:
+            if part != 0:
+                raise SimError("The key of the first part is required to connect to it")
+            authkey = os.urandom(32)
+
+        self.authkey = authkey
+        """ Key authenticating the connections of the parts.
+
+        :type: bytes """
+
+        self.listener = None
+        """ Socket on which the first part accepts the other parts.
+
+        :type: multiprocessing.connection.Listener """
+
+        self.connections = None
+        """ Connections of the first part to the other parts, in order.
+        Accepted on the first exchange.
+
+        :type: list(multiprocessing.connection.Connection) """
+
+        self.connection = None
+        """ Connection of another part to the first part.
+
+        :type: multiprocessing.connection.Connection """
+
+        if part == 0:
+            self.listener = Listener(address, authkey=authkey)
+            address = self.listener.address
+        else:
+            self.connection = connect(address, authkey, timeout)
+            self.connection.send(part)
+
+        self.address = address
+        """ Address on which the first part listens.
+
+        :type: (string, int) or string """
+
+    def accept(self):
+        """
+        Accepts the connections of the other parts to the first part.
+        """
+
+        if self.connections is not None:
+            return
+        connections = {}
+        while len(connections) < self.size - 1:
+            connection = self.listener.accept()
+            part = connection.recv()
+            if part in connections or not 0 < part < self.size:
+                raise SimError("Unexpected connection of part {0}".format(part))
+            connections[part] = connection
+        self.connections = [connections[part] for part in range(1, self.size)]
+
+    def exchange(self, batches, done):
+        if self.part != 0:
+            self.connection.send(("exchange", batches, done))
+            try:
+                return self.connection.recv()
+            except (EOFError, OSError):
+                raise SimError("The first part of the simulation stopped")
+
+        self.accept()
+        messages = [(batches, done)]
+        for (part, connection) in enumerate(self.connections, 1):
+            message = receive(connection, part)
+            if message[0] != "exchange":
+                raise SimError("Part {0} of the simulation stopped".format(part))
+            messages.append(message[1:])
+        replies = route(messages)
+        for (connection, reply) in zip(self.connections, replies[1:]):
+            connection.send(reply)
+        return replies[0]
+
+    def gather(self, result):
+        if self.part != 0:
+            self.connection.send(("result", result))
+            return None
+
+        self.accept()
+        results = [result]
+        for (part, connection) in enumerate(self.connections, 1):
+            message = receive(connection, part)
+            if message[0] != "result":
+                raise SimError("Part {0} of the simulation stopped".format(part))
+            results.append(message[1])
+        return results
+
+    def fail(self, message):
+        if self.part != 0:
+            self.connection.send(("error", message))
+
+    def close(self):
+        for connection in self.connections or [self.connection]:
+            if connection is not None:
+                connection.close()
+        if self.listener is not None:
+            self.listener.close()
+
+
+class MPICommunicator(Communicator):
+    """
+    Communicator of parts run as the processes of an MPI communicator, for
+    instance those started by mpiexec. Requires mpi4py.
+    """
+
+    def __init__(self, comm=None):
+        """
+        Constructor.
+
+        :param comm: MPI communicator of the parts, one per process.
+        Defaults to MPI.COMM_WORLD.
+        :type comm: mpi4py.MPI.Comm
+
+        :raises SimError: Raised if mpi4py is not installed.
+        """
+
+        if MPI is None:
+            raise SimError("mpi4py is required to run simulations with MPI")
+        if comm is None:
+            comm = MPI.COMM_WORLD
+
+        Communicator.__init__(self, comm.Get_rank(), comm.Get_size())
+
+        self.comm = comm
+        """ MPI communicator of the parts.
+
+        :type: mpi4py.MPI.Comm """
+
+    def exchange(self, batches, done):
+        events = []
+        for batch in self.comm.alltoall(batches):
+            events += batch
+        return (events, self.comm.allreduce(done, op=MPI.LAND))
+
+    def gather(self, result):
+        return self.comm.gather(result, root=0)
+
+    def fail(self, message):
+        # The other processes are blocked in collective operations.
+        sys.stderr.write(message)
+        sys.stderr.flush()
+        self.comm.Abort(1)
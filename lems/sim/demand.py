@@ -0,0 +1,236 @@
+"""
+Build-time analysis of the derived variables read during a simulation, so
+that only those are computed at each step.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import re
+
+from lems.parser.expr import ExprNode
+from lems.model.dynamics import OnCondition, StateAssignment
+from lems.sim.runnable import Runnable
+from lems.sim.vector import InstanceView
+
+
+def get_expression_variables(tree):
+    """
+    Lists the variables referred to by an expression.
+
+    :param tree: Root node of the expression tree.
+    :type tree: lems.parser.expr.ExprNode
+
+    :return: Variable names.
+    :rtype: set(string)
+    """
+
+    variables = set()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if node is None:
+            continue
+        if node.type == ExprNode.VALUE:
+            if node.value[0].isalpha():
+                variables.add(node.value)
+        elif node.type == ExprNode.OP:
+            nodes += [node.left, node.right]
+        elif node.type == ExprNode.FUNC1:
+            nodes.append(node.param)
+    return variables
+
+
+def get_event_handler_variables(event_handler):
+    """
+    Lists the variables read by the condition and actions of an event
+    handler.
+    """
+
+    variables = set()
+    if isinstance(event_handler, OnCondition):
+        variables |= get_expression_variables(event_handler.expression_tree)
+    for action in event_handler.actions:
+        if isinstance(action, StateAssignment):
+            variables |= get_expression_variables(action.expression_tree)
+    return variables
+
+
+def get_read_variables(dynamics):
+    """
+    Lists the variables read by the time derivatives and event handlers of
+    the dynamics of a component and its regimes. Variables read only by
+    derived variables are not included.
+
+    :param dynamics: Dynamics of a component.
+    :type dynamics: lems.model.dynamics.Dynamics
+
+    :return: Variable names.
+    :rtype: set(string)
+    """
+
+    variables = set()
+    for behavior in [dynamics] + list(dynamics.regimes):
+        for td in behavior.time_derivatives:
+            variables |= get_expression_variables(td.expression_tree)
+        for event_handler in behavior.event_handlers:
+            variables |= get_event_handler_variables(event_handler)
+    return variables
+
+
+def find_derived_variable(dynamics, name):
+    """
+    Finds the definition of a derived variable in the dynamics of a
+    component or in one of its regimes.
+
+    :return: Derived variable, conditional derived variable or None.
+    :rtype: lems.model.dynamics.DerivedVariable
+    """
+
+    for behavior in [dynamics] + list(dynamics.regimes):
+        if name in behavior.derived_variables:
+            return behavior.derived_variables[name]
+        if name in behavior.conditional_derived_variables:
+            return behavior.conditional_derived_variables[name]
+    return None
+
+
+def get_derived_variable_reads(dv):
+    """
+    Lists the variables read by the expression or cases of a derived
+    variable. Selected variables are not included.
+
+    :rtype: set(string)
+    """
+
+    if getattr(dv, "cases", None) is not None:
+        variables = set()
+        for case in dv.cases:
+            variables |= get_expression_variables(case.condition_expression_tree)
+            variables |= get_expression_variables(case.value_expression_tree)
+        return variables
+    elif dv.expression_tree is not None:
+        return get_expression_variables(dv.expression_tree)
+    else:
+        return set()
+
+
+def resolve_select(runnable, select):
+    """
+    Finds the runnables and variables read by a derived variable selecting
+    the variables of other runnables, such as "populations[*]/current".
+    Filtered selections, such as "populations[ion='ca']/i", are resolved to
+    all candidates.
+
+    :param runnable: Runnable of the derived variable.
+    :type runnable: lems.sim.runnable.Runnable
+
+    :param select: Path of the selected variable.
+    :type select: string
+
+    :return: List of (runnable, variable name).
+    :rtype: list((lems.sim.runnable.Runnable, string))
+    """
+
+    steps = select.replace(" ", "").split("/")
+    objects = [runnable]
+    for step in steps[:-1]:
+        match = re.match(r"(\w+)(\[(.*)\])?$", step)
+        if match is None:
+            return []
+
+        found = []
+        for o in objects:
+            value = getattr(o, match.group(1), None)
+            if isinstance(value, Runnable) and match.group(2) is not None:
+                # Members of a runnable are those of its array
+                value = value.array
+            if isinstance(value, list):
+                if match.group(2) is None:
+                    return []
+                index = match.group(3)
+                if index.isdigit():
+                    value = value[int(index)] if int(index) < len(value) else None
+                else:
+                    found += value
+                    continue
+            if value is not None:
+                found.append(value)
+        objects = found
+
+    targets = []
+    for o in objects:
+        if isinstance(o, InstanceView):
+            targets.append((o.population, steps[-1]))
+        elif isinstance(o, Runnable):
+            targets.append((o, steps[-1]))
+    return targets
+
+
+def resolve_variable(runnable, name):
+    """
+    Finds the runnable holding a variable read by the expressions of a
+    runnable: the runnable itself or, for requirements, an ancestor.
+
+    :return: Runnable holding the variable, or None.
+    :rtype: lems.sim.runnable.Runnable
+    """
+
+    r = runnable
+    while (
+        r is not None
+        and name not in r.instance_variables
+        and name not in r.derived_variables
+    ):
+        r = r.parent
+    return r
+
+
+def find_needed_derived_variables(runnables):
+    """
+    Finds the derived variables of a set of runnables that are read during
+    a simulation: by time derivatives and event handlers, by recordings, by
+    derived variables of other runnables selecting them or by requirements
+    of descendants, and, transitively, by other needed derived variables.
+
+    :param runnables: All runnables of the simulation.
+    :type runnables: list(lems.sim.runnable.Runnable)
+
+    :return: Names of the needed derived variables by runnable uid.
+    :rtype: dict(int, set(string))
+    """
+
+    needed = dict((r.uid, set()) for r in runnables)
+    pending = []
+
+    def demand(runnable, name):
+        if runnable is None or name not in runnable.derived_variables:
+            return
+        names = needed.setdefault(runnable.uid, set())
+        if name not in names:
+            names.add(name)
+            pending.append((runnable, name))
+
+    for runnable in runnables:
+        if runnable.component is None:
+            continue
+        for name in get_read_variables(runnable.component.dynamics):
+            demand(resolve_variable(runnable, name), name)
+        for recording in runnable.recorded_variables:
+            demand(runnable, recording.variable)
+        for index, variable, recording in getattr(runnable, "recorders", []):
+            demand(runnable, variable)
+
+    while pending:
+        (runnable, name) = pending.pop()
+        dv = find_derived_variable(runnable.component.dynamics, name)
+        if dv is None:
+            continue
+
+        for variable in get_derived_variable_reads(dv):
+            demand(resolve_variable(runnable, variable), variable)
+        if getattr(dv, "select", None):
+            for target, variable in resolve_select(runnable, dv.select):
+                demand(target, variable)
+
+    return needed
@@ -0,0 +1,821 @@
+"""
+Delivery of events from event out ports to connected event in ports.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimBuildError, SimError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def get_event_counter(target, port):
+    """
+    Locates the counter incremented when an event reaches an event in port.
+
+    :param target: Runnable (or member of a vectorized population) receiving
+    the events.
+    :type target: lems.sim.runnable.Runnable
+
+    :param port: Event in port.
+    :type port: string
+
+    :return: The counter dictionary of a scalar runnable and the port, or
+    the counter array of a vectorized population and the index of the member.
+    :rtype: (dict(string, int), string) or (numpy.ndarray, int)
+    """
+
+    if target.vectorized:
+        # Member of a population, see lems.sim.vector.InstanceView
+        return (target.population.event_in_counters[port], target.index)
+    else:
+        return (target.event_in_counters, port)
+
+
+def get_event_delay(component, event_connection):
+    """
+    Gets the delay of an event connection.
+
+    :param component: Component containing the event connection.
+    :type component: lems.model.component.FatComponent
+
+    :param event_connection: Event connection.
+    :type event_connection: lems.model.structure.EventConnection
+
+    :return: Delay in seconds (0 if the connection has no delay).
+    :rtype: float
+
+    :raises SimBuildError: Raised if the delay parameter is not defined.
+    """
+
+    delay = event_connection.delay
+    if not delay:
+        return 0
+    if delay not in component.parameters:
+        raise SimBuildError(
+            "Unable to find delay parameter '{0}' in component '{1}'".format(
+                delay, component.id
+            )
+        )
+    return component.parameters[delay].numeric_value
+
+
+def gather_rows(indptr, indices, rows, counts):
+    """
+    Collects the entries of the given rows of a CSR matrix.
+
+    :param indptr: Row offsets into indices.
+    :type indptr: numpy.ndarray
+
+    :param indices: Column indices.
+    :type indices: numpy.ndarray
+
+    :param rows: Rows to be collected.
+    :type rows: numpy.ndarray
+
+    :param counts: Weight of each row.
+    :type counts: numpy.ndarray
+
+    :return: Column indices of the collected entries and their weights.
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    total = int(lengths.sum())
+
+    # Offset of each entry within the concatenation of the rows, shifted
+    # to the start of its row.
+    ends = numpy.cumsum(lengths)
+    offsets = numpy.arange(total) + numpy.repeat(starts - ends + lengths, lengths)
+
+    return (indices[offsets], numpy.repeat(counts, lengths))
+
+
+def get_delay_steps(queue, delay):
+    """
+    Converts a connection delay into a number of queue steps.
+
+    :raises SimError: Raised if there is no queue for delayed events.
+    """
+
+    if queue is None:
+        raise SimError("Delayed event connections require an event queue")
+    return queue.get_delay_steps(delay)
+
+
+class EventQueue(LEMSBase):
+    """
+    Holds delayed events until they are due.
+
+    Events are kept in a ring buffer with one slot per time step, indexed by
+    the step at which they are to be delivered. The events posted to the same
+    fanout for the same step are merged, so that each fanout delivers once
+    per step however many events it received.
+    """
+
+    def __init__(self):
+        self.time_step = 0
+        """ Time step of the queue, normally the smallest time step of the
+        simulation. Delays are rounded to a whole number of steps.
+
+        :type: float """
+
+        self.step = 0
+        """ Current step.
+
+        :type: int """
+
+        self.slots = [{}]
+        """ Ring buffer of the events due at each step. Each slot maps the
+        id of a fanout to the fanout and the number of events to be
+        delivered.
+
+        :type: list(dict(int, list)) """
+
+        self.pending = 0
+        """ Number of non-empty slots.
+
+        :type: int """
+
+        self.active = False
+        """ Set if there are delayed event connections, in which case the
+        queue must be advanced on each simulation step.
+
+        :type: Boolean """
+
+    def reset(self, time_step):
+        """
+        Discards all events and restarts the queue.
+
+        :param time_step: Time step of the queue.
+        :type time_step: float
+        """
+
+        self.time_step = time_step
+        self.step = 0
+        self.slots = [{}]
+        self.pending = 0
+        self.active = False
+
+    def get_delay_steps(self, delay):
+        """
+        Converts a delay into a number of steps (at least one), growing the
+        ring buffer if needed.
+
+        :param delay: Delay in seconds.
+        :type delay: float
+
+        :return: Number of steps.
+        :rtype: int
+        """
+
+        if self.time_step <= 0:
+            raise SimError("The event queue has no time step")
+
+        steps = max(1, int(round(delay / self.time_step)))
+        self.reserve(steps)
+        return steps
+
+    def reserve(self, steps):
+        """
+        Grows the ring buffer, if needed, so that events can be posted a
+        number of steps ahead.
+
+        :param steps: Number of steps.
+        :type steps: int
+        """
+
+        size = len(self.slots)
+        if steps >= size:
+            new_size = max(steps + 1, 2 * size)
+            slots = [{} for i in range(new_size)]
+            for step in range(self.step, self.step + size):
+                slots[step % new_size] = self.slots[step % size]
+            self.slots = slots
+
+    def post(self, steps, fanout, count):
+        """
+        Posts events to be delivered by a fanout after a number of steps.
+
+        :param steps: Delay in steps (less than the size of the ring buffer).
+        :type steps: int
+
+        :param fanout: Fanout delivering the events.
+        :type fanout: lems.sim.events.EventFanout or
+        lems.sim.events.PopulationFanout
+
+        :param count: Number of events, or per-member event counts.
+        :type count: int or numpy.ndarray
+        """
+
+        slot = self.slots[(self.step + steps) % len(self.slots)]
+        if not slot:
+            self.pending += 1
+
+        key = id(fanout)
+        if key in slot:
+            slot[key][1] = slot[key][1] + count
+        else:
+            slot[key] = [fanout, count]
+
+    def post_at(self, step, fanout, count):
+        """
+        Posts events to be delivered by a fanout at a given step.
+
+        :param step: Step at which the events are delivered.
+        :type step: int
+
+        :param fanout: Fanout delivering the events.
+        :type fanout: lems.sim.events.EventFanout
+
+        :param count: Number of events.
+        :type count: int
+
+        :raises SimError: Raised if the step has already been reached.
+        """
+
+        steps = step - self.step
+        if steps < 1:
+            raise SimError(
+                "Unable to post events for step {0} at step {1}".format(step, self.step)
+            )
+        self.reserve(steps)
+        self.post(steps, fanout, count)
+
+    def advance(self, time):
+        """
+        Delivers the events due up to the step containing a time.
+
+        :param time: Current simulation time.
+        :type time: float
+        """
+
+        step = int(round(time / self.time_step))
+        if not self.pending:
+            if step > self.step:
+                self.step = step
+            return
+
+        size = len(self.slots)
+        while self.step < step:
+            self.step += 1
+            index = self.step % size
+            slot = self.slots[index]
+            if slot:
+                self.slots[index] = {}
+                self.pending -= 1
+                for fanout, count in slot.values():
+                    fanout(count)
+
+    def get_state(self, fanouts):
+        """
+        Returns the pending events.
+
+        :param fanouts: Fanouts with delayed connections, which identify the
+        delayed events in the returned state.
+        :type fanouts: list(lems.sim.events.EventFanout)
+
+        :return: Current step and list of (steps until delivery, fanout index,
+        delay index, count) for each pending delivery.
+        :rtype: (int, list((int, int, int, int or numpy.ndarray)))
+        """
+
+        keys = {}
+        for i, fanout in enumerate(fanouts):
+            if not fanout.compiled:
+                fanout.compile()
+            for j, (steps, delayed) in enumerate(fanout.delayed):
+                keys[id(delayed)] = (i, j)
+
+        pending = []
+        size = len(self.slots)
+        for steps in range(1, size):
+            for delayed, count in self.slots[(self.step + steps) % size].values():
+                (i, j) = keys[id(delayed)]
+                pending.append((steps, i, j, count))
+
+        return (self.step, pending)
+
+    def set_state(self, state, fanouts):
+        """
+        Restores the pending events returned by get_state.
+
+        :param state: Pending events.
+        :type state: tuple
+
+        :param fanouts: Fanouts with delayed connections, in the order
+        passed to get_state.
+        :type fanouts: list(lems.sim.events.EventFanout)
+        """
+
+        (step, pending) = state
+
+        for fanout in fanouts:
+            if not fanout.compiled:
+                fanout.compile()
+
+        self.step = step
+        self.slots = [{} for slot in self.slots]
+        self.pending = 0
+        for steps, i, j, count in pending:
+            self.post(steps, fanouts[i].delayed[j][1], count)
+
+
+class EventFanout(LEMSBase):
+    """
+    Connections of one event out port of a runnable.
+
+    Connections are recorded as (target, port, delay) tuples and compiled on
+    first delivery: targets which are scalar runnables become (counter
+    dictionary, port) pairs, and targets in vectorized populations become
+    one array of member indices per population, incremented with a single
+    scatter-add. Connections with a delay are grouped by delay into fanouts
+    which are posted to the event queue.
+    """
+
+    def __init__(self):
+        self.links = []
+        """ Connected event in ports, with delays in seconds.
+
+        :type: list((lems.sim.runnable.Runnable, string, float)) """
+
+        self.callbacks = []
+        """ Other functions called for each event.
+
+        :type: list(callable) """
+
+        self.scalar_targets = []
+        """ Counters of the scalar targets, built by compile.
+
+        :type: list((dict(string, int), string)) """
+
+        self.vector_targets = []
+        """ Counter arrays of the vectorized targets and the indices of the
+        members to be incremented, built by compile.
+
+        :type: list((numpy.ndarray, numpy.ndarray, Boolean)) """
+
+        self.delayed = []
+        """ Fanouts of the delayed connections with their delays in steps,
+        built by compile.
+
+        :type: list((int, lems.sim.events.EventFanout)) """
+
+        self.queue = None
+        """ Queue holding delayed events.
+
+        :type: lems.sim.events.EventQueue """
+
+        self.compiled = False
+        """ Set if the compiled targets are up to date.
+
+        :type: Boolean """
+
+    def connect(self, target, port, delay=0):
+        """
+        Connects an event in port.
+
+        :param target: Runnable receiving the events.
+        :type target: lems.sim.runnable.Runnable
+
+        :param port: Event in port of the target.
+        :type port: string
+
+        :param delay: Delay in seconds before events are delivered.
+        :type delay: float
+        """
+
+        self.links.append((target, port, delay))
+        self.compiled = False
+
+    def has_delays(self):
+        """
+        Checks if any connection has a delay.
+        """
+
+        return any(delay > 0 for target, port, delay in self.links)
+
+    def set_queue(self, queue):
+        """
+        Sets the queue holding delayed events.
+
+        :param queue: Event queue.
+        :type queue: lems.sim.events.EventQueue
+        """
+
+        self.queue = queue
+        self.compiled = False
+
+    def copy(self):
+        """
+        Copies the connections and callbacks.
+
+        :return: New fanout
+        :rtype: lems.sim.events.EventFanout
+        """
+
+        fanout = EventFanout()
+        fanout.links = list(self.links)
+        fanout.callbacks = self.callbacks
+        return fanout
+
+    def compile(self):
+        """
+        Resolves the counters of the connected ports.
+        """
+
+        self.scalar_targets = []
+        self.delayed = []
+        delayed = {}
+        arrays = {}
+        for target, port, delay in self.links:
+            if delay > 0:
+                steps = get_delay_steps(self.queue, delay)
+                if steps not in delayed:
+                    delayed[steps] = EventFanout()
+                    self.delayed.append((steps, delayed[steps]))
+                delayed[steps].connect(target, port)
+                continue
+
+            counters, key = get_event_counter(target, port)
+            if isinstance(counters, dict):
+                self.scalar_targets.append((counters, key))
+            else:
+                if id(counters) not in arrays:
+                    arrays[id(counters)] = (counters, [])
+                arrays[id(counters)][1].append(key)
+
+        self.vector_targets = []
+        for counters, indices in arrays.values():
+            unique = len(set(indices)) == len(indices)
+            self.vector_targets.append((counters, numpy.array(indices), unique))
+
+        self.compiled = True
+
+    def __call__(self, count=1):
+        """
+        Delivers events to all connected ports.
+
+        :param count: Number of events.
+        :type count: int
+        """
+
+        if not self.compiled:
+            self.compile()
+
+        for counters, port in self.scalar_targets:
+            counters[port] += count
+        for counters, indices, unique in self.vector_targets:
+            if unique:
+                counters[indices] += count
+            else:
+                numpy.add.at(counters, indices, count)
+        for steps, fanout in self.delayed:
+            self.queue.post(steps, fanout, count)
+        for _ in range(count):
+            for c in self.callbacks:
+                c()
+
+
+class PopulationFanout(LEMSBase):
+    """
+    Connections of one event out port of all members of a vectorized
+    population.
+
+    Connectivity to each vectorized target population is compiled into a CSR
+    matrix of member indices (one row per source member), so that the events
+    emitted by the whole population in a step are delivered with one
+    scatter-add per target population.
+    """
+
+    def __init__(self, size):
+        """
+        Constructor.
+
+        :param size: Number of members in the source population.
+        :type size: int
+        """
+
+        self.size = size
+        """ Number of members in the source population.
+
+        :type: int """
+
+        self.links = [[] for i in range(size)]
+        """ Connected event in ports of each member, with delays in seconds.
+
+        :type: list(list((lems.sim.runnable.Runnable, string, float))) """
+
+        self.callbacks = [[] for i in range(size)]
+        """ Other functions called for each event emitted by a member.
+
+        :type: list(list(callable)) """
+
+        self.scalar_targets = None
+        """ Counters of the scalar targets of each member, built by compile.
+
+        :type: list(list((dict(string, int), string))) """
+
+        self.vector_targets = []
+        """ Counter arrays of the vectorized targets with the CSR row offsets
+        and member indices of their connections, built by compile.
+
+        :type: list((numpy.ndarray, numpy.ndarray, numpy.ndarray)) """
+
+        self.delayed = []
+        """ Fanouts of the delayed connections with their delays in steps,
+        built by compile.
+
+        :type: list((int, lems.sim.events.PopulationFanout)) """
+
+        self.queue = None
+        """ Queue holding delayed events.
+
+        :type: lems.sim.events.EventQueue """
+
+        self.compiled = False
+        """ Set if the compiled targets are up to date.
+
+        :type: Boolean """
+
+    def connect(self, index, target, port, delay=0):
+        """
+        Connects an event in port to a member.
+
+        :param index: Index of the source member.
+        :type index: int
+
+        :param target: Runnable receiving the events.
+        :type target: lems.sim.runnable.Runnable
+
+        :param port: Event in port of the target.
+        :type port: string
+
+        :param delay: Delay in seconds before events are delivered.
+        :type delay: float
+        """
+
+        self.links[index].append((target, port, delay))
+        self.compiled = False
+
+    def has_delays(self):
+        """
+        Checks if any connection has a delay.
+        """
+
+        return any(delay > 0 for links in self.links for t, p, delay in links)
+
+    def set_queue(self, queue):
+        """
+        Sets the queue holding delayed events.
+
+        :param queue: Event queue.
+        :type queue: lems.sim.events.EventQueue
+        """
+
+        self.queue = queue
+        self.compiled = False
+
+    def compile(self):
+        """
+        Builds the CSR matrices of the connections.
+        """
+
+        scalar_targets = [[] for i in range(self.size)]
+        has_scalar_targets = False
+        self.delayed = []
+        delayed = {}
+        arrays = {}
+        for i, links in enumerate(self.links):
+            for target, port, delay in links:
+                if delay > 0:
+                    steps = get_delay_steps(self.queue, delay)
+                    if steps not in delayed:
+                        delayed[steps] = PopulationFanout(self.size)
+                        self.delayed.append((steps, delayed[steps]))
+                    delayed[steps].connect(i, target, port)
+                    continue
+
+                counters, key = get_event_counter(target, port)
+                if isinstance(counters, dict):
+                    scalar_targets[i].append((counters, key))
+                    has_scalar_targets = True
+                else:
+                    if id(counters) not in arrays:
+                        arrays[id(counters)] = (
+                            counters,
+                            [[] for j in range(self.size)],
+                        )
+                    arrays[id(counters)][1][i].append(key)
+
+        self.scalar_targets = scalar_targets if has_scalar_targets else None
+
+        self.vector_targets = []
+        for counters, rows in arrays.values():
+            indptr = numpy.zeros(self.size + 1, dtype=numpy.intp)
+            indptr[1:] = numpy.cumsum([len(row) for row in rows])
+            indices = numpy.array([j for row in rows for j in row], dtype=numpy.intp)
+            self.vector_targets.append((counters, indptr, indices))
+
+        self.compiled = True
+
+    def __call__(self, fired):
+        """
+        Delivers the events emitted by the population.
+
+        :param fired: Boolean mask or per-member event counts.
+        :type fired: numpy.ndarray
+        """
+
+        if not self.compiled:
+            self.compile()
+
+        fired = numpy.broadcast_to(fired, (self.size,))
+        rows = numpy.flatnonzero(fired)
+        if not rows.size:
+            return
+        counts = fired[rows].astype(int)
+
+        if self.delayed:
+            fired = numpy.zeros(self.size, dtype=int)
+            fired[rows] = counts
+            for steps, fanout in self.delayed:
+                self.queue.post(steps, fanout, fired)
+
+        for counters, indptr, indices in self.vector_targets:
+            targets, weights = gather_rows(indptr, indices, rows, counts)
+            numpy.add.at(counters, targets, weights)
+
+        if self.scalar_targets is not None:
+            for i, n in zip(rows, counts):
+                for counters, port in self.scalar_targets[i]:
+                    counters[port] += int(n)
+
+        for i, n in zip(rows, counts):
+            callbacks = self.callbacks[i]
+            for _ in range(int(n)):
+                for c in callbacks:
+                    c()
+
+
+class EnsembleFanout(LEMSBase):
+    """
+    Connections of one event out port of a runnable simulated as an
+    ensemble of trials.
+
+    Every trial is an independent simulation, so events emitted in a trial
+    are only delivered to the same trial of the connected runnables: the
+    per-trial event counts are added to the counter arrays of the targets.
+    """
+
+    def __init__(self, size):
+        """
+        Constructor.
+
+        :param size: Number of trials.
+        :type size: int
+        """
+
+        self.size = size
+        """ Number of trials.
+
+        :type: int """
+
+        self.links = []
+        """ Connected event in ports, with delays in seconds.
+
+        :type: list((lems.sim.vector.EnsembleRunnable, string, float)) """
+
+        self.callbacks = []
+        """ Other functions called with the per-trial event counts.
+
+        :type: list(callable) """
+
+        self.targets = []
+        """ Counter arrays of the connected ports, built by compile.
+
+        :type: list(numpy.ndarray) """
+
+        self.delayed = []
+        """ Fanouts of the delayed connections with their delays in steps,
+        built by compile.
+
+        :type: list((int, lems.sim.events.EnsembleFanout)) """
+
+        self.queue = None
+        """ Queue holding delayed events.
+
+        :type: lems.sim.events.EventQueue """
+
+        self.compiled = False
+        """ Set if the compiled targets are up to date.
+
+        :type: Boolean """
+
+    def connect(self, target, port, delay=0):
+        """
+        Connects an event in port.
+
+        :param target: Ensemble runnable receiving the events.
+        :type target: lems.sim.vector.EnsembleRunnable
+
+        :param port: Event in port of the target.
+        :type port: string
+
+        :param delay: Delay in seconds before events are delivered.
+        :type delay: float
+        """
+
+        self.links.append((target, port, delay))
+        self.compiled = False
+
+    def has_delays(self):
+        """
+        Checks if any connection has a delay.
+        """
+
+        return any(delay > 0 for target, port, delay in self.links)
+
+    def set_queue(self, queue):
+        """
+        Sets the queue holding delayed events.
+
+        :param queue: Event queue.
+        :type queue: lems.sim.events.EventQueue
+        """
+
+        self.queue = queue
+        self.compiled = False
+
+    def copy(self):
+        """
+        Copies the connections and callbacks.
+
+        :return: New fanout
+        :rtype: lems.sim.events.EnsembleFanout
+        """
+
+        fanout = EnsembleFanout(self.size)
+        fanout.links = list(self.links)
+        fanout.callbacks = self.callbacks
+        return fanout
+
+    def compile(self):
+        """
+        Resolves the counter arrays of the connected ports.
+
+        :raises SimError: Raised if a target is not part of the ensemble.
+        """
+
+        self.targets = []
+        self.delayed = []
+        delayed = {}
+        for target, port, delay in self.links:
+            if delay > 0:
+                steps = get_delay_steps(self.queue, delay)
+                if steps not in delayed:
+                    delayed[steps] = EnsembleFanout(self.size)
+                    self.delayed.append((steps, delayed[steps]))
+                delayed[steps].connect(target, port)
+                continue
+
+            counters = target.event_in_counters[port]
+            if numpy.shape(counters) != (self.size,):
+                raise SimError(
+                    "Event in port '{0}' of '{1}' does not have one counter "
+                    "per trial".format(port, target.id)
+                )
+            self.targets.append(counters)
+
+        self.compiled = True
+
+    def __call__(self, fired=True):
+        """
+        Delivers the events emitted by each trial.
+
+        :param fired: Boolean mask or per-trial event counts. By default,
+        one event is emitted in every trial.
+        :type fired: numpy.ndarray or Boolean
+        """
+
+        if not self.compiled:
+            self.compile()
+
+        # Copied: the counts may be the event counters of the source, which
+        # are cleared once handled, and delayed counts are held in the queue.
+        counts = numpy.array(numpy.broadcast_to(fired, (self.size,)), dtype=int)
+        if not counts.any():
+            return
+
+        for counters in self.targets:
+            counters += counts
+        for steps, fanout in self.delayed:
+            self.queue.post(steps, fanout, counts)
+        for c in self.callbacks:
+            c(counts)
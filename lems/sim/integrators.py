@@ -0,0 +1,202 @@
+"""
+Integration methods for the time derivatives of runnable components.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+from math import expm1
+
+from lems.base.base import LEMSBase
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ButcherTableau(LEMSBase):
+    """
+    Coefficients of an explicit Runge-Kutta method.
+    """
+
+    def __init__(self, a, b, c):
+        """
+        Constructor.
+
+        :param a: Weights of the previous stages in the state of each stage.
+        :type a: list(list(float))
+
+        :param b: Weights of the stages in the final state.
+        :type b: list(float)
+
+        :param c: Time of each stage, as a fraction of the time step.
+        :type c: list(float)
+        """
+
+        self.a = a
+        """ Weights of the previous stages in the state of each stage.
+
+        :type: list(list(float)) """
+
+        self.b = b
+        """ Weights of the stages in the final state.
+
+        :type: list(float) """
+
+        self.c = c
+        """ Time of each stage, as a fraction of the time step.
+
+        :type: list(float) """
+
+
+runge_kutta_tableaus = {
+    "rk2": ButcherTableau([[], [0.5]], [0.0, 1.0], [0.0, 0.5]),
+    "rk4": ButcherTableau(
+        [[], [0.5], [0.0, 0.5], [0.0, 0.0, 1.0]],
+        [1.0 / 6, 1.0 / 3, 1.0 / 3, 1.0 / 6],
+        [0.0, 0.5, 0.5, 1.0],
+    ),
+}
+""" Runge-Kutta methods by name: midpoint (rk2) and classic fourth order
+(rk4). """
+
+integration_methods = ["euler", "expeuler"] + sorted(runge_kutta_tableaus)
+""" Names of the supported integration methods. """
+
+
+def exp_euler_factor(z):
+    """
+    Computes (exp(z) - 1) / z, the factor scaling a forward Euler step into
+    an exponential Euler step for a time derivative a + b * x, where
+    z = b * dt.
+
+    :param z: Linear coefficient times the time step.
+    :type z: float
+
+    :rtype: float
+    """
+
+    if z == 0:
+        return 1.0
+    return expm1(z) / z
+
+
+def vector_exp_euler_factor(z):
+    """
+    Element-wise exp_euler_factor for NumPy arrays.
+    """
+
+    zero = z == 0
+    return numpy.where(zero, 1.0, numpy.expm1(z) / numpy.where(zero, 1.0, z))
+
+
+class RungeKuttaStep(LEMSBase):
+    """
+    Step of a runnable and its descendants integrating their time
+    derivatives together with an explicit Runge-Kutta method.
+
+    At each stage, the derived variables of all runnables are updated,
+    children first, before their time derivatives are evaluated. Derived
+    variables are left at the values of the first stage, as computed at the
+    start of a forward Euler step.
+    """
+
+    def __init__(self, runnables, tableau, dt):
+        """
+        Constructor.
+
+        :param runnables: Runnables integrated together, children first.
+        :type runnables: list(lems.sim.runnable.Runnable)
+
+        :param tableau: Runge-Kutta method.
+        :type tableau: lems.sim.integrators.ButcherTableau
+
+        :param dt: Time step.
+        :type dt: float
+        """
+
+        self.runnables = runnables
+        """ Runnables integrated together, children first.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.tableau = tableau
+        """ Runge-Kutta method.
+
+        :type: lems.sim.integrators.ButcherTableau """
+
+        self.dt = dt
+        """ Time step.
+
+        :type: float """
+
+        self.integrated = [r for r in runnables if r.integrated_variables]
+        """ Runnables with time derivatives.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.derived = [
+            r for r in runnables if getattr(r, "update_derived_variables", None)
+        ]
+        """ Runnables with derived variables.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.shadowed = [r for r in runnables if r.plastic and r.copy_shadow_variables]
+        """ Runnables whose shadow variables are updated.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+    def set_states(self, y0, stages, weights):
+        """
+        Sets the integrated variables to y0 + dt * sum(weights * stages).
+        """
+
+        dt = self.dt
+        for i, r in enumerate(self.integrated):
+            values = y0[i]
+            for k, w in zip(stages, weights):
+                if w:
+                    values = [y + (dt * w) * d for y, d in zip(values, k[i])]
+            for name, value in zip(r.integrated_variables, values):
+                r.__dict__[name] = value
+
+        for r in self.shadowed:
+            r.copy_shadow_variables(r)
+
+    def __call__(self):
+        tableau = self.tableau
+
+        try:
+            times = [r.time_completed for r in self.runnables]
+            y0 = [
+                [r.__dict__[v] for v in r.integrated_variables] for r in self.integrated
+            ]
+
+            stages = []
+            for stage, c in enumerate(tableau.c):
+                if stage > 0:
+                    self.set_states(y0, stages, tableau.a[stage])
+                    for r, t in zip(self.runnables, times):
+                        r.time_completed = t + c * self.dt
+
+                for r in self.derived:
+                    r.update_derived_variables(r)
+                if stage == 0:
+                    derived = [
+                        [r.__dict__[v] for v in r.derived_variables]
+                        for r in self.derived
+                    ]
+
+                stages.append([r.time_derivatives(r) for r in self.integrated])
+
+            for r, t in zip(self.runnables, times):
+                r.time_completed = t
+            for r, values in zip(self.derived, derived):
+                for name, value in zip(r.derived_variables, values):
+                    r.__dict__[name] = value
+
+            self.set_states(y0, stages, tableau.b)
+        except KeyError as e:
+            self.runnables[-1].report_step_error(e)
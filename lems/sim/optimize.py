@@ -0,0 +1,181 @@
+"""
+Helpers optimizing the Python expressions generated from expression trees:
+operator precedences, numeric literals and common subexpressions.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+from math import isfinite
+
+from lems.base.base import LEMSBase
+from lems.parser.expr import ExprNode, ValueNode
+
+python_precedence = {
+    "or": 1,
+    "and": 2,
+    "==": 4,
+    "!=": 4,
+    "<": 4,
+    "<=": 4,
+    ">": 4,
+    ">=": 4,
+    "|": 5,
+    "&": 6,
+    "+": 8,
+    "-": 8,
+    "*": 9,
+    "/": 9,
+    "**": 11,
+}
+""" Precedences of the Python binary operators used in generated
+expressions. """
+
+UNARY_PRECEDENCE = 10
+""" Precedence of unary minus. """
+
+ATOM_PRECEDENCE = 12
+""" Precedence of names, calls, subscripts and parenthesized expressions. """
+
+
+def is_literal(tree_node):
+    """
+    Checks if an expression tree node is a numeric literal.
+
+    :param tree_node: Expression tree node.
+    :type tree_node: lems.parser.expr.ExprNode
+
+    :rtype: Boolean
+    """
+
+    return (
+        tree_node.type == ExprNode.VALUE
+        and not tree_node.value[0].isalpha()
+        and tree_node.value[0] != "_"
+    )
+
+
+def make_literal(value):
+    """
+    Makes a literal node holding a number, if it can be written exactly.
+
+    :param value: Number.
+    :type value: int or float
+
+    :return: Literal node, or None if the value is not a finite number.
+    :rtype: lems.parser.expr.ValueNode
+    """
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, float):
+        if not isfinite(value):
+            return None
+        return ValueNode(repr(float(value)))
+    return ValueNode(repr(int(value)))
+
+
+def get_literal_precedence(literal):
+    """
+    Gets the precedence of a literal: negative numbers are unary minus
+    expressions.
+    """
+
+    return UNARY_PRECEDENCE if literal.startswith("-") else ATOM_PRECEDENCE
+
+
+def format_binary_op(op, left, right):
+    """
+    Formats a binary operation, only parenthesizing operands where Python
+    precedence and associativity require it.
+
+    :param op: Python operator.
+    :type op: string
+
+    :param left: Code and precedence of the left operand.
+    :type left: (string, int)
+
+    :param right: Code and precedence of the right operand.
+    :type right: (string, int)
+
+    :return: Code and precedence of the operation.
+    :rtype: (string, int)
+    """
+
+    precedence = python_precedence[op]
+    (left_code, left_precedence) = left
+    (right_code, right_precedence) = right
+
+    if precedence == python_precedence["=="] or op == "**":
+        # Comparisons would chain; powers are right-associative
+        wrap_left = left_precedence <= precedence
+    else:
+        wrap_left = left_precedence < precedence
+    wrap_right = right_precedence <= precedence
+
+    if wrap_left:
+        left_code = "(" + left_code + ")"
+    if wrap_right:
+        right_code = "(" + right_code + ")"
+    return ("{0} {1} {2}".format(left_code, op, right_code), precedence)
+
+
+def format_negation(operand):
+    """
+    Formats a unary minus.
+
+    :param operand: Code and precedence of the operand.
+    :type operand: (string, int)
+
+    :return: Code and precedence of the negation.
+    :rtype: (string, int)
+    """
+
+    (code, precedence) = operand
+    if precedence <= UNARY_PRECEDENCE:
+        code = "(" + code + ")"
+    return ("-" + code, UNARY_PRECEDENCE)
+
+
+class CommonSubexpressions(LEMSBase):
+    """
+    Subexpressions occurring more than once in the expressions of a
+    generated method. The first evaluation of each is stored in a local
+    variable with an assignment expression, and later occurrences read that
+    variable.
+    """
+
+    def __init__(self, codes):
+        """
+        Constructor.
+
+        :param codes: Code of the common subexpressions.
+        :type codes: set(string)
+        """
+
+        self.codes = codes
+        """ Code of the common subexpressions.
+
+        :type: set(string) """
+
+        self.names = {}
+        """ Local variables holding the subexpressions already evaluated.
+
+        :type: dict(string, string) """
+
+    def reference(self, code):
+        """
+        Gets the code of an occurrence of a subexpression.
+
+        :param code: Code of the subexpression.
+        :type code: string
+
+        :return: Code and precedence of the occurrence.
+        :rtype: (string, int)
+        """
+
+        if code in self.names:
+            return (self.names[code], ATOM_PRECEDENCE)
+        name = "_c{0}".format(len(self.names))
+        self.names[code] = name
+        return ("({0} := {1})".format(name, code), ATOM_PRECEDENCE)
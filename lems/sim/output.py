@@ -0,0 +1,448 @@
+"""
+Writers saving recorded data to files while a simulation runs.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import os
+import struct
+import tempfile
+import zipfile
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimError
+from lems.model.simulation import DataWriter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class OutputWriter(LEMSBase):
+    """
+    Base class for writers streaming the recordings of a data writer to a
+    file in blocks of rows.
+
+    Once written, samples are dropped from the recordings, so at most
+    flush_interval rows are held in memory.
+    """
+
+    def __init__(self, data_output, file_name, columns, flush_interval=1000):
+        """
+        Constructor.
+
+        :param data_output: Data writer whose recordings are to be saved.
+        :type data_output: lems.model.simulation.DataWriter
+
+        :param file_name: Name of the file to be written.
+        :type file_name: string
+
+        :param columns: Paths of the recorded quantities, in column order.
+        :type columns: list(string)
+
+        :param flush_interval: Number of rows buffered before they are
+        written.
+        :type flush_interval: int
+        """
+
+        self.data_output = data_output
+        """ Data writer whose recordings are saved.
+
+        :type: lems.model.simulation.DataWriter """
+
+        self.file_name = file_name
+        """ Name of the file to be written.
+
+        :type: string """
+
+        self.columns = columns
+        """ Paths of the recorded quantities, in column order.
+
+        :type: list(string) """
+
+        self.flush_interval = max(1, flush_interval)
+        """ Number of rows buffered before they are written.
+
+        :type: int """
+
+        self.recordings = []
+        """ All recordings made for the data writer.
+
+        :type: list(lems.sim.recording.Recording) """
+
+        self.column_recordings = []
+        """ Recordings in column order.
+
+        :type: list(lems.sim.recording.Recording) """
+
+        self.rows_written = 0
+        """ Number of rows written so far.
+
+        :type: int """
+
+    def open(self, sim):
+        """
+        Finds the recordings of the data writer and opens the file.
+
+        :param sim: Simulation whose recordings are to be saved.
+        :type sim: lems.sim.sim.Simulation
+
+        :raises SimError: Raised if a column has not been recorded.
+        """
+
+        self.recordings = [
+            recording
+            for recording in sim.get_recordings()
+            if recording.data_output is self.data_output
+        ]
+
+        by_path = {}
+        for recording in self.recordings:
+            by_path[recording.full_path] = recording
+        try:
+            self.column_recordings = [by_path[column] for column in self.columns]
+        except KeyError as e:
+            raise SimError(
+                "No recording of '{0}' for file '{1}'".format(e.args[0], self.file_name)
+            )
+
+        self.rows_written = 0
+        self.open_file()
+
+    def poll(self):
+        """
+        Writes the buffered rows once there are at least flush_interval.
+        """
+
+        if self.recordings and len(self.recordings[0]) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered rows and drops them from the recordings.
+        """
+
+        if not self.recordings:
+            return
+
+        rows = len(self.recordings[0])
+        if rows == 0:
+            return
+
+        self.write_rows(rows)
+        self.rows_written += rows
+
+        time_axes = {}
+        for recording in self.recordings:
+            recording.drop(rows)
+            time_axes[id(recording.time_axis)] = recording.time_axis
+        for time_axis in time_axes.values():
+            time_axis.drop(rows)
+
+    def close(self):
+        """
+        Writes the remaining rows and closes the file.
+        """
+
+        self.flush()
+        self.close_file()
+
+        print(
+            "Saved {0}x{1} data points to file {2}".format(
+                self.rows_written, len(self.columns), self.file_name
+            )
+        )
+
+    def open_file(self):
+        raise NotImplementedError()
+
+    def write_rows(self, rows):
+        """
+        Writes the first buffered rows.
+
+        :param rows: Number of rows to be written.
+        :type rows: int
+        """
+
+        raise NotImplementedError()
+
+    def close_file(self):
+        raise NotImplementedError()
+
+
+class TextOutputWriter(OutputWriter):
+    """
+    Writes whitespace separated columns of text, one row per sample time.
+    """
+
+    def open_file(self):
+        self.file = open(self.file_name, "w")
+
+    def write_rows(self, rows):
+        times = self.recordings[0].get_time_list()
+        columns = [recording.get_value_list() for recording in self.column_recordings]
+
+        lines = []
+        for i in range(rows):
+            line = "{0}   ".format(times[i])
+            for column in columns:
+                line += "{0}   ".format(column[i])
+            lines.append(line + "\n")
+
+        self.file.write("".join(lines))
+
+    def close_file(self):
+        self.file.close()
+
+
+class BinaryOutputWriter(OutputWriter):
+    """
+    Base class for writers saving a two dimensional array of doubles, with
+    one row per sample time holding the time followed by the columns.
+    """
+
+    def open(self, sim):
+        if numpy is None:
+            raise SimError(
+                "NumPy is required to write '{0}' in a binary format".format(
+                    self.file_name
+                )
+            )
+        OutputWriter.open(self, sim)
+
+    def get_block(self, rows):
+        """
+        Returns the first buffered rows as a C ordered array.
+
+        :param rows: Number of rows.
+        :type rows: int
+
+        :return: Array of shape (rows, 1 + number of columns)
+        :rtype: numpy.ndarray
+        """
+
+        block = numpy.empty((rows, 1 + len(self.column_recordings)))
+        block[:, 0] = self.recordings[0].get_times()[:rows]
+        for i, recording in enumerate(self.column_recordings):
+            block[:, i + 1] = recording.get_values()[:rows]
+        return block
+
+
+def npy_header(rows, columns):
+    """
+    Builds a version 1.0 .npy header for a C ordered array of doubles.
+    Headers always take 128 bytes, so that they can be rewritten once the
+    final number of rows is known.
+    """
+
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({0}, {1}), }}".format(
+        rows, columns
+    )
+    header = header.ljust(128 - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode()
+
+
+class NpyOutputWriter(BinaryOutputWriter):
+    """
+    Writes an .npy file which can be memory mapped with
+    numpy.load(file_name, mmap_mode="r"). Rows are appended during the run
+    and the header is completed when the file is closed.
+    """
+
+    def open_file(self):
+        self.file = open(self.get_data_file_name(), "wb")
+        self.file.write(npy_header(0, 1 + len(self.columns)))
+
+    def get_data_file_name(self):
+        """
+        Returns the name of the .npy file the rows are written to.
+        """
+
+        return self.file_name
+
+    def write_rows(self, rows):
+        self.file.write(self.get_block(rows).astype("<f8", copy=False).tobytes())
+
+    def close_file(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.rows_written, 1 + len(self.columns)))
+        self.file.close()
+
+
+class NpzOutputWriter(NpyOutputWriter):
+    """
+    Writes an .npz archive holding the array 'data' (as written by
+    NpyOutputWriter) and the array 'columns' of column names. Rows are
+    written to a temporary .npy file during the run and archived on close.
+    """
+
+    def get_data_file_name(self):
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        fd, self.data_file_name = tempfile.mkstemp(suffix=".npy", dir=directory)
+        os.close(fd)
+        return self.data_file_name
+
+    def close_file(self):
+        NpyOutputWriter.close_file(self)
+
+        columns = numpy.array(["t"] + list(self.columns))
+        try:
+            with zipfile.ZipFile(self.file_name, "w", allowZip64=True) as archive:
+                archive.write(self.data_file_name, "data.npy")
+                with archive.open("columns.npy", "w") as f:
+                    numpy.lib.format.write_array(f, columns)
+        finally:
+            os.remove(self.data_file_name)
+
+
+class HDF5OutputWriter(BinaryOutputWriter):
+    """
+    Writes an HDF5 file with a chunked, resizable dataset 'data', whose
+    'columns' attribute holds the column names. Requires h5py.
+    """
+
+    def open_file(self):
+        if h5py is None:
+            raise SimError(
+                "h5py is required to write '{0}' in HDF5 format".format(self.file_name)
+            )
+
+        self.file = h5py.File(self.file_name, "w")
+        self.dataset = self.file.create_dataset(
+            "data",
+            shape=(0, 1 + len(self.columns)),
+            maxshape=(None, 1 + len(self.columns)),
+            chunks=(self.flush_interval, 1 + len(self.columns)),
+            dtype="f8",
+        )
+        self.dataset.attrs["columns"] = ["t"] + list(self.columns)
+
+    def write_rows(self, rows):
+        self.dataset.resize(self.rows_written + rows, axis=0)
+        self.dataset[self.rows_written : self.rows_written + rows] = self.get_block(
+            rows
+        )
+
+    def close_file(self):
+        self.file.close()
+
+
+output_formats = {
+    "text": TextOutputWriter,
+    "npy": NpyOutputWriter,
+    "npz": NpzOutputWriter,
+    "hdf5": HDF5OutputWriter,
+}
+""" Output writers by format name. """
+
+output_extensions = {
+    ".npy": "npy",
+    ".npz": "npz",
+    ".h5": "hdf5",
+    ".hdf5": "hdf5",
+}
+""" Formats chosen by file name extension. """
+
+format_extensions = {"npy": ".npy", "npz": ".npz", "hdf5": ".h5"}
+""" Extensions given to files written in a binary format. """
+
+
+def get_output_format(file_name, format=None):
+    """
+    Chooses the format and file name of an output file.
+
+    :param file_name: File name given in the model.
+    :type file_name: string
+
+    :param format: Format to be used for all output files, or None to
+    choose the format from the extension of the file name (text if it is not
+    a binary format extension). The extension is changed to match a binary
+    format.
+    :type format: string
+
+    :return: Format and file name.
+    :rtype: (string, string)
+
+    :raises SimError: Raised if the format is not known.
+    """
+
+    extension = os.path.splitext(file_name)[1].lower()
+    if format is None:
+        return (output_extensions.get(extension, "text"), file_name)
+
+    if format not in output_formats:
+        raise SimError("Unknown output format '{0}'".format(format))
+
+    if format != "text" and output_extensions.get(extension) != format:
+        file_name = os.path.splitext(file_name)[0] + format_extensions[format]
+
+    return (format, file_name)
+
+
+def get_output_files(model):
+    """
+    Lists the output files of the simulation targeted by a model.
+
+    :param model: Model containing the simulation specification.
+    :type model: lems.model.model.Model
+
+    :return: List of (file name, column paths) for each OutputFile.
+    :rtype: list((string, list(string)))
+    """
+
+    output_files = []
+
+    simulation = model.components[model.targets[0]]
+    for c in simulation.children:
+        if c.type == "OutputFile":
+            columns = [f.parameters["quantity"] for f in c.children]
+            output_files.append((c.parameters["fileName"], columns))
+
+    return output_files
+
+
+def create_output_writers(sim, model, flush_interval=1000, format=None):
+    """
+    Creates a streaming writer for each output file of a simulation and adds
+    it to the simulation.
+
+    :param sim: Simulation built from the model.
+    :type sim: lems.sim.sim.Simulation
+
+    :param model: Model containing the simulation specification.
+    :type model: lems.model.model.Model
+
+    :param flush_interval: Number of rows buffered before they are written.
+    :type flush_interval: int
+
+    :param format: Format used for all files (see output_formats). By
+    default the format is chosen from the extension of each file name.
+    :type format: string
+
+    :return: List of the writers created.
+    :rtype: list(lems.sim.output.OutputWriter)
+    """
+
+    data_writers = {}
+    for recording in sim.get_recordings():
+        if isinstance(recording.data_output, DataWriter):
+            data_writers[recording.data_output.file_name] = recording.data_output
+
+    writers = []
+    for file_name, columns in get_output_files(model):
+        if file_name in data_writers:
+            file_format, out_file_name = get_output_format(file_name, format)
+            writer = output_formats[file_format](
+                data_writers[file_name], out_file_name, columns, flush_interval
+            )
+            sim.add_output_writer(writer)
+            writers.append(writer)
+
+    return writers
@@ -0,0 +1,693 @@
+"""
+Partitioned simulations: the runnables of one simulation divided between
+worker processes or nodes, which step their parts independently and
+exchange the events crossing parts in batches (see lems.sim.comm).
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import multiprocessing
+import traceback
+from collections import defaultdict
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimError
+from lems.sim.build import SimulationBuilder
+from lems.sim.comm import PipeCommunicator, receive, route
+from lems.sim.events import EventFanout, EventQueue, PopulationFanout
+from lems.sim.prune import get_runnable, remove_child
+from lems.sim.runnable import Runnable, get_reduction_reference
+from lems.sim.vector import VectorRunnable
+
+
+def has_dynamics(runnable):
+    """
+    Checks if a runnable does any work of its own when it is stepped.
+
+    :rtype: Boolean
+    """
+
+    component = runnable.component
+    return component is not None and component.dynamics.has_content()
+
+
+def get_weight(runnable):
+    """
+    Gets the number of components with dynamics simulated by a runnable and
+    its descendants, counting each member of a vectorized population.
+
+    :rtype: int
+    """
+
+    weight = 0
+    for r in runnable.iter_subtree():
+        if has_dynamics(r):
+            weight += r.size if isinstance(r, VectorRunnable) else 1
+    return weight
+
+
+def get_runs(sim):
+    """
+    Lists the top level runnables run by the <Run> statements of the
+    simulation components of a simulation.
+
+    :rtype: list(lems.sim.runnable.Runnable)
+    """
+
+    return [r for r in sorted(sim.runnables.values()) if r.time_step > 0]
+
+
+def assign_parts(weights, size):
+    """
+    Divides a sequence of weighted items into consecutive, non-empty parts
+    of similar total weight.
+
+    :param weights: Weight of each item.
+    :type weights: list(int)
+
+    :param size: Number of parts, at most the number of items.
+    :type size: int
+
+    :return: Part of each item.
+    :rtype: list(int)
+    """
+
+    total = float(sum(weights))
+    parts = []
+    part = 0
+    weight = 0
+    for i, w in enumerate(weights):
+        target = int((weight + w / 2.0) * size / total)
+        target = min(target, part + 1 if parts else 0, size - 1)
+        # Leave at least one item for each of the remaining parts
+        target = max(target, part, size - (len(weights) - i))
+        parts.append(target)
+        part = target
+        weight += w
+    return parts
+
+
+class UnitGroups(LEMSBase):
+    """
+    Disjoint sets of units, merged with union by size.
+    """
+
+    def __init__(self, count):
+        self.parents = list(range(count))
+        self.sizes = [1] * count
+
+    def find(self, i):
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def merge(self, i, j):
+        (i, j) = (self.find(i), self.find(j))
+        if i == j:
+            return
+        if self.sizes[i] < self.sizes[j]:
+            (i, j) = (j, i)
+        self.parents[j] = i
+        self.sizes[i] += self.sizes[j]
+
+
+class EventOutbox(LEMSBase):
+    """
+    Stands in for the event in ports of the runnables simulated by other
+    parts. Connections to them are replaced by connections to the outbox,
+    which counts the events sent to each destination during a step.
+    """
+
+    vectorized = False
+
+    def __init__(self):
+        self.event_in_counters = defaultdict(int)
+        """ Number of events sent to each destination since the counters
+        were last emptied.
+
+        :type: dict(int, int) """
+
+
+class Partition(LEMSBase):
+    """
+    Division of the runnables of a built simulation into parts, each to be
+    simulated by one process (see run_part).
+
+    Units of work are the runnables with dynamics nearest to the roots of
+    the simulation, such as the members of populations, and are assigned
+    to the parts as consecutive slices in the order they are stepped.
+    Runnables without dynamics above them, such as networks and
+    populations, are kept in every part.
+
+    Units exchanging zero-delay events in the order they are stepped, or
+    reading the variables of each other through select/reduce derived
+    variables, are kept in the same part. Other events crossing parts are
+    exchanged once every sync_steps steps of the event queue, which is
+    never more than their delays, so results are the same as those of the
+    whole simulation run in one process, unless random numbers are drawn
+    while it runs.
+    """
+
+    def __init__(self, sim, processes, independent=False):
+        """
+        Constructor.
+
+        :param sim: Built simulation, which has not been run.
+        :type sim: lems.sim.sim.Simulation
+
+        :param processes: Maximum number of parts.
+        :type processes: int
+
+        :param independent: Keep all units exchanging events, and the
+        components run by a simulation component with that component, in
+        the same part, so that parts run without exchanging events, such as
+        the independent runs of several simulation components.
+        :type independent: Boolean
+        """
+
+        self.sim = sim
+        """ Partitioned simulation.
+
+        :type: lems.sim.sim.Simulation """
+
+        self.independent = independent
+        """ True if units exchanging events are kept in the same part.
+
+        :type: Boolean """
+
+        self.units = []
+        """ Units of work, in the order they are stepped.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.roots = []
+        """ Top level runnable of each unit.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        for root in sorted(sim.runnables.values()):
+            self.find_units(root, root)
+
+        self.unit_indices = {}
+        """ Index of the unit of each runnable below the units, by uid.
+
+        :type: dict(int, int) """
+
+        for i, unit in enumerate(self.units):
+            for r in unit.iter_subtree():
+                self.unit_indices[r.uid] = i
+
+        time_steps = [r.time_step for r in sim.runnables.values() if r.time_step > 0]
+        self.queue = EventQueue()
+        """ Event queue with the time step of the event queue of the
+        simulation, used to convert delays into steps.
+
+        :type: lems.sim.events.EventQueue """
+
+        self.queue.reset(min(time_steps) if time_steps else 0)
+
+        self.links = self.find_links()
+        """ Event connections between units, as (source unit, fanout, member
+        index, link index, target unit, target, port, delay).
+
+        :type: list((int, *, int, int, int, lems.sim.runnable.Runnable,
+        string, float)) """
+
+        groups = self.group_units()
+        if self.queue.time_step <= 0:
+            # Runnables without time steps are stepped once.
+            processes = 1
+        self.size = max(1, min(processes, len(groups)))
+        """ Number of parts.
+
+        :type: int """
+
+        self.owners = [0] * len(self.units)
+        """ Part of each unit.
+
+        :type: list(int) """
+
+        if self.units:
+            weights = [sum(get_weight(self.units[i]) for i in g) for g in groups]
+            for group, part in zip(groups, assign_parts(weights, self.size)):
+                for i in group:
+                    self.owners[i] = part
+
+        self.destinations = []
+        """ Event in ports receiving events from other parts, as (part,
+        target, port, delay in steps).
+
+        :type: list((int, lems.sim.runnable.Runnable, string, int)) """
+
+        self.exports = []
+        """ Event connections to other parts, as (source part, fanout,
+        member index, link index, destination).
+
+        :type: list((int, *, int, int, int)) """
+
+        self.sync_steps = None
+        """ Number of event queue steps between exchanges of events, or None
+        if no events cross parts.
+
+        :type: int """
+
+        self.find_exports()
+
+    def find_units(self, runnable, root):
+        if has_dynamics(runnable):
+            self.units.append(runnable)
+            self.roots.append(root)
+            return
+        for child in runnable.uchildren.values():
+            self.find_units(child, root)
+        for child in runnable.array:
+            if isinstance(child, Runnable):
+                self.find_units(child, root)
+
+    def get_unit(self, runnable):
+        """
+        Gets the index of the unit of a runnable or member of a vectorized
+        population, or None for runnables kept in every part.
+        """
+
+        return self.unit_indices.get(get_runnable(runnable).uid)
+
+    def find_links(self):
+        links = []
+        fanouts = set()
+        for (i, unit) in enumerate(self.units):
+            for r in unit.iter_subtree():
+                for port in r.event_out_ports:
+                    fanout = r.event_out_fanouts[port]
+                    if id(fanout) in fanouts:
+                        continue
+                    fanouts.add(id(fanout))
+
+                    if isinstance(fanout, PopulationFanout):
+                        members = enumerate(fanout.links)
+                    elif isinstance(fanout, EventFanout):
+                        members = [(None, fanout.links)]
+                    else:
+                        raise SimError(
+                            "Unable to partition the events of '{0}'".format(r.id)
+                        )
+                    for (member, member_links) in members:
+                        for (k, (target, port, delay)) in enumerate(member_links):
+                            j = self.get_unit(target)
+                            if j is not None and j != i:
+                                links.append(
+                                    (i, fanout, member, k, j, target, port, delay)
+                                )
+        return links
+
+    def group_units(self):
+        """
+        Groups the units which must be simulated by the same part.
+
+        :return: Groups of unit indices, in the order of their first unit.
+        :rtype: list(list(int))
+        """
+
+        groups = UnitGroups(len(self.units))
+        for (i, fanout, member, k, j, target, port, delay) in self.links:
+            if self.independent:
+                groups.merge(i, j)
+                continue
+            if delay > 0:
+                continue
+            # Events sent to units stepped earlier are only handled in the
+            # next step, like delayed events.
+            if self.roots[i] is not self.roots[j] or j > i:
+                groups.merge(i, j)
+
+        if self.independent:
+            for (i, unit) in enumerate(self.units):
+                # The components run by a simulation component are its
+                # children, but top level runnables.
+                parent = unit.parent
+                while parent is not None:
+                    j = self.get_unit(parent)
+                    if j is not None:
+                        groups.merge(i, j)
+                        break
+                    parent = parent.parent
+
+        for (i, unit) in enumerate(self.units):
+            for r in unit.iter_subtree():
+                for name in r.reductions:
+                    reduction = r.__dict__.get(get_reduction_reference(name))
+                    if reduction is None:
+                        continue
+                    members = list(reduction.members)
+                    members += [p for (p, indices) in reduction.populations]
+                    for member in members:
+                        j = self.get_unit(member)
+                        if j is not None:
+                            groups.merge(i, j)
+
+        members = {}
+        for i in range(len(self.units)):
+            members.setdefault(groups.find(i), []).append(i)
+        return list(members.values())
+
+    def find_exports(self):
+        keys = {}
+        for (i, fanout, member, k, j, target, port, delay) in self.links:
+            if self.owners[i] == self.owners[j]:
+                continue
+
+            steps = self.queue.get_delay_steps(delay) if delay > 0 else 1
+
+            key = (id(target), port, steps)
+            if key not in keys:
+                keys[key] = len(self.destinations)
+                self.destinations.append((self.owners[j], target, port, steps))
+            self.exports.append((self.owners[i], fanout, member, k, keys[key]))
+
+            if self.sync_steps is None or steps < self.sync_steps:
+                self.sync_steps = steps
+
+    def get_recordings(self, part):
+        """
+        Lists the recordings made by a part, with their indices in the
+        recordings of the whole simulation. Recordings of the runnables kept
+        in every part are made by the first part.
+
+        :return: List of (index, recording).
+        :rtype: list((int, lems.sim.recording.Recording))
+        """
+
+        recordings = []
+        index = 0
+        for runnable in self.sim.iter_runnables():
+            unit = self.get_unit(runnable)
+            owner = self.owners[unit] if unit is not None else 0
+            for recording in runnable.recorded_variables:
+                if owner == part:
+                    recordings.append((index, recording))
+                index += 1
+        return recordings
+
+    def run_part(self, part, communicator):
+        """
+        Runs the units of one part of the simulation, exchanging events with
+        the other parts. The other units are removed from the simulation.
+
+        :param part: Index of the part.
+        :type part: int
+
+        :param communicator: Exchanges events with the other parts.
+        :type communicator: lems.sim.comm.Communicator
+
+        :return: Sample times and values of the recordings made by the part,
+        by index in the recordings of the whole simulation.
+        :rtype: dict(int, (list(Number), list(Number)))
+        """
+
+        sim = self.sim
+        recordings = self.get_recordings(part)
+
+        outbox = EventOutbox()
+        for (owner, fanout, member, k, destination) in self.exports:
+            if owner != part:
+                continue
+            links = fanout.links if member is None else fanout.links[member]
+            links[k] = (outbox, destination, 0)
+            fanout.compiled = False
+
+        removed = set()
+        for (unit, owner) in zip(self.units, self.owners):
+            if owner == part:
+                continue
+            if unit.parent is None:
+                removed.add(unit.uid)
+            else:
+                remove_child(unit.parent, unit)
+
+        sim.init_run()
+        groups = []
+        for group in sim.rate_groups:
+            group.runnables = [r for r in group.runnables if r.uid not in removed]
+            if group.runnables:
+                groups.append(group)
+        sim.set_schedule(groups)
+
+        queue = sim.event_queue
+        if self.sync_steps is not None:
+            queue.active = True
+
+        counters = outbox.event_in_counters
+        fanouts = {}
+        window = 0
+        while True:
+            limit = None
+            if self.sync_steps is not None:
+                limit = (window + 1) * self.sync_steps
+
+            batches = [[] for i in range(self.size)]
+            tick = sim.get_next_tick()
+            while tick is not None:
+                if limit is not None:
+                    time = float(tick * sim.tick_base)
+                    if int(round(time / queue.time_step)) >= limit:
+                        break
+                sim.step()
+                if counters:
+                    for (destination, count) in counters.items():
+                        owner = self.destinations[destination][0]
+                        batches[owner].append((queue.step, destination, count))
+                    counters.clear()
+                tick = sim.get_next_tick()
+
+            (events, done) = communicator.exchange(batches, tick is None)
+            for (step, destination, count) in events:
+                (owner, target, port, steps) = self.destinations[destination]
+                if destination not in fanouts:
+                    fanouts[destination] = EventFanout()
+                    fanouts[destination].connect(target, port)
+                queue.post_at(step + steps, fanouts[destination], count)
+            if done:
+                break
+            window += 1
+
+        return dict(
+            (index, (recording.get_time_list(), recording.get_value_list()))
+            for (index, recording) in recordings
+        )
+
+
+def run_shard(model, communicator, sim=None, options=None, independent=False):
+    """
+    Builds a simulation from a resolved model and runs one of its parts
+    (see Partition), exchanging events through a communicator.
+
+    Every part must be run with the same model and options, so that all
+    parts divide the simulation in the same way. The recordings of all
+    parts are collected by the first part, which adds them to the
+    recordings of the given simulation and saves them with its output
+    writers.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param communicator: Exchanges events with the other parts.
+    :type communicator: lems.sim.comm.Communicator
+
+    :param sim: Simulation built from the model with the same options, to
+    hold the recordings in the first part. Built if not given.
+    :type sim: lems.sim.sim.Simulation
+
+    :param options: Keyword arguments of the simulation builder, such as
+    vectorize or integrator (see lems.sim.build.SimulationBuilder).
+    :type options: dict
+
+    :param independent: Only divide the simulation into groups of
+    runnables which exchange no events, see Partition.
+    :type independent: Boolean
+
+    :return: Simulation holding the recordings in the first part, None in
+    the others.
+    :rtype: lems.sim.sim.Simulation
+
+    :raises SimError: Raised if the simulation cannot be divided into the
+    parts of the communicator, or if a part fails.
+    """
+
+    try:
+        shard = SimulationBuilder(model, **(options or {})).build()
+        partition = Partition(shard, communicator.size, independent)
+        if partition.size != communicator.size:
+            raise SimError(
+                "The simulation cannot be divided into {0} parts".format(
+                    communicator.size
+                )
+            )
+        result = partition.run_part(communicator.part, communicator)
+    except Exception:
+        communicator.fail(traceback.format_exc())
+        raise
+
+    results = communicator.gather(result)
+    if results is None:
+        return None
+
+    if sim is None:
+        sim = SimulationBuilder(model, **(options or {})).build()
+    save_results(sim, results)
+    return sim
+
+
+def save_results(sim, results):
+    """
+    Adds the recordings made by the parts of a partitioned simulation to
+    the recordings of the whole simulation, and saves them with its output
+    writers.
+
+    :param sim: Simulation holding the recordings.
+    :type sim: lems.sim.sim.Simulation
+
+    :param results: Recordings of each part, see Partition.run_part.
+    :type results: list(dict(int, (list(Number), list(Number))))
+    """
+
+    recordings = sim.get_recordings()
+    sim.init_recordings()
+    for result in results:
+        for (index, (times, values)) in result.items():
+            recording = recordings[index]
+            for (time, value) in zip(times, values):
+                recording.add_value(time, value)
+
+    for writer in sim.output_writers:
+        writer.open(sim)
+        writer.close()
+
+
+def run_worker(model, part, size, connection, options, independent):
+    """
+    Builds and runs one part of a partitioned simulation in a worker
+    process, and sends its recordings through the pipe.
+    """
+
+    communicator = PipeCommunicator(part, size, connection)
+    try:
+        run_shard(model, communicator, options=options, independent=independent)
+    except Exception:
+        # Already sent to the process which started the parts.
+        pass
+    finally:
+        communicator.close()
+
+
+def route_events(connections):
+    """
+    Passes the events exchanged by the parts of a partitioned simulation
+    between their pipes, until all parts have completed.
+
+    :param connections: Pipes to the parts, in order.
+    :type connections: list(multiprocessing.connection.Connection)
+
+    :return: Recordings of each part, see Partition.run_part.
+    :rtype: list(dict(int, (list(Number), list(Number))))
+
+    :raises SimError: Raised if a part fails.
+    """
+
+    while True:
+        messages = [
+            receive(connection, part) for (part, connection) in enumerate(connections)
+        ]
+        if all(message[0] == "result" for message in messages):
+            return [message[1] for message in messages]
+
+        replies = route([message[1:] for message in messages])
+        for (connection, reply) in zip(connections, replies):
+            connection.send(reply)
+
+
+def run_partitioned(model, sim=None, processes=None, options=None, independent=False):
+    """
+    Runs a simulation divided between worker processes (see Partition).
+
+    Each worker builds the simulation from the resolved model and runs its
+    part. The recordings of all parts are then added to the recordings of
+    the given simulation, which is not run itself, and saved by its output
+    writers.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param sim: Simulation built from the model with the same options, to
+    hold the recordings. Built if not given.
+    :type sim: lems.sim.sim.Simulation
+
+    :param processes: Number of worker processes. Defaults to the number of
+    CPUs. If the simulation cannot be divided, it is run in the calling
+    process.
+    :type processes: int
+
+    :param options: Keyword arguments of the simulation builder, such as
+    vectorize or integrator (see lems.sim.build.SimulationBuilder).
+    :type options: dict
+
+    :param independent: Only divide the simulation into groups of
+    runnables which exchange no events, such as independent runs, which
+    then run without waiting for each other.
+    :type independent: Boolean
+
+    :return: Simulation holding the recordings.
+    :rtype: lems.sim.sim.Simulation
+
+    :raises SimError: Raised if a part fails.
+    """
+
+    if sim is None:
+        sim = SimulationBuilder(model, **(options or {})).build()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    size = Partition(sim, processes, independent).size
+    if size == 1:
+        sim.run()
+        return sim
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+
+    connections = []
+    workers = []
+    try:
+        for part in range(size):
+            (connection, worker_connection) = context.Pipe()
+            worker = context.Process(
+                target=run_worker,
+                args=(
+                    model,
+                    part,
+                    size,
+                    worker_connection,
+                    options,
+                    independent,
+                ),
+            )
+            worker.start()
+            worker_connection.close()
+            connections.append(connection)
+            workers.append(worker)
+
+        results = route_events(connections)
+    except BaseException:
+        # Also stop the workers on KeyboardInterrupt
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+    save_results(sim, results)
+    return sim
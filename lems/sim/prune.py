@@ -0,0 +1,231 @@
+"""
+Removal of the runnables of a simulation that cannot affect its outputs.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+from lems.base.base import LEMSBase
+from lems.sim.vector import InstanceView
+from lems.sim.events import PopulationFanout
+from lems.sim.demand import find_derived_variable, resolve_select
+
+
+class PruningReport(LEMSBase):
+    """
+    Runnables and connections removed from a simulation by
+    prune_simulation.
+    """
+
+    def __init__(self):
+        self.runnables = []
+        """ Paths of the removed runnables.
+
+        :type: list(string) """
+
+        self.event_connections = 0
+        """ Number of removed event connections.
+
+        :type: int """
+
+        self.derived_variables = 0
+        """ Number of derived variables no longer computed in the remaining
+        runnables.
+
+        :type: int """
+
+    def __str__(self):
+        lines = [
+            "Pruned {0} runnables, {1} event connections and {2} derived "
+            "variables".format(
+                len(self.runnables), self.event_connections, self.derived_variables
+            )
+        ]
+        for path in self.runnables:
+            lines.append("  " + path)
+        return "\n".join(lines)
+
+
+def get_runnable_path(runnable):
+    """
+    Gets the path of a runnable from the root of the simulation, such as
+    "sim1.net1.p2".
+
+    :rtype: string
+    """
+
+    r = runnable
+    path = r.id
+    while r.parent:
+        r = r.parent
+        path = "{0}.{1}".format(r.id, path)
+    return path
+
+
+def get_runnable(target):
+    """
+    Gets the runnable holding the variables of an event target: the target
+    itself, or its population for members of vectorized populations.
+    """
+
+    if isinstance(target, InstanceView):
+        return target.population
+    return target
+
+
+def get_fanout_links(fanout):
+    """
+    Lists the (target, port, delay) connections of an event out port.
+    """
+
+    if isinstance(fanout, PopulationFanout):
+        return [link for links in fanout.links for link in links]
+    return fanout.links
+
+
+def has_callbacks(fanout):
+    """
+    Checks if functions are called for the events of an event out port.
+    """
+
+    if isinstance(fanout, PopulationFanout):
+        return any(fanout.callbacks)
+    return bool(fanout.callbacks)
+
+
+def find_live_runnables(roots, needed):
+    """
+    Finds the runnables which can affect the outputs of a simulation.
+
+    The roots and the runnables holding recordings or with functions called
+    for their events are live. Ancestors of live runnables are live, as
+    are the runnables whose variables are selected by the needed derived
+    variables of live runnables and the sources of the events they receive.
+
+    :param roots: Top-level runnables of the simulation.
+    :type roots: list(lems.sim.runnable.Runnable)
+
+    :param needed: Names of the needed derived variables by runnable uid,
+    see lems.sim.demand.find_needed_derived_variables.
+    :type needed: dict(int, set(string))
+
+    :return: Uids of the live runnables.
+    :rtype: set(int)
+    """
+
+    runnables = []
+    for root in roots:
+        runnables += root.iter_subtree()
+
+    sources = {}
+    for runnable in runnables:
+        for fanout in runnable.event_out_fanouts.values():
+            for target, port, delay in get_fanout_links(fanout):
+                uid = get_runnable(target).uid
+                sources.setdefault(uid, []).append(runnable)
+
+    live = set()
+    pending = []
+
+    def keep(runnable):
+        while runnable is not None and runnable.uid not in live:
+            live.add(runnable.uid)
+            pending.append(runnable)
+            runnable = runnable.parent
+
+    for runnable in roots:
+        keep(runnable)
+    for runnable in runnables:
+        if runnable.recorded_variables or getattr(runnable, "recorders", None):
+            keep(runnable)
+        elif any(has_callbacks(f) for f in runnable.event_out_fanouts.values()):
+            keep(runnable)
+
+    while pending:
+        runnable = pending.pop()
+        for source in sources.get(runnable.uid, []):
+            keep(source)
+
+        if runnable.component is None:
+            continue
+        for name in needed.get(runnable.uid, []):
+            dv = find_derived_variable(runnable.component.dynamics, name)
+            if dv is not None and getattr(dv, "select", None):
+                for target, variable in resolve_select(runnable, dv.select):
+                    keep(target)
+
+    return live
+
+
+def remove_child(parent, child):
+    """
+    Removes a child runnable, or the members of a vectorized population,
+    from the children, array, groups and attachments of its parent.
+    """
+
+    # Empty containers of compacted runnables are shared read-only defaults
+    if child.uid in parent.uchildren:
+        del parent.uchildren[child.uid]
+    for key in [k for k, c in parent.children.items() if c is child]:
+        del parent.children[key]
+
+    members = [child] + list(getattr(child, "views", []))
+    parent.array = [c for c in parent.array if not any(c is m for m in members)]
+
+    for name in list(parent.groups) + list(parent.attachments.values()):
+        group = parent.__dict__.get(name)
+        if isinstance(group, list):
+            parent.__dict__[name] = [c for c in group if c is not child]
+
+
+def prune_simulation(sim, needed):
+    """
+    Removes the runnables of a built simulation which cannot affect its
+    outputs (see find_live_runnables), and the event connections to them.
+
+    :param sim: Simulation.
+    :type sim: lems.sim.sim.Simulation
+
+    :param needed: Names of the needed derived variables by runnable uid,
+    see lems.sim.demand.find_needed_derived_variables.
+    :type needed: dict(int, set(string))
+
+    :return: Removed runnables and connections.
+    :rtype: lems.sim.prune.PruningReport
+    """
+
+    report = PruningReport()
+
+    roots = list(sim.runnables.values())
+    live = find_live_runnables(roots, needed)
+
+    runnables = []
+    for root in roots:
+        runnables += root.iter_subtree()
+
+    for runnable in runnables:
+        if runnable.uid in live:
+            continue
+        if runnable.parent.uid in live:
+            report.runnables.append(get_runnable_path(runnable))
+            remove_child(runnable.parent, runnable)
+
+    for runnable in runnables:
+        if runnable.uid not in live:
+            continue
+        for fanout in runnable.event_out_fanouts.values():
+            before = len(get_fanout_links(fanout))
+            if isinstance(fanout, PopulationFanout):
+                fanout.links = [
+                    [l for l in links if get_runnable(l[0]).uid in live]
+                    for links in fanout.links
+                ]
+            else:
+                fanout.links = [
+                    l for l in fanout.links if get_runnable(l[0]).uid in live
+                ]
+            fanout.compiled = False
+            report.event_connections += before - len(get_fanout_links(fanout))
+
+    report.runnables.sort()
+    return report
@@ -5,14 +5,151 @@ Recording class(es).
 :organization: LEMS (https://github.com/organizations/LEMS)
 """
 
+from array import array
+
 from lems.base.base import LEMSBase
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def allocate(size):
+    """
+    Allocates a zero filled buffer of doubles.
+
+    :param size: Number of elements.
+    :type size: int
+
+    :return: Buffer of doubles.
+    :rtype: array.array
+    """
+
+    return array("d", bytes(8 * size))
+
+
+def exact_list(buffer, exact, length):
+    """
+    Returns the first elements of a buffer as a list, replacing the samples
+    which were not recorded as floats with their exact values.
+    """
+
+    values = buffer[:length].tolist()
+    for i in exact:
+        if i < length:
+            values[i] = exact[i]
+    return values
+
+
+def drop_samples(buffer, exact, length, count):
+    """
+    Moves the samples following the first count samples of a buffer to its
+    start.
+
+    :return: Updated table of exact samples.
+    :rtype: dict(int, Number)
+    """
+
+    buffer[: length - count] = buffer[count:length]
+    return dict((i - count, v) for i, v in exact.items() if i >= count)
+
+
+def buffer_view(buffer, length):
+    """
+    Returns a zero-copy view of the first elements of a buffer: a NumPy
+    array if NumPy is installed, otherwise a memoryview.
+    """
+
+    if numpy is not None:
+        return numpy.frombuffer(buffer, dtype=float, count=length)
+    else:
+        return memoryview(buffer)[:length]
+
+
+class TimeAxis(LEMSBase):
+    """
+    Stores the sample times of one or more recordings made in lockstep,
+    typically all recordings of a data output.
+    """
+
+    chunk_size = 4096
+    """ Minimum number of samples added when a buffer is full. """
+
+    def __init__(self, capacity=0):
+        self.data = allocate(capacity)
+        """ Preallocated sample buffer, of which the first length entries
+        are used.
+
+        :type: array.array """
+
+        self.length = 0
+        """ Number of samples.
+
+        :type: int """
+
+        self.exact = {}
+        """ Samples which are not floats (such as the initial integer time),
+        by index, so that they can be written out exactly as given.
+
+        :type: dict(int, Number) """
+
+    def __len__(self):
+        return self.length
+
+    def add_time(self, time):
+        n = self.length
+        if n == len(self.data):
+            # Buffers are replaced rather than resized so that existing
+            # views stay valid.
+            self.data = self.data + allocate(max(self.chunk_size, n))
+        self.data[n] = time
+        if time.__class__ is not float:
+            self.exact[n] = time
+        self.length = n + 1
+
+    def drop(self, count):
+        """
+        Discards the first samples, for instance once they have been saved.
+
+        :param count: Number of samples to be discarded.
+        :type count: int
+        """
+
+        self.exact = drop_samples(self.data, self.exact, self.length, count)
+        self.length -= count
+
+    def get_times(self):
+        """
+        Returns a zero-copy view of the sample times.
+        """
+
+        return buffer_view(self.data, self.length)
+
+    def get_time_list(self, length=None):
+        """
+        Returns the sample times as a list, with samples which are not floats
+        as given.
+        """
+
+        return exact_list(
+            self.data, self.exact, self.length if length is None else length
+        )
+
 
 class Recording(LEMSBase):
     """
     Stores details of a variable recording across a single simulation run.
+
+    Values are stored in a preallocated buffer of doubles, which grows in
+    chunks if more values are recorded than expected. Sample times are kept
+    in a lems.sim.recording.TimeAxis which may be shared by the recordings
+    of a data output.
     """
 
+    chunk_size = 4096
+    """ Minimum number of samples added when a buffer is full. """
+
     def __init__(self, variable, full_path, data_output, recorder):
         self.variable = variable
 
@@ -22,15 +159,218 @@ class Recording(LEMSBase):
 
         self.recorder = recorder
 
-        self.values = []
+        self.time_axis = TimeAxis()
+        """ Sample times.
+
+        :type: lems.sim.recording.TimeAxis """
+
+        self.data = allocate(0)
+        """ Preallocated value buffer, of which the first length entries are
+        used.
+
+        :type: array.array """
+
+        self.length = 0
+        """ Number of recorded values.
+
+        :type: int """
+
+        self.exact = {}
+        """ Values which are not floats (such as integers), by index, so
+        that they can be written out exactly as recorded.
+
+        :type: dict(int, Number) """
 
     def __str__(self):
         return "Recording: {0} ({1}), {2}, size: {3}".format(
-            self.variable, self.full_path, self.recorder, len(self.values)
+            self.variable, self.full_path, self.recorder, self.length
         )
 
     def __repr__(self):
         return self.__str__()
 
+    def __len__(self):
+        return self.length
+
+    def reserve(self, capacity, time_axis=None):
+        """
+        Preallocates the buffers of an empty recording.
+
+        :param capacity: Expected number of samples.
+        :type capacity: int
+
+        :param time_axis: Time axis shared with other recordings made in
+        lockstep with this one. A new one is created if not given.
+        :type time_axis: lems.sim.recording.TimeAxis
+        """
+
+        if self.length:
+            return
+
+        self.data = allocate(capacity)
+        if time_axis is None:
+            time_axis = TimeAxis(capacity)
+        self.time_axis = time_axis
+
+    def add_value(self, time, value):
+        n = self.length
+        if n == len(self.data):
+            self.data = self.data + allocate(max(self.chunk_size, n))
+        self.data[n] = value
+        if value.__class__ is not float:
+            self.exact[n] = value
+        self.length = n + 1
+
+        # The first recording sampled on a shared axis records the time.
+        time_axis = self.time_axis
+        if n == time_axis.length:
+            time_axis.add_time(time)
+
+    def drop(self, count):
+        """
+        Discards the first values, for instance once they have been saved.
+        The time axis, which may be shared, is left unchanged.
+
+        Views returned earlier by get_values will see the values move.
+
+        :param count: Number of values to be discarded.
+        :type count: int
+        """
+
+        self.exact = drop_samples(self.data, self.exact, self.length, count)
+        self.length -= count
+
+    def get_times(self):
+        """
+        Returns a zero-copy view of the sample times.
+
+        :return: NumPy array if NumPy is installed, memoryview otherwise.
+        """
+
+        return buffer_view(self.time_axis.data, self.length)
+
+    def get_values(self):
+        """
+        Returns a zero-copy view of the recorded values.
+
+        :return: NumPy array if NumPy is installed, memoryview otherwise.
+        """
+
+        return buffer_view(self.data, self.length)
+
+    def get_time_list(self):
+        """
+        Returns the sample times as a list, with samples which were not
+        floats as given.
+        """
+
+        return self.time_axis.get_time_list(self.length)
+
+    def get_value_list(self):
+        """
+        Returns the recorded values as a list, with values which were not
+        floats as recorded.
+        """
+
+        return exact_list(self.data, self.exact, self.length)
+
+    @property
+    def values(self):
+        """
+        List of (time, value) pairs. Built on each access; use get_times and
+        get_values for large recordings.
+
+        :type: list((Number, Number))
+        """
+
+        return list(zip(self.get_time_list(), self.get_value_list()))
+
+
+class EnsembleRecording(Recording):
+    """
+    Recording of a variable in every trial of an ensemble simulation (see
+    lems.sim.vector.EnsembleRunnable).
+
+    Each sample is a row of one value per trial, stored in a preallocated
+    two dimensional NumPy array.
+    """
+
+    def __init__(self, variable, full_path, data_output, recorder, size):
+        Recording.__init__(self, variable, full_path, data_output, recorder)
+
+        self.size = size
+        """ Number of trials.
+
+        :type: int """
+
+        self.data = numpy.zeros((0, size))
+
+    def __str__(self):
+        return "EnsembleRecording: {0} ({1}), {2}, size: {3}x{4}".format(
+            self.variable, self.full_path, self.recorder, self.length, self.size
+        )
+
+    def reserve(self, capacity, time_axis=None):
+        if self.length:
+            return
+
+        self.data = numpy.zeros((capacity, self.size))
+        if time_axis is None:
+            time_axis = TimeAxis(capacity)
+        self.time_axis = time_axis
+
     def add_value(self, time, value):
-        self.values.append((time, value))
+        """
+        Adds a sample.
+
+        :param time: Sample time.
+        :type time: float
+
+        :param value: Value in each trial, or a single value for all trials.
+        :type value: numpy.ndarray or float
+        """
+
+        n = self.length
+        if n == len(self.data):
+            extra = numpy.zeros((max(self.chunk_size, n), self.size))
+            self.data = numpy.concatenate((self.data, extra))
+        self.data[n] = value
+        self.length = n + 1
+
+        time_axis = self.time_axis
+        if n == time_axis.length:
+            time_axis.add_time(time)
+
+    def drop(self, count):
+        self.data[: self.length - count] = self.data[count : self.length]
+        self.length -= count
+
+    def get_values(self):
+        """
+        Returns a view of the recorded values.
+
+        :return: Array of shape (samples, trials).
+        :rtype: numpy.ndarray
+        """
+
+        return self.data[: self.length]
+
+    def get_value_list(self):
+        """
+        Returns the recorded values as a list of per-trial lists.
+        """
+
+        return self.data[: self.length].tolist()
+
+    def get_trial_values(self, trial):
+        """
+        Returns a view of the values recorded in one trial.
+
+        :param trial: Index of the trial.
+        :type trial: int
+
+        :return: Array of the values of the trial.
+        :rtype: numpy.ndarray
+        """
+
+        return self.data[: self.length, trial]
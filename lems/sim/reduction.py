@@ -0,0 +1,329 @@
+"""
+Select/reduce derived variables, such as the sum of the currents of the
+synapses attached to a cell, evaluated over member sets resolved once the
+simulation is built.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import re
+from functools import reduce as fold
+from operator import add, mul, attrgetter
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimBuildError
+from lems.sim.vector import InstanceView
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def is_state_variable(component, name):
+    """
+    Checks if a variable of a component changes during a simulation: a state
+    variable or a derived variable of its dynamics or regimes.
+
+    :rtype: Boolean
+    """
+
+    dynamics = component.dynamics
+    for behavior in [dynamics] + list(dynamics.regimes):
+        if (
+            name in behavior.state_variables
+            or name in behavior.derived_variables
+            or name in behavior.conditional_derived_variables
+        ):
+            return True
+    return False
+
+
+def get_index_set(indices, size):
+    """
+    Gets the cheapest NumPy index selecting members of a population.
+
+    :param indices: Indices of the members, in ascending order.
+    :type indices: list(int)
+
+    :param size: Size of the population.
+    :type size: int
+
+    :return: None for the whole population, or a slice or an index array.
+    :rtype: slice or numpy.ndarray
+    """
+
+    if indices == list(range(size)):
+        return None
+    if indices == list(range(indices[0], indices[-1] + 1)):
+        return slice(indices[0], indices[-1] + 1)
+    return numpy.array(indices)
+
+
+class Reduction(LEMSBase):
+    """
+    Derived variable reducing a variable of selected runnables, such as
+    "synapses[*]/i" or "populations[ion='ca']/i", with an addition or a
+    multiplication.
+    """
+
+    def __init__(self, variable, select, reduce, required=None):
+        """
+        Constructor.
+
+        :param variable: Name of the derived variable.
+        :type variable: string
+
+        :param select: Path of the selected variable.
+        :type select: string
+
+        :param reduce: Reduction, "add" or "multiply".
+        :type reduce: string
+
+        :param required: "false" if the selected runnables may be missing.
+        :type required: string
+
+        :raises SimBuildError: Raised if the selection is not supported.
+        """
+
+        self.variable = variable
+        """ Name of the derived variable.
+
+        :type: string """
+
+        self.select = select
+        """ Path of the selected variable.
+
+        :type: string """
+
+        self.required = required != "false"
+        """ True if the selected runnables must exist.
+
+        :type: Boolean """
+
+        match = re.match(r"([\w/]+?)(\[(.*)\])?/(\w+)$", select.replace(" ", ""))
+        if match is None:
+            raise SimBuildError("Invalid reduce target - '{0}'".format(select))
+
+        self.path = match.group(1).split("/")
+        """ Path of the selected runnable, or of the list of selected
+        runnables.
+
+        :type: list(string) """
+
+        self.multiple = match.group(2) is not None
+        """ True if a list of runnables is selected.
+
+        :type: Boolean """
+
+        self.target = match.group(4)
+        """ Name of the reduced variable of the selected runnables.
+
+        :type: string """
+
+        self.key = None
+        """ Name of the variable the selected runnables are filtered on, or
+        None if all are selected.
+
+        :type: string """
+
+        self.value = None
+        """ Python expression for the value of the filter variable.
+
+        :type: string """
+
+        if self.multiple and match.group(3) != "*":
+            bits = match.group(3).split("=")
+            if len(bits) != 2:
+                raise SimBuildError("Invalid reduce target - '{0}'".format(select))
+            (self.key, self.value) = bits
+
+        if reduce == "add":
+            self.operator = add
+            self.identity = 0
+        else:
+            self.operator = mul
+            self.identity = 1
+
+    def find_members(self, runnable):
+        """
+        Finds the runnables selected from a runnable.
+
+        Selecting all members of a runnable, such as "p1[*]/v", selects
+        the runnables in its array. Lists of runnables which are never
+        created, such as children groups without children, select no
+        runnable.
+
+        :raises SimBuildError: Raised if a required runnable is missing.
+        """
+
+        o = runnable
+        for name in self.path:
+            o = getattr(o, name, None)
+            if o is None:
+                if self.multiple and name == self.path[-1]:
+                    return []
+                if not self.required:
+                    return []
+                raise SimBuildError(
+                    "Unable to find '{0}' selected by '{1}' in '{2}'".format(
+                        name, self.select, runnable.id
+                    )
+                )
+
+        if not self.multiple:
+            return [o]
+        elif isinstance(o, list):
+            return o
+        else:
+            return list(o.array)
+
+    def bind(self, runnable):
+        """
+        Resolves the runnables selected from a runnable.
+
+        Filters on parameters are applied once, here. Filters on state
+        variables are applied each time the reduction is evaluated.
+        Selected runnables without the filter variable are not selected.
+
+        :param runnable: Runnable of the derived variable.
+        :type runnable: lems.sim.runnable.Runnable
+
+        :return: Reduction over the selected runnables.
+        :rtype: lems.sim.reduction.MemberReduction
+
+        :raises SimBuildError: Raised if a selected runnable is missing or
+        does not have the reduced variable.
+        """
+
+        value = None
+        if self.key is not None:
+            value = runnable.evaluate(self.value)
+
+        members = []
+        populations = {}
+        dynamic = False
+        for member in self.find_members(runnable):
+            if not hasattr(member, self.target):
+                raise SimBuildError(
+                    "Unable to find variable '{0}' selected by '{1}' in '{2}'".format(
+                        self.target, self.select, member.id
+                    )
+                )
+
+            if self.key is not None:
+                if not hasattr(member, self.key):
+                    continue
+                component = getattr(member, "component", None)
+                if component is not None and is_state_variable(component, self.key):
+                    dynamic = True
+                elif getattr(member, self.key) != value:
+                    continue
+
+            if isinstance(member, InstanceView):
+                population = member.population
+                if population.uid not in populations:
+                    populations[population.uid] = (population, [])
+                populations[population.uid][1].append(member.index)
+            else:
+                members.append(member)
+
+        return MemberReduction(
+            self,
+            members,
+            [
+                (population, get_index_set(sorted(indices), population.size))
+                for (population, indices) in populations.values()
+            ],
+            value if dynamic else None,
+        )
+
+
+class MemberReduction(LEMSBase):
+    """
+    Reduction over the runnables selected from a runnable (see
+    Reduction.bind). Members of scalar runnables are reduced in order, as
+    they would be by a loop, and members of vectorized populations with
+    NumPy over the population arrays.
+    """
+
+    def __init__(self, reduction, members, populations, value=None):
+        """
+        Constructor.
+
+        :param reduction: Selection and operator.
+        :type reduction: lems.sim.reduction.Reduction
+
+        :param members: Selected scalar runnables.
+        :type members: list(lems.sim.runnable.Runnable)
+
+        :param populations: Vectorized populations and the indices of their
+        selected members (see get_index_set).
+        :type populations: list((lems.sim.vector.VectorRunnable, slice))
+
+        :param value: Value of the filter variable, if the filter is on a
+        state variable and evaluated each time.
+        """
+
+        self.reduction = reduction
+        """ Selection and operator.
+
+        :type: lems.sim.reduction.Reduction """
+
+        self.members = members
+        """ Selected scalar runnables.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.populations = populations
+        """ Vectorized populations and the indices of their selected
+        members.
+
+        :type: list((lems.sim.vector.VectorRunnable, slice)) """
+
+        self.value = value
+        """ Value of the filter variable, or None if the members were
+        filtered when they were resolved.
+
+        :type: float """
+
+        self.get = attrgetter(reduction.target)
+        """ Reads the reduced variable of a runnable.
+
+        :type: callable """
+
+        if populations:
+            self.array_operator = (
+                numpy.add if reduction.operator is add else numpy.multiply
+            )
+        else:
+            self.array_operator = None
+
+    def __call__(self):
+        reduction = self.reduction
+        get = self.get
+
+        if self.value is None:
+            values = map(get, self.members)
+        else:
+            get_key = attrgetter(reduction.key)
+            values = (get(o) for o in self.members if get_key(o) == self.value)
+        acc = fold(reduction.operator, values, reduction.identity)
+
+        for population, indices in self.populations:
+            values = numpy.broadcast_to(
+                population.__dict__[reduction.target], (population.size,)
+            )
+            if indices is not None:
+                values = values[indices]
+            if self.value is not None:
+                keys = numpy.broadcast_to(
+                    population.__dict__[reduction.key], (population.size,)
+                )
+                if indices is not None:
+                    keys = keys[indices]
+                values = values[keys == self.value]
+            acc = reduction.operator(acc, float(self.array_operator.reduce(values)))
+
+        return acc
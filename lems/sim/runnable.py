@@ -7,14 +7,24 @@ Base class for runnable components.
 
 from lems.base.base import LEMSBase
 from lems.base.stack import Stack
-from lems.base.errors import SimBuildError
+from lems.base.errors import SimBuildError, SimError
 from lems.sim.recording import Recording
+from lems.sim.events import EventFanout, get_event_delay
+from lems.sim import integrators
+from lems.sim.integrators import RungeKuttaStep
 
 import ast
 import sys
+from collections import OrderedDict
+from functools import partial
+from types import MappingProxyType
 
 from math import *
 
+# Generated methods of scalar runnables are compiled against the globals of
+# this module (see Reflective.add_method).
+exp_euler_factor = integrators.exp_euler_factor
+
 # import math
 
 # class Ex1(Exception):
@@ -31,11 +41,62 @@ from math import *
 class Reflective(LEMSBase):
     debug = False
 
+    vectorized = False
+    """ True if generated methods operate on arrays rather than scalars. """
+
+    method_globals = None
+    """ Globals for generated methods (defaults to this module's globals). """
+
+    kernel_cache = OrderedDict()
+    """ Compiled generated methods shared by all runnables, keyed by
+    whether they are vectorized and their source, with the globals they
+    were compiled against. Least recently used first.
+
+    :type: OrderedDict((Boolean, string), (dict, function)) """
+
+    kernel_cache_size = 4096
+    """ Maximum number of compiled methods kept in the kernel cache.
+
+    :type: int """
+
+    kernel_cache_hits = 0
+    """ Number of generated methods found in the kernel cache.
+
+    :type: int """
+
+    kernel_cache_misses = 0
+    """ Number of generated methods that had to be compiled.
+
+    :type: int """
+
     def __init__(self):
         self.instance_variables = []
         self.derived_variables = []
         self.array = []
         self.methods = {}
+
+        self.shadow = []
+        """ Shadow (start of phase) values of the variables, read by the
+        generated code as self.shadow[i].
+
+        :type: list """
+
+        self.shadow_indices = {}
+        """ Index of each variable in the shadow buffer.
+
+        :type: dict(string, int) """
+
+        self.copy_shadow_variables = None
+        """ Generated method refreshing the whole shadow buffer from the
+        current values, see build_shadow_copy.
+
+        :type: function """
+
+        self.integrated_variables = []
+        """ State variables whose time derivatives are returned, in order,
+        by the generated method time_derivatives.
+
+        :type: list(string) """
         # self.total_code_string = ''
 
     # @classmethod
@@ -72,8 +133,7 @@ class Reflective(LEMSBase):
             for statement in statements:
                 code_string += "    " + statement + "\n"
 
-        g = globals()
-        l = locals()
+        g = self.method_globals if self.method_globals is not None else globals()
 
         # print(code_string.replace('__generated_function__',
         #                          '{0}.{1}'.format(self.component.type, method_name)))
@@ -84,25 +144,122 @@ class Reflective(LEMSBase):
                 % (method_name, self.id, str(self.derived_variables))
             )
             print(code_string)
-        exec(compile(ast.parse(code_string), "<unknown>", "exec"), g, l)
+
+        # Generated methods only refer to their arguments and globals, so
+        # runnables of the same component type can share the compiled code.
+        cache = Reflective.kernel_cache
+        key = (self.vectorized, code_string)
+        entry = cache.get(key)
+        if entry is not None and entry[0] is g:
+            Reflective.kernel_cache_hits += 1
+            cache.move_to_end(key)
+            function = entry[1]
+        else:
+            Reflective.kernel_cache_misses += 1
+            l = {}
+            exec(compile(ast.parse(code_string), "<unknown>", "exec"), g, l)
+            function = l["__generated_function__"]
+            cache[key] = (g, function)
+            cache.move_to_end(key)
+            while len(cache) > Reflective.kernel_cache_size:
+                cache.popitem(last=False)
 
         # setattr(cls, method_name, __generated_function__)
-        self.__dict__[method_name] = l["__generated_function__"]
-        del l["__generated_function__"]
+        self.__dict__[method_name] = function
+
+    def evaluate(self, expression):
+        """
+        Evaluates a Python expression with the globals of the generated
+        methods of this object.
+
+        :param expression: Python expression.
+        :type expression: string
+        """
+
+        g = self.method_globals if self.method_globals is not None else globals()
+        return eval(expression, g)
+
+    @staticmethod
+    def kernel_cache_info():
+        """
+        Returns the kernel cache statistics.
+
+        :return: Dictionary with the number of cache hits, misses and
+        compiled methods currently cached.
+        :rtype: dict(string, int)
+        """
+
+        return {
+            "hits": Reflective.kernel_cache_hits,
+            "misses": Reflective.kernel_cache_misses,
+            "size": len(Reflective.kernel_cache),
+        }
+
+    @staticmethod
+    def clear_kernel_cache():
+        """
+        Empties the kernel cache and resets its counters.
+        """
+
+        Reflective.kernel_cache.clear()
+        Reflective.kernel_cache_hits = 0
+        Reflective.kernel_cache_misses = 0
 
     def add_instance_variable(self, variable, initial_value):
         self.instance_variables.append(variable)
 
-        code_string = "self.{0} = {1}\nself.{0}_shadow = {1}".format(
-            variable, initial_value
-        )
-        exec(compile(ast.parse(code_string), "<unknown>", "exec"))
+        if not isinstance(initial_value, (int, float)):
+            # Values given as text are evaluated as Python literals/expressions.
+            initial_value = eval(str(initial_value))
+        self.__dict__[variable] = initial_value
+        self.shadow[self.shadow_index(variable)] = initial_value
 
     def add_derived_variable(self, variable):
         self.derived_variables.append(variable)
 
-        code_string = "self.{0} = {1}\nself.{0}_shadow = {1}".format(variable, 0)
-        exec(compile(ast.parse(code_string), "<unknown>", "exec"))
+        self.__dict__[variable] = 0
+        self.shadow[self.shadow_index(variable)] = 0
+
+    def shadow_index(self, variable):
+        """
+        Returns the index of a variable in the shadow buffer, allocating
+        one if needed.
+
+        :param variable: Variable name.
+        :type variable: string
+
+        :return: Index of the variable in self.shadow.
+        :rtype: int
+        """
+
+        if variable not in self.shadow_indices:
+            self.shadow_indices[variable] = len(self.shadow)
+            self.shadow.append(None)
+        return self.shadow_indices[variable]
+
+    def build_shadow_copy(self):
+        """
+        Generates copy_shadow_variables, which replaces the shadow buffer
+        with the current variable values in a single statement. Must be
+        called once all variables have been added.
+        """
+
+        variables = set(self.instance_variables) | set(self.derived_variables)
+        if not variables:
+            return
+
+        values = [None] * len(self.shadow)
+        for variable, index in self.shadow_indices.items():
+            if variable in variables:
+                values[index] = "self.{0}".format(variable)
+            else:
+                values[index] = "self.shadow[{0}]".format(index)
+
+        self.add_method(
+            "copy_shadow_variables",
+            ["self"],
+            ["self.shadow = [{0}]".format(", ".join(values))],
+        )
 
     def add_text_variable(self, variable, value):
         self.__dict__[variable] = value
@@ -114,6 +271,98 @@ class Reflective(LEMSBase):
         self.array[key] = val
 
 
+def get_required_variable_reference(variable):
+    """
+    Gets the name of the attribute referring to the ancestor holding a
+    required variable, see Runnable.bind_required_variables.
+
+    :param variable: Name of the required variable.
+    :type variable: string
+
+    :rtype: string
+    """
+
+    return "_required_" + variable
+
+
+def get_reduction_reference(variable):
+    """
+    Gets the name of the attribute holding the reduction computing a
+    select/reduce derived variable, see Runnable.bind_reductions.
+
+    :param variable: Name of the derived variable.
+    :type variable: string
+
+    :rtype: string
+    """
+
+    return "_reduce_" + variable
+
+
+EMPTY_MAPPING = MappingProxyType({})
+""" Read-only empty mapping, read by compacted runnables in place of the
+empty dictionaries they no longer hold. """
+
+compact_shared_lists = [
+    "instance_variables",
+    "derived_variables",
+    "integrated_variables",
+    "event_in_ports",
+    "event_out_ports",
+    "groups",
+]
+""" Names of the lists which compacted runnables share, as tuples, with the
+other runnables holding equal lists. """
+
+compact_shared_mappings = [
+    "shadow_indices",
+    "attachments",
+    "regimes",
+    "required_variables",
+    "reductions",
+]
+""" Names of the dictionaries which compacted runnables share, as read-only
+mappings, with the other runnables holding equal dictionaries. """
+
+compact_dropped = ["derived_variable_code", "methods"]
+""" Names of the attributes only used while building, which compacted
+runnables drop. """
+
+copy_reset_attributes = [
+    "uid",
+    "methods",
+    "state_stack",
+    "recorded_variables",
+    "event_in_counters",
+    "new_regime",
+    "last_regime",
+    "step_plan",
+    "step_plan_clocks",
+    "integrator",
+]
+""" Names of the attributes which copies of a runnable do not take from it,
+but hold their initial values. """
+
+copy_structure_attributes = [
+    "instance_variables",
+    "derived_variables",
+    "shadow",
+    "shadow_indices",
+    "array",
+    "attachments",
+    "children",
+    "uchildren",
+    "groups",
+    "event_in_ports",
+    "event_out_ports",
+    "event_out_fanouts",
+    "event_out_callbacks",
+    "regimes",
+]
+""" Names of the containers which copies of a runnable fill in with their
+own elements. """
+
+
 class Regime:
     def __init__(self, name):
         self.name = name
@@ -128,6 +377,36 @@ class Regime:
 class Runnable(Reflective):
     uid_count = 0
 
+    # Defaults read by compacted runnables (see compact) in place of the
+    # empty containers and default values they no longer hold. Containers
+    # are read-only, so that filling them in raises an error.
+    array = ()
+    children = EMPTY_MAPPING
+    uchildren = EMPTY_MAPPING
+    groups = ()
+    methods = EMPTY_MAPPING
+    recorded_variables = ()
+    event_in_ports = ()
+    event_out_ports = ()
+    event_in_counters = EMPTY_MAPPING
+    event_out_callbacks = EMPTY_MAPPING
+    event_out_fanouts = EMPTY_MAPPING
+    attachments = EMPTY_MAPPING
+    regimes = EMPTY_MAPPING
+    required_variables = EMPTY_MAPPING
+    reductions = EMPTY_MAPPING
+    derived_variable_code = EMPTY_MAPPING
+    integrated_variables = ()
+    copy_shadow_variables = None
+    plastic = True
+    state_stack = None
+    new_regime = ""
+    current_regime = ""
+    last_regime = ""
+    step_plan = None
+    step_plan_clocks = None
+    integrator = None
+
     def __init__(self, id_, component, parent=None):
         Reflective.__init__(self)
 
@@ -144,7 +423,10 @@ class Runnable(Reflective):
 
         self.plastic = True
 
-        self.state_stack = Stack()
+        self.state_stack = None
+        """ Saved states, see push_state. Created when first used.
+
+        :type: lems.base.stack.Stack """
 
         self.children = {}
         self.uchildren = {}
@@ -158,6 +440,11 @@ class Runnable(Reflective):
         self.event_out_callbacks = {}
         self.event_in_counters = {}
 
+        self.event_out_fanouts = {}
+        """ Connections of each event out port.
+
+        :type: dict(string, lems.sim.events.EventFanout) """
+
         self.attachments = {}
 
         self.new_regime = ""
@@ -165,6 +452,45 @@ class Runnable(Reflective):
         self.last_regime = ""
         self.regimes = {}
 
+        self.step_plan = None
+        """ Flat list of the callables making up one simulation step of this
+        runnable and its descendants, built by build_step_plan.
+
+        :type: list(callable) """
+
+        self.step_plan_clocks = None
+        """ Runnables whose time is advanced by the step plan.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.integrator = None
+        """ Runge-Kutta method integrating this runnable and its descendants
+        together (see init_step_plan), or None to step each runnable with
+        its generated update_state_variables.
+
+        :type: lems.sim.integrators.ButcherTableau """
+
+        self.required_variables = {}
+        """ Depth of the ancestor holding each variable required by the
+        generated methods and read through a direct reference to it, see
+        bind_required_variables.
+
+        :type: dict(string, int) """
+
+        self.reductions = {}
+        """ Select/reduce derived variables, evaluated by the generated
+        methods through the reductions set by bind_reductions.
+
+        :type: dict(string, lems.sim.reduction.Reduction) """
+
+        self.derived_variable_code = {}
+        """ Generated statements computing each derived variable, in
+        evaluation order, by method suffix ("" for the dynamics, "_regime_"
+        followed by the regime name for regimes). Used to regenerate
+        update_derived_variables with only the needed variables.
+
+        :type: dict(string, list((string, list(string)))) """
+
     def __str__(self):
         return "Runnable, id: {0} ({1}, {2}), component: ({3})".format(
             self.id, self.uid, id(self), self.component
@@ -186,6 +512,24 @@ class Runnable(Reflective):
 
         runnable.parent = self
 
+    def add_population(self, population):
+        """
+        Adds a vectorized population whose members are placed in the array
+        of this runnable.
+
+        :param population: Vectorized population
+        :type population: lems.sim.vector.VectorRunnable
+        """
+
+        self.uchildren[population.uid] = population
+        self.array.extend(population.views)
+
+        population.parent = self
+        for view in population.views:
+            view.parent = self
+
+        population.configure_time(self.time_step, self.time_total)
+
     def add_child_typeref(self, typename, runnable):
         self.__dict__[typename] = runnable
 
@@ -249,11 +593,39 @@ class Runnable(Reflective):
 
     def add_event_out_port(self, port):
         self.event_out_ports.append(port)
-        if port not in self.event_out_callbacks:
-            self.event_out_callbacks[port] = []
+        if port not in self.event_out_fanouts:
+            self.event_out_fanouts[port] = EventFanout()
+            self.event_out_callbacks[port] = self.event_out_fanouts[port].callbacks
+
+    def connect_event_out(self, port, runnable, remote_port, delay=0):
+        """
+        Connects an event out port of this runnable to an event in port.
+
+        :param port: Event out port of this runnable.
+        :type port: string
+
+        :param runnable: Runnable receiving the events.
+        :type runnable: lems.sim.runnable.Runnable
+
+        :param remote_port: Event in port of the receiving runnable.
+        :type remote_port: string
+
+        :param delay: Delay in seconds before events are delivered. Delayed
+        events are held in the event queue of the simulation.
+        :type delay: float
+
+        :raises SimBuildError: Raised if there is no such event out port.
+        """
+
+        if port in self.event_out_fanouts:
+            self.event_out_fanouts[port].connect(runnable, remote_port, delay)
+        else:
+            raise SimBuildError(
+                "No event out port '{0}' in " "component '{1}'".format(port, self.id)
+            )
 
     def register_event_out_link(self, port, runnable, remote_port):
-        self.event_out_callbacks[port].append((runnable, remote_port))
+        self.connect_event_out(port, runnable, remote_port)
 
     def register_event_out_callback(self, port, callback):
         if self.debug:
@@ -273,6 +645,10 @@ class Runnable(Reflective):
     def add_regime(self, regime):
         self.regimes[regime.name] = regime
 
+    def set_initial_regime(self, name):
+        self.current_regime = name
+        self.new_regime = name
+
     def resolve_path(self, path):
         if self.debug:
             print("Resolving path: %s in %s" % (path, self))
@@ -435,6 +811,11 @@ class Runnable(Reflective):
         ##         component.reset_time()
 
     def single_step(self, dt):
+        if self.integrator is not None:
+            if self.step_plan is None:
+                self.init_step_plan()
+            return self.single_step_plan(dt)
+
         # return self.single_step2(dt)
 
         # For debugging
@@ -448,41 +829,49 @@ class Runnable(Reflective):
         #    # rate * exp((v - midpoint)/scale)
         #    sys.exit(0)
         except KeyError as e:
-            r = self
-            name = r.id
-            while r.parent:
-                r = r.parent
-                name = "{0}.{1}".format(r.id, name)
-
-            print("Error in '{0} ({1})': {2}".format(name, self.component.type, e))
-            print(e)
-
-            prefix = "- "
-            if self.instance_variables:
-                print("Instance variables".format(prefix))
-                for vn in self.instance_variables:
-                    print("{0}      {1} = {2}".format(prefix, vn, self.__dict__[vn]))
-            if self.derived_variables:
-                print("{0}    Derived variables".format(prefix))
-                for vn in self.derived_variables:
-                    print("{0}      {1} = {2}".format(prefix, vn, self.__dict__[vn]))
-
-            keys = list(self.__dict__.keys())
-            keys.sort()
-            for k in keys:
-                print("{0} -> {1}".format(k, str(self.__dict__[k])))
-            print("")
-            print("")
-
-            if isinstance(e, ArithmeticError):
-                print(
-                    (
-                        "This is an arithmetic error. Consider reducing the "
-                        "integration time step."
-                    )
+            self.report_step_error(e)
+
+    def report_step_error(self, e):
+        """
+        Prints the state of this runnable after an error during a step and
+        exits.
+        """
+
+        r = self
+        name = r.id
+        while r.parent:
+            r = r.parent
+            name = "{0}.{1}".format(r.id, name)
+
+        print("Error in '{0} ({1})': {2}".format(name, self.component.type, e))
+        print(e)
+
+        prefix = "- "
+        if self.instance_variables:
+            print("Instance variables".format(prefix))
+            for vn in self.instance_variables:
+                print("{0}      {1} = {2}".format(prefix, vn, self.__dict__[vn]))
+        if self.derived_variables:
+            print("{0}    Derived variables".format(prefix))
+            for vn in self.derived_variables:
+                print("{0}      {1} = {2}".format(prefix, vn, self.__dict__[vn]))
+
+        keys = list(self.__dict__.keys())
+        keys.sort()
+        for k in keys:
+            print("{0} -> {1}".format(k, str(self.__dict__[k])))
+        print("")
+        print("")
+
+        if isinstance(e, ArithmeticError):
+            print(
+                (
+                    "This is an arithmetic error. Consider reducing the "
+                    "integration time step."
                 )
+            )
 
-            sys.exit(0)
+        sys.exit(0)
 
     def single_step2(self, dt):
         for cid in self.uchildren:
@@ -535,50 +924,304 @@ class Runnable(Reflective):
                 self.parent.parent.parent.parent.v,
             )
 
-        if self.current_regime != "":
-            if self.debug:
-                print("In reg: " + self.current_regime)
-            regime = self.regimes[self.current_regime]
+        self.step_regime(dt)
+
+        self.record_variables()
+
+        self.time_completed += dt
+        if self.time_completed >= self.time_total:
+            return 0
+        else:
+            return dt
+
+    def step_regime(self, dt):
+        """
+        Runs the dynamics of the current regime for one step and makes any
+        pending regime transition.
+        """
+
+        if self.current_regime == "":
+            return
+
+        if self.debug:
+            print("In reg: " + self.current_regime)
+        regime = self.regimes[self.current_regime]
+
+        # if getattr(self, "xxx", None):
+        if getattr(regime, "update_kinetic_scheme", None):
+            regime.update_kinetic_scheme(self, dt)
+
+        if getattr(regime, "run_preprocessing_event_handlers", None):
+            regime.run_preprocessing_event_handlers(self)
+        if getattr(self, "update_shadow_variables", None):
+            self.update_shadow_variables()
+
+        if getattr(regime, "update_derived_variables", None):
+            regime.update_derived_variables(self)
+        if getattr(self, "update_shadow_variables", None):
+            self.update_shadow_variables()
+
+        if getattr(regime, "update_state_variables", None):
+            regime.update_state_variables(self, dt)
+        if getattr(self, "update_shadow_variables", None):
+            self.update_shadow_variables()
 
-            # if getattr(self, "xxx", None):
-            if getattr(regime, "update_kinetic_scheme", None):
-                regime.update_kinetic_scheme(self, dt)
+        if getattr(regime, "run_postprocessing_event_handlers", None):
+            regime.run_postprocessing_event_handlers(self)
+        if getattr(self, "update_shadow_variables", None):
+            self.update_shadow_variables()
 
+        if self.new_regime != "":
+            self.current_regime = self.new_regime
+            self.new_regime = ""
+            regime = self.regimes[self.current_regime]
             if getattr(regime, "run_preprocessing_event_handlers", None):
                 regime.run_preprocessing_event_handlers(self)
             if getattr(self, "update_shadow_variables", None):
                 self.update_shadow_variables()
 
-            if getattr(regime, "update_derived_variables", None):
-                regime.update_derived_variables(self)
-            if getattr(self, "update_shadow_variables", None):
-                self.update_shadow_variables()
+        if self.debug:
+            print("In reg: " + self.current_regime)
 
-            if getattr(regime, "update_state_variables", None):
-                regime.update_state_variables(self, dt)
-            if getattr(self, "update_shadow_variables", None):
-                self.update_shadow_variables()
+    def build_step_plan(self, plan, clocks):
+        """
+        Appends the work done by single_step2 for this runnable and its
+        descendants to a flat step plan, in the same order.
 
-            if getattr(regime, "run_postprocessing_event_handlers", None):
-                regime.run_postprocessing_event_handlers(self)
-            if getattr(self, "update_shadow_variables", None):
-                self.update_shadow_variables()
+        Generated methods are bound to their runnable and time step, methods
+        which are not defined are left out and the shadow copies following a
+        missing phase, which would copy unchanged values, are dropped.
 
-            if self.new_regime != "":
-                self.current_regime = self.new_regime
-                self.new_regime = ""
-                regime = self.regimes[self.current_regime]
-                if getattr(regime, "run_preprocessing_event_handlers", None):
-                    regime.run_preprocessing_event_handlers(self)
-                if getattr(self, "update_shadow_variables", None):
-                    self.update_shadow_variables()
+        :param plan: List of callables taking no arguments.
+        :type plan: list(callable)
 
-            if self.debug:
-                print("In reg: " + self.current_regime)
+        :param clocks: List of runnables whose time is advanced after each
+        step.
+        :type clocks: list(lems.sim.runnable.Runnable)
+        """
 
-        self.record_variables()
+        for cid in self.uchildren:
+            self.uchildren[cid].build_step_plan(plan, clocks)
+
+        for child in self.array:
+            child.build_step_plan(plan, clocks)
+
+        dt = self.time_step
+
+        if self.plastic and self.copy_shadow_variables:
+            shadow = [partial(self.copy_shadow_variables, self)]
+        else:
+            shadow = []
+
+        if getattr(self, "update_kinetic_scheme", None):
+            plan.append(partial(self.update_kinetic_scheme, self, dt))
+
+        if getattr(self, "run_preprocessing_event_handlers", None):
+            plan.append(partial(self.run_preprocessing_event_handlers, self))
+        # Always copied: start up code does not update the shadow variables.
+        plan += shadow
+
+        if getattr(self, "update_derived_variables", None):
+            plan.append(partial(self.update_derived_variables, self))
+            plan += shadow
+
+        if getattr(self, "update_state_variables", None):
+            plan.append(partial(self.update_state_variables, self, dt))
+            plan += shadow
+
+        if getattr(self, "run_postprocessing_event_handlers", None):
+            plan.append(partial(self.run_postprocessing_event_handlers, self))
+            plan += shadow
+
+        if self.regimes:
+            plan.append(partial(self.step_regime, dt))
+
+        if self.recorded_variables:
+            plan.append(self.record_variables)
+
+        clocks.append(self)
+
+    def build_integrator_step_plan(self, plan, clocks):
+        """
+        Builds the step plan of this runnable and its descendants when their
+        time derivatives are integrated together by a Runge-Kutta method.
+
+        Each phase of the step is run for all runnables, children first,
+        before the next phase starts, so that events emitted by the
+        postprocessing event handlers are seen in the following step.
+        Time derivatives of regimes are integrated with forward Euler by
+        step_regime.
+
+        :param plan: List of callables taking no arguments.
+        :type plan: list(callable)
+
+        :param clocks: List of runnables whose time is advanced after each
+        step.
+        :type clocks: list(lems.sim.runnable.Runnable)
+        """
+
+        runnables = list(self.iter_subtree())
+        dt = self.time_step
+
+        shadows = {}
+        for r in runnables:
+            if r.plastic and r.copy_shadow_variables:
+                shadows[r.uid] = [partial(r.copy_shadow_variables, r)]
+            else:
+                shadows[r.uid] = []
+
+        for r in runnables:
+            if getattr(r, "run_preprocessing_event_handlers", None):
+                plan.append(partial(r.run_preprocessing_event_handlers, r))
+            plan += shadows[r.uid]
+
+        plan.append(RungeKuttaStep(runnables, self.integrator, dt))
+
+        for r in runnables:
+            if getattr(r, "run_postprocessing_event_handlers", None):
+                plan.append(partial(r.run_postprocessing_event_handlers, r))
+                plan += shadows[r.uid]
+
+        for r in runnables:
+            if r.regimes:
+                plan.append(partial(r.step_regime, dt))
+            if r.recorded_variables or r.vectorized:
+                plan.append(r.record_variables)
+            clocks.append(r)
+
+    def bind_required_variables(self):
+        """
+        Sets the direct references to the ancestors holding the variables
+        required by the generated methods of this runnable, so that reading
+        such a variable, such as the membrane potential read by ion channel
+        gates, does not walk up the parents at each evaluation. Must be
+        called once the runnable has its final parents.
+        """
+
+        for variable, depth in self.required_variables.items():
+            r = self
+            for i in range(depth):
+                r = r.parent
+            self.__dict__[get_required_variable_reference(variable)] = r
+
+    def bind_reductions(self):
+        """
+        Resolves the runnables selected by the select/reduce derived
+        variables of this runnable. Must be called once the children and
+        attachments of the runnable are final.
+
+        :raises SimBuildError: Raised if a selected runnable is missing or
+        does not have the reduced variable.
+        """
+
+        for variable, reduction in self.reductions.items():
+            self.__dict__[get_reduction_reference(variable)] = reduction.bind(self)
+
+    def compact(self, shared):
+        """
+        Reduces the memory held by this runnable once the simulation is
+        built and will no longer be changed.
+
+        Lists and dictionaries of metadata which are the same for all
+        instances of a component, such as the names of the variables or the
+        indices of the shadow buffer, are shared with the other compacted
+        runnables holding equal values, as tuples and read-only mappings.
+        Empty containers, values left at their defaults and data only used
+        while building, such as the generated statements of each derived
+        variable, are dropped and read from the class defaults.
+
+        Adding children, variables, ports or recordings to a compacted
+        runnable raises an error. Copies of a compacted runnable are not
+        compacted.
+
+        :param shared: Metadata already shared, by attribute name and value.
+        The same dictionary should be passed for all runnables of a
+        simulation.
+        :type shared: dict
+        """
+
+        d = self.__dict__
+
+        for name in compact_shared_lists:
+            if name in d:
+                value = tuple(d[name])
+                d[name] = shared.setdefault((name, value), value)
+
+        for name in compact_shared_mappings:
+            if name in d:
+                key = (name, tuple(d[name].items()))
+                if key not in shared:
+                    shared[key] = MappingProxyType(dict(d[name]))
+                d[name] = shared[key]
+
+        for name in compact_dropped:
+            d.pop(name, None)
+
+        for name in list(d):
+            default = getattr(type(self), name, self)
+            value = d[name]
+            if isinstance(value, (list, dict, tuple, MappingProxyType)):
+                if not value and isinstance(default, (tuple, MappingProxyType)):
+                    del d[name]
+            elif type(value) is type(default) and value == default:
+                del d[name]
+
+        # Deleting entries does not shrink a dictionary
+        self.__dict__ = dict(d)
+
+    def iter_subtree(self):
+        """
+        Iterates over this runnable and its descendants, children first, in
+        the order they are stepped. Members of vectorized populations are
+        represented by their population.
+        """
+
+        for cid in self.uchildren:
+            yield from self.uchildren[cid].iter_subtree()
+
+        for child in self.array:
+            if isinstance(child, Runnable):
+                yield from child.iter_subtree()
+
+        yield self
+
+    def init_step_plan(self):
+        """
+        Flattens this runnable and its descendants into a step plan.
+        """
+
+        self.step_plan = []
+        self.step_plan_clocks = []
+        if self.integrator is None:
+            self.build_step_plan(self.step_plan, self.step_plan_clocks)
+        else:
+            self.build_integrator_step_plan(self.step_plan, self.step_plan_clocks)
+
+    def single_step_plan(self, dt):
+        """
+        Advances this runnable and its descendants by one step using the
+        step plan. Equivalent to single_step.
+
+        :param dt: Time step. Must be the time step the plan was built for.
+        :type dt: Number
+        """
+
+        try:
+            for step in self.step_plan:
+                step()
+        except KeyError as e:
+            # Steps are bound methods or partials of generated functions
+            # (whose first argument is the runnable) or of bound methods.
+            runnable = getattr(step, "__self__", None)
+            if runnable is None:
+                runnable = getattr(step.func, "__self__", None)
+            if runnable is None:
+                runnable = step.args[0]
+            runnable.report_step_error(e)
+
+        for runnable in self.step_plan_clocks:
+            runnable.time_completed += dt
 
-        self.time_completed += dt
         if self.time_completed >= self.time_total:
             return 0
         else:
@@ -627,10 +1270,10 @@ class Runnable(Reflective):
             recording.add_value(self.time_completed, self.__dict__[recording.variable])
 
     def push_state(self):
-        vars = []
-        for varname in self.instance_variables:
-            vars += [self.__dict__[varname], self.__dict__[varname + "_shadow"]]
-        self.state_stack.push(vars)
+        vars = [self.__dict__[varname] for varname in self.instance_variables]
+        if self.state_stack is None:
+            self.state_stack = Stack()
+        self.state_stack.push((vars, list(self.shadow)))
 
         for cid in self.uchildren:
             self.uchildren[cid].push_state()
@@ -639,11 +1282,10 @@ class Runnable(Reflective):
             c.push_state()
 
     def pop_state(self):
-        vars = self.state_stack.pop()
-        for varname in self.instance_variables:
-            self.__dict_[varname] = vars[0]
-            self.__dict_[varname + "_shadow"] = vars[1]
-            vars = vars[2:]
+        (vars, shadow) = self.state_stack.pop()
+        for varname, value in zip(self.instance_variables, vars):
+            self.__dict__[varname] = value
+        self.shadow = shadow
 
         for cid in self.uchildren:
             self.uchildren[cid].pop_state()
@@ -651,16 +1293,73 @@ class Runnable(Reflective):
         for c in self.array:
             c.pop_state()
 
+    def get_state(self):
+        """
+        Returns the dynamic state of this runnable (excluding its children):
+        variables, shadow buffer, regimes, event counters and time.
+
+        :return: State to be passed to set_state.
+        :rtype: tuple
+        """
+
+        return (
+            [self.__dict__[v] for v in self.instance_variables],
+            [self.__dict__[v] for v in self.derived_variables],
+            list(self.shadow),
+            (self.current_regime, self.new_regime, self.last_regime),
+            dict(self.event_in_counters),
+            self.time_completed,
+        )
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state, possibly by another runnable
+        built from the same model.
+
+        :param state: State of the runnable.
+        :type state: tuple
+
+        :raises SimError: Raised if the state does not match the variables
+        and event ports of this runnable.
+        """
+
+        (variables, derived, shadow, regimes, counters, time) = state
+
+        if (
+            len(variables) != len(self.instance_variables)
+            or len(derived) != len(self.derived_variables)
+            or len(shadow) != len(self.shadow)
+            or set(counters) != set(self.event_in_counters)
+        ):
+            raise SimError("State does not match runnable '{0}'".format(self.id))
+
+        for name, value in zip(self.instance_variables, variables):
+            self.__dict__[name] = value
+        for name, value in zip(self.derived_variables, derived):
+            self.__dict__[name] = value
+        self.shadow = list(shadow)
+        (self.current_regime, self.new_regime, self.last_regime) = regimes
+        self.set_event_counters(counters)
+        self.time_completed = time
+
+    def set_event_counters(self, counters):
+        for port in counters:
+            self.event_in_counters[port] = counters[port]
+
     def update_shadow_variables(self):
-        if self.plastic:
-            for var in self.instance_variables:
-                self.__dict__[var + "_shadow"] = self.__dict__[var]
-            for var in self.derived_variables:
-                self.__dict__[var + "_shadow"] = self.__dict__[var]
+        if self.plastic and self.copy_shadow_variables:
+            self.copy_shadow_variables(self)
 
     def __lt__(self, other):
         return self.id < other.id
 
+    def make_copy(self):
+        """
+        Creates the runnable filled in by copy.
+        """
+
+        return Runnable(self.id, self.component, self.parent)
+
     def copy(self):
         """
         Make a copy of this runnable.
@@ -668,210 +1367,308 @@ class Runnable(Reflective):
         :return: Copy of this runnable.
         :rtype: lems.sim.runnable.Runnable
         """
-        if self.debug:
-            print("Coping....." + self.id)
-        r = Runnable(self.id, self.component, self.parent)
-        copies = dict()
-
-        # Copy simulation time parameters
-        r.time_step = self.time_step
-        r.time_completed = self.time_completed
-        r.time_total = self.time_total
-
-        # Plasticity and state stack (?)
-        r.plastic = self.plastic
-        r.state_stack = Stack()
-
-        # Copy variables (GG - Faster using the add_* methods?)
-        for v in self.instance_variables:
-            r.instance_variables.append(v)
-            r.__dict__[v] = self.__dict__[v]
-            r.__dict__[v + "_shadow"] = self.__dict__[v + "_shadow"]
-
-        for v in self.derived_variables:
-            r.derived_variables.append(v)
-            r.__dict__[v] = self.__dict__[v]
-            r.__dict__[v + "_shadow"] = self.__dict__[v + "_shadow"]
-
-        # Copy array elements
-        for child in self.array:
-            child_copy = child.copy()
-            child_copy.parent = r
-            r.array.append(child_copy)
-            copies[child.uid] = child_copy
-
-        # Copy attachment def
-        for att in self.attachments:
-            atn = self.attachments[att]
-            r.attachments[att] = atn
-            r.__dict__[atn] = []
-
-        # Copy children
-        for uid in self.uchildren:
-            child = self.uchildren[uid]
-            child_copy = child.copy()
-            child_copy.parent = r
-            copies[child.uid] = child_copy
 
-            r.add_child(child_copy.id, child_copy)
+        return Prototype(self).instantiate()
+
+
+class Prototype(LEMSBase):
+    """
+    Layout of a runnable, found once, from which any number of copies are
+    made (see Runnable.copy).
+
+    The attributes shared by the copies, the prototypes of the children,
+    group members and other referred runnables, and the event connections
+    between them are found when the prototype is made. Each copy is then
+    made by copying a dictionary of attributes and filling in its own
+    containers, in time proportional to the size of the runnable.
+    """
+
+    def __init__(self, template):
+        """
+        Constructor.
+
+        :param template: Runnable to be copied.
+        :type template: lems.sim.runnable.Runnable
+
+        :raises SimBuildError: Raised if an event connection of the runnable
+        cannot be resolved.
+        """
+
+        self.template = template
+        """ Runnable to be copied.
+
+        :type: lems.sim.runnable.Runnable """
+
+        self.delegated = type(template).copy is not Runnable.copy
+        """ True if the class of the runnable makes its own copies.
 
-            # For typerefs
-            try:
-                idx = [k for k in self.__dict__ if self.__dict__[k] == child][0]
-                r.__dict__[idx] = child_copy
-            except:
-                pass
-
-            # For groups and attachments:
-            try:
-                idx = [k for k in self.__dict__ if child in self.__dict__[k]][0]
-                if idx not in r.__dict__:
-                    r.__dict__[idx] = []
-                r.__dict__[idx].append(child_copy)
-
-            except:
-                pass
-
-        # Copy event ports
-        for port in self.event_in_ports:
-            r.event_in_ports.append(port)
-            r.event_in_counters[port] = 0
-
-        for port in self.event_out_ports:
-            r.event_out_ports.append(port)
-            r.event_out_callbacks[port] = self.event_out_callbacks[port]
-
-        for ec in r.component.structure.event_connections:
-            if self.debug:
-                print("--- Fixing event_connection: %s in %s" % (ec.toxml(), id(r)))
-
-            source = r.parent.resolve_path(ec.from_)
-            target = r.parent.resolve_path(ec.to)
-
-            if ec.receiver:
-                # Will throw error...
-                receiver_template = self.build_runnable(ec.receiver, target)
-                # receiver = copy.deepcopy(receiver_template)
-                receiver = receiver_template.copy()
-                receiver.id = "{0}__{1}__".format(component.id, receiver_template.id)
-
-                if ec.receiver_container:
-                    target.add_attachment(receiver, ec.receiver_container)
-                target.add_child(receiver_template.id, receiver)
-                target = receiver
+        :type: Boolean """
+
+        self.fast = type(template) is Runnable
+        """ True if copies are made without calling the constructor of
+        their class.
+
+        :type: Boolean """
+
+        self.attributes = {}
+        """ Attributes set in every copy, shared with the runnable.
+
+        :type: dict(string, *) """
+
+        self.defaults = {}
+        """ Other attributes of the runnable, set in the copies which do not
+        hold them once constructed.
+
+        :type: dict(string, *) """
+
+        self.references = []
+        """ Attributes referring to other runnables, as (name, runnable).
+
+        :type: list((string, lems.sim.runnable.Runnable)) """
+
+        self.array = []
+        """ Prototypes of the array elements.
+
+        :type: list(lems.sim.runnable.Prototype) """
+
+        self.children = []
+        """ Prototypes of the children.
+
+        :type: list(lems.sim.runnable.Prototype) """
+
+        self.members = {}
+        """ Prototypes of the group members and other referred runnables
+        which are not children, by uid.
+
+        :type: dict(int, lems.sim.runnable.Prototype) """
+
+        self.event_connections = []
+        """ Event connections made in every copy, as (source, source port,
+        target, target port, delay). Runnables copied along with the
+        runnable are replaced by their copies.
+
+        :type: list((lems.sim.runnable.Runnable, string,
+        lems.sim.runnable.Runnable, string, float)) """
+
+        if self.delegated:
+            return
+
+        d = template.__dict__
+        for name in [
+            "id",
+            "component",
+            "time_step",
+            "time_completed",
+            "time_total",
+            "plastic",
+            "copy_shadow_variables",
+            "integrated_variables",
+            "derived_variable_code",
+            "required_variables",
+            "reductions",
+            "current_regime",
+        ]:
+            self.attributes[name] = getattr(template, name)
+        for name in list(template.instance_variables) + list(
+            template.derived_variables
+        ):
+            self.attributes[name] = d[name]
+
+        skipped = set(copy_reset_attributes + copy_structure_attributes)
+        skipped |= set(template.groups) | set(template.attachments.values())
+        for (name, value) in d.items():
+            if name == "parent" or name in self.attributes or name in skipped:
+                continue
+            if isinstance(value, Runnable):
+                self.references.append((name, value))
             else:
-                source = r.resolve_path(ec.from_)
-                target = r.resolve_path(ec.to)
+                self.defaults[name] = value
 
-            source_port = ec.source_port
-            target_port = ec.target_port
+        self.array = [Prototype(child) for child in template.array]
+        self.children = [Prototype(child) for child in template.uchildren.values()]
 
-            if not source_port:
-                if len(source.event_out_ports) == 1:
-                    source_port = source.event_out_ports[0]
-                else:
-                    raise SimBuildError(
-                        (
-                            "No source event port " "uniquely identifiable" " in '{0}'"
-                        ).format(source.id)
-                    )
-            if not target_port:
-                if len(target.event_in_ports) == 1:
-                    target_port = target.event_in_ports[0]
-                else:
-                    raise SimBuildError(
-                        (
-                            "No destination event port "
-                            "uniquely identifiable "
-                            "in '{0}'"
-                        ).format(target)
-                    )
+        copied = set(child.uid for child in template.array)
+        copied |= set(template.uchildren)
+        members = [c for name in template.groups for c in d[name]]
+        members += [c for (name, c) in self.references]
+        for c in members:
+            if c.uid not in copied:
+                self.members[c.uid] = Prototype(c)
+                copied.add(c.uid)
 
-            if self.debug:
-                print(
-                    "register_event_out_callback\n   Source: %s, %s (port: %s) \n   -> %s, %s (port: %s)"
-                    % (source, id(source), source_port, target, id(target), target_port)
-                )
-            source.register_event_out_callback(
-                source_port, lambda: target.inc_event_in(target_port)
+        if template.component is not None:
+            for ec in template.component.structure.event_connections:
+                self.event_connections.append(self.resolve_event_connection(ec))
+
+    def resolve_event_connection(self, ec):
+        """
+        Resolves the source, target and ports of an event connection of the
+        runnable.
+
+        :param ec: Event connection.
+        :type ec: lems.model.structure.EventConnection
+
+        :return: Source, source port, target, target port and delay.
+        :rtype: (lems.sim.runnable.Runnable, string,
+        lems.sim.runnable.Runnable, string, float)
+
+        :raises SimBuildError: Raised if a port is not uniquely identifiable
+        or if the connection has a receiver.
+        """
+
+        template = self.template
+        template.parent.resolve_path(ec.from_)
+        template.parent.resolve_path(ec.to)
+
+        if ec.receiver:
+            raise SimBuildError(
+                "Unable to copy '{0}': event connections with receivers "
+                "are not supported".format(template.id)
             )
 
-        # Copy methods
-        if getattr(self, "update_kinetic_scheme", None):
-            r.update_kinetic_scheme = self.update_kinetic_scheme
-        if getattr(self, "run_startup_event_handlers", None):
-            r.run_startup_event_handlers = self.run_startup_event_handlers
-        if getattr(self, "run_preprocessing_event_handlers", None):
-            r.run_preprocessing_event_handlers = self.run_preprocessing_event_handlers
-        if getattr(self, "run_postprocessing_event_handlers", None):
-            r.run_postprocessing_event_handlers = self.run_postprocessing_event_handlers
+        source = template.resolve_path(ec.from_)
+        target = template.resolve_path(ec.to)
 
-        if getattr(self, "update_state_variables", None):
-            r.update_state_variables = self.update_state_variables
-        if getattr(self, "update_derived_variables", None):
-            r.update_derived_variables = self.update_derived_variables
-        # r.update_shadow_variables = self.update_shadow_variables
-        if getattr(self, "update_derived_parameters", None):
-            r.update_derived_parameters = self.update_derived_parameters
-
-        for rn in self.regimes:
-            r.add_regime(self.regimes[rn])
-        r.current_regime = self.current_regime
-
-        # Copy groups
-        for gn in self.groups:
-            g = self.__dict__[gn]
-            for c in g:
-                if c.uid in copies:
-                    r.add_child_to_group(gn, copies[c.uid])
-                else:
-                    c2 = c.copy()
-                    c2.parent = r
-                    copies[c.uid] = c2
-                    r.add_child_to_group(gn, c2)
-
-        # Copy remaining runnable references.
-        for k in self.__dict__:
-            if k == "parent":
-                continue
-            c = self.__dict__[k]
-            if isinstance(c, Runnable):
-                if c.uid in copies:
-                    r.__dict__[k] = copies[c.uid]
-                else:
-                    c2 = c.copy()
-                    c2.parent = r
-                    copies[c.uid] = c2
-                    r.__dict__[k] = c2
-
-        # Copy text fields
-        for k in self.__dict__:
-            if not k in r.__dict__:
-                c = self.__dict__[k]
-                if self.debug:
-                    print("Adding remaining field: %s = %s" % (k, c))
-                r.__dict__[k] = c
+        source_port = ec.source_port
+        target_port = ec.target_port
 
-        if self.debug:
-            print("########################################")
-            keys = list(self.__dict__.keys())
-            keys.sort()
-            print(len(keys))
-            for k in keys:
-                print(k, self.__dict__[k])
-            print("----------------------------------------")
-            keys = list(r.__dict__.keys())
-            keys.sort()
-            print(len(keys))
-            for k in keys:
-                print(k, r.__dict__[k])
-            print("########################################")
-            print("")
-            print("")
-            print("")
-            print("")
+        if not source_port:
+            if len(source.event_out_ports) == 1:
+                source_port = source.event_out_ports[0]
+            else:
+                raise SimBuildError(
+                    (
+                        "No source event port " "uniquely identifiable" " in '{0}'"
+                    ).format(source.id)
+                )
+        if not target_port:
+            if len(target.event_in_ports) == 1:
+                target_port = target.event_in_ports[0]
+            else:
+                raise SimBuildError(
+                    (
+                        "No destination event port "
+                        "uniquely identifiable "
+                        "in '{0}'"
+                    ).format(target)
+                )
 
-        if self.debug:
-            print("Finished coping..." + self.id)
+        return (
+            source,
+            source_port,
+            target,
+            target_port,
+            get_event_delay(template.component, ec),
+        )
+
+    def instantiate(self, copies=None):
+        """
+        Makes a copy of the runnable.
+
+        :param copies: Copies made so far of the runnables copied along
+        with an enclosing runnable, by uid of the runnable copied, used to
+        connect events between copies.
+        :type copies: dict(int, lems.sim.runnable.Runnable)
+
+        :return: Copy of the runnable.
+        :rtype: lems.sim.runnable.Runnable
+        """
+
+        template = self.template
+        if self.delegated:
+            return template.copy()
+        if copies is None:
+            copies = {}
+
+        if self.fast:
+            r = Runnable.__new__(Runnable)
+            d = dict(self.defaults)
+            d.update(self.attributes)
+            d["uid"] = Runnable.uid_count
+            Runnable.uid_count += 1
+            d["parent"] = template.parent
+            d["methods"] = {}
+            d["state_stack"] = None
+            d["recorded_variables"] = []
+            d["event_in_ports"] = list(template.event_in_ports)
+            d["event_in_counters"] = dict.fromkeys(template.event_in_ports, 0)
+            d["new_regime"] = ""
+            d["last_regime"] = ""
+            d["step_plan"] = None
+            d["step_plan_clocks"] = None
+            d["integrator"] = None
+            r.__dict__ = d
+        else:
+            r = template.make_copy()
+            d = r.__dict__
+            d.update(self.attributes)
+            for (name, value) in self.defaults.items():
+                d.setdefault(name, value)
+            for port in template.event_in_ports:
+                r.add_event_in_port(port)
+        copies[template.uid] = r
+
+        d["instance_variables"] = list(template.instance_variables)
+        d["derived_variables"] = list(template.derived_variables)
+        d["shadow"] = list(template.shadow)
+        d["shadow_indices"] = dict(template.shadow_indices)
+        d["attachments"] = dict(template.attachments)
+        for name in template.attachments.values():
+            d[name] = []
+        d["array"] = []
+        d["children"] = {}
+        d["uchildren"] = {}
+        d["groups"] = []
+        d["regimes"] = dict(template.regimes)
+
+        fanouts = {}
+        for port in template.event_out_ports:
+            fanouts[port] = template.event_out_fanouts[port].copy()
+        d["event_out_ports"] = list(template.event_out_ports)
+        d["event_out_fanouts"] = fanouts
+        d["event_out_callbacks"] = dict(
+            (port, fanout.callbacks) for (port, fanout) in fanouts.items()
+        )
+
+        # Copies of the runnables referred to by this runnable
+        local = {}
+
+        for prototype in self.array:
+            child_copy = prototype.instantiate(copies)
+            child_copy.parent = r
+            r.array.append(child_copy)
+            local[prototype.template.uid] = child_copy
+
+        for prototype in self.children:
+            child_copy = prototype.instantiate(copies)
+            child_copy.parent = r
+            r.add_child(child_copy.id, child_copy)
+            local[prototype.template.uid] = child_copy
+
+        for (source, source_port, target, target_port, delay) in self.event_connections:
+            source = copies.get(source.uid, source)
+            target = copies.get(target.uid, target)
+            source.connect_event_out(source_port, target, target_port, delay)
+
+        for name in template.groups:
+            for c in template.__dict__[name]:
+                r.add_child_to_group(name, self.get_copy(r, c, local, copies))
+            if name not in d:
+                d[name] = []
+
+        for (name, c) in self.references:
+            d[name] = self.get_copy(r, c, local, copies)
 
         return r
+
+    def get_copy(self, r, c, local, copies):
+        """
+        Gets the copy of a runnable referred to by the runnable, making it
+        if it is not a child.
+        """
+
+        if c.uid not in local:
+            c2 = self.members[c.uid].instantiate(copies)
+            c2.parent = r
+            local[c.uid] = c2
+        return local[c.uid]
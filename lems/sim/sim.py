@@ -6,9 +6,154 @@ Simulation.
 """
 
 from lems.base.base import LEMSBase
-from lems.base.errors import SimError
+from lems.base.errors import SimBuildError, SimError
 
 import heapq
+import json
+import math
+import os
+import random
+from fractions import Fraction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from lems.sim.recording import TimeAxis
+from lems.sim.events import EventQueue
+
+checkpoint_version = 3
+""" Version of the checkpoint file format. """
+
+
+def encode_state(value):
+    """
+    Converts the state of a simulation into plain JSON values. Tuples,
+    dictionaries, fractions and NumPy arrays are tagged so that
+    decode_state restores them.
+
+    :param value: State made of None, Booleans, numbers, strings, lists,
+    tuples, dictionaries, fractions and NumPy arrays or scalars.
+
+    :return: JSON value.
+
+    :raises SimError: Raised if the state holds any other kind of value.
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode_state(v) for v in value]
+    if isinstance(value, tuple):
+        return {"tuple": [encode_state(v) for v in value]}
+    if isinstance(value, dict):
+        return {"dict": [[encode_state(k), encode_state(v)] for k, v in value.items()]}
+    if isinstance(value, Fraction):
+        return {"fraction": [value.numerator, value.denominator]}
+    if numpy and isinstance(value, (numpy.ndarray, numpy.generic)):
+        return {"array": numpy.asarray(value).tolist(), "dtype": value.dtype.str}
+    raise SimError("Cannot save a value of type {0}".format(type(value).__name__))
+
+
+def decode_state(value):
+    """
+    Restores a state converted by encode_state.
+
+    :param value: JSON value.
+
+    :return: State.
+
+    :raises SimError: Raised if the value is not a converted state.
+    """
+
+    if isinstance(value, list):
+        return [decode_state(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "tuple" in value:
+        return tuple(decode_state(v) for v in value["tuple"])
+    if "dict" in value:
+        return dict((decode_state(k), decode_state(v)) for k, v in value["dict"])
+    if "fraction" in value:
+        return Fraction(*value["fraction"])
+    if "array" in value:
+        if numpy is None:
+            raise SimError("NumPy is required to restore this state")
+        array = numpy.array(value["array"], dtype=numpy.dtype(value["dtype"]))
+        return array if array.ndim else array[()]
+    raise SimError("Unexpected value in a saved state")
+
+
+def get_exact_time(time):
+    """
+    Converts a time to a fraction, taking floats to be the decimal numbers
+    they are printed as (0.1 is taken to be 1/10).
+
+    :param time: Time in seconds.
+    :type time: Number
+
+    :rtype: fractions.Fraction
+    """
+
+    if isinstance(time, float):
+        return Fraction(repr(float(time)))
+    else:
+        return Fraction(time)
+
+
+def get_tick_base(time_steps):
+    """
+    Finds the longest interval of which all time steps are whole multiples.
+
+    :param time_steps: Positive time steps in seconds.
+    :type time_steps: list(Number)
+
+    :return: Interval in seconds.
+    :rtype: fractions.Fraction
+    """
+
+    base = None
+    for time_step in time_steps:
+        step = get_exact_time(time_step)
+        if base is None:
+            base = step
+        else:
+            denominator = base.denominator * step.denominator
+            base = Fraction(
+                math.gcd(
+                    base.numerator * step.denominator,
+                    step.numerator * base.denominator,
+                ),
+                denominator,
+            )
+    return base if base is not None else Fraction(1)
+
+
+class RateGroup(LEMSBase):
+    """
+    Top level runnables stepped together at the same rate.
+    """
+
+    def __init__(self, ticks, runnables, next_tick=0):
+        self.ticks = ticks
+        """ Time step of the runnables in ticks, or 0 for runnables without
+        a time step, which are stepped once.
+
+        :type: int """
+
+        self.runnables = runnables
+        """ Runnables still running, in the order they are stepped.
+
+        :type: list(lems.sim.runnable.Runnable) """
+
+        self.next_tick = next_tick
+        """ Tick at which the runnables are next stepped.
+
+        :type: int """
+
+    def __lt__(self, other):
+        return self.ticks < other.ticks
 
 
 class Simulation(LEMSBase):
@@ -28,15 +173,74 @@ class Simulation(LEMSBase):
 
         :type: dict(string, lems.sim.runnable.Runnable) """
 
+        self.tick_base = Fraction(1)
+        """ Duration of a tick in seconds. All time steps are whole numbers
+        of ticks, so that runnables due at the same time are stepped
+        together however their times were accumulated.
+
+        :type: fractions.Fraction """
+
+        self.rate_groups = []
+        """ Top level runnables still running, grouped by time step.
+
+        :type: list(lems.sim.sim.RateGroup) """
+
         self.run_queue = []
-        """ Priority of pairs of (time-to-next run, runnable).
+        """ Priority queue of (next tick, group) pairs, used when the
+        runnables run at several rates.
+
+        :type: list((int, lems.sim.sim.RateGroup)) """
+
+        self.current_time = 0
+        """ Time of the last step, in seconds.
+
+        :type: Number """
+
+        self.event_queue = EventQueue()
+        """ Queue of events posted through delayed event connections.
+
+        :type: lems.sim.events.EventQueue """
 
-        :type: list((Integer, lems.sim.runnable.Runnable)) """
+        self.output_writers = []
+        """ Writers saving recordings to files during the run.
 
-        self.event_queue = []
-        """ List of posted events.
+        :type: list(lems.sim.output.OutputWriter) """
 
-        :type: list(lems.sim.sim.Event) """
+        self.use_step_plan = True
+        """ Step runnables using flat step plans built in init_run rather
+        than by recursing through the runnable tree.
+
+        :type: Boolean """
+
+        self.delayed_fanouts = []
+        """ Fanouts of event out ports with delayed connections, in the
+        order of iter_runnables.
+
+        :type: list(lems.sim.events.EventFanout) """
+
+        self.restored = False
+        """ Set by load_checkpoint, so that the next call to run continues
+        from the restored state.
+
+        :type: Boolean """
+
+        self.skipped_derived_variables = {}
+        """ Derived variables no longer computed in demand-driven simulations,
+        by runnable uid (see lems.sim.build.SimulationBuilder).
+
+        :type: dict(int, set(string)) """
+
+        self.started = False
+        """ True while a run is in progress: it has been initialized and the
+        output writers are open, see start and finish.
+
+        :type: Boolean """
+
+        self.stop_time = Fraction(0)
+        """ Time up to which the run in progress has been stepped by
+        run_until, run_for or iter_steps.
+
+        :type: fractions.Fraction """
 
     def add_runnable(self, runnable):
         """
@@ -52,53 +256,467 @@ class Simulation(LEMSBase):
 
         self.runnables[runnable.id] = runnable
 
+    def add_output_writer(self, writer):
+        """
+        Adds a writer saving recordings to a file during the run.
+
+        :param writer: Output writer
+        :type writer: lems.sim.output.OutputWriter
+        """
+
+        self.output_writers.append(writer)
+
+    def get_recordings(self):
+        """
+        Lists the recordings made by all runnables in this simulation.
+
+        :return: List of recordings
+        :rtype: list(lems.sim.recording.Recording)
+        """
+
+        recordings = []
+        for runnable in self.iter_runnables():
+            recordings += runnable.recorded_variables
+        return recordings
+
+    def iter_runnables(self):
+        """
+        Iterates over all runnables in this simulation, breadth first. The
+        order is the same for all simulations built from a model.
+
+        :return: Iterator over runnables
+        :rtype: iterator(lems.sim.runnable.Runnable)
+        """
+
+        rq = list(self.runnables.values())
+        while rq:
+            runnable = rq.pop(0)
+            rq.extend(runnable.uchildren.values())
+            rq.extend(runnable.array)
+            yield runnable
+
     def init_run(self):
         self.current_time = 0
         for id in self.runnables:
             self.runnables[id].do_startup()
-            heapq.heappush(self.run_queue, (0, self.runnables[id]))
 
-    def step(self):
-        current_time = self.current_time
+        self.init_schedule()
+        self.init_recordings()
+        self.init_event_queue()
 
-        if self.run_queue == []:
-            return False
+        if self.use_step_plan:
+            self.init_step_plans()
+
+    def init_schedule(self):
+        """
+        Converts the time steps of the top level runnables to whole numbers
+        of ticks and groups the runnables by time step.
+        """
+
+        time_steps = [r.time_step for r in self.runnables.values() if r.time_step > 0]
+        self.tick_base = get_tick_base(time_steps)
+
+        groups = {}
+        # Runnables due at the same time are stepped in order of id.
+        for runnable in sorted(self.runnables.values()):
+            if runnable.time_step > 0:
+                ticks = get_exact_time(runnable.time_step) / self.tick_base
+                ticks = int(ticks)
+            else:
+                ticks = 0
+            groups.setdefault(ticks, []).append(runnable)
+
+        self.set_schedule(
+            [RateGroup(ticks, runnables) for ticks, runnables in groups.items()]
+        )
+
+    def set_schedule(self, rate_groups):
+        """
+        Sets the groups of runnables to be stepped.
 
-        (current_time, runnable) = heapq.heappop(self.run_queue)
-        time = current_time
-        while time == current_time:
-            next_time = current_time + runnable.single_step(runnable.time_step)
+        :param rate_groups: Groups of runnables.
+        :type rate_groups: list(lems.sim.sim.RateGroup)
+        """
+
+        self.rate_groups = rate_groups
+        self.run_queue = []
+        if len(rate_groups) > 1:
+            for group in rate_groups:
+                heapq.heappush(self.run_queue, (group.next_tick, group))
+
+    def init_recordings(self):
+        """
+        Preallocates the recording buffers for the expected number of steps
+        and lets the recordings of each data output share a time axis.
+        Recordings saved by an output writer only need to hold the rows
+        between two flushes.
+        """
 
-            if next_time > current_time:
-                heapq.heappush(self.run_queue, (next_time, runnable))
+        flush_intervals = {}
+        for writer in self.output_writers:
+            flush_intervals[id(writer.data_output)] = writer.flush_interval
+
+        for runnable in self.runnables.values():
+            if runnable.time_step > 0:
+                capacity = int(math.ceil(runnable.time_total / runnable.time_step)) + 1
+            else:
+                capacity = 0
+
+            time_axes = {}
+            rq = [runnable]
+            while rq:
+                r = rq.pop()
+                rq.extend(r.uchildren.values())
+                rq.extend(r.array)
+                for recording in r.recorded_variables:
+                    key = id(recording.data_output)
+                    size = min(capacity, flush_intervals.get(key, capacity))
+                    if key not in time_axes:
+                        time_axes[key] = TimeAxis(size)
+                    recording.reserve(size, time_axes[key])
+
+    def init_event_queue(self):
+        """
+        Restarts the event queue, with the smallest time step of the
+        runnables, and hands it to the event connections with delays.
+        """
+
+        time_steps = [r.time_step for r in self.runnables.values() if r.time_step > 0]
+        self.event_queue.reset(min(time_steps) if time_steps else 0)
 
-            if self.run_queue == []:
-                break
-            (time, runnable) = heapq.heappop(self.run_queue)
+        fanouts = {}
+        for runnable in self.iter_runnables():
+            for port in runnable.event_out_ports:
+                fanout = runnable.event_out_fanouts[port]
+                fanouts[id(fanout)] = fanout
 
-            if time > current_time:
-                heapq.heappush(self.run_queue, (time, runnable))
+        self.delayed_fanouts = []
+        for fanout in fanouts.values():
+            if fanout.has_delays():
+                fanout.set_queue(self.event_queue)
+                self.delayed_fanouts.append(fanout)
+                self.event_queue.active = True
 
-        self.current_time = current_time
+    def init_step_plans(self):
+        """
+        Builds the flat step plans of all runnables. Must be called again if
+        the structure or plasticity of the runnables changes.
+        """
 
-        if self.run_queue == []:
+        for id in self.runnables:
+            self.runnables[id].init_step_plan()
+
+    def step(self):
+        """
+        Steps the runnables due at the next tick.
+
+        :return: False once all runnables have completed.
+        :rtype: Boolean
+        """
+
+        if len(self.rate_groups) == 1:
+            # Single rate: every step is due, no scheduling needed.
+            group = self.rate_groups[0]
+            self.set_current_tick(group.next_tick)
+
+            group.runnables = self.step_runnables(group.runnables)
+            group.next_tick += group.ticks
+            if not group.runnables or not group.ticks:
+                self.rate_groups = []
+            return bool(self.rate_groups)
+
+        if not self.run_queue:
             return False
+
+        (tick, group) = heapq.heappop(self.run_queue)
+        groups = [group]
+        while self.run_queue and self.run_queue[0][0] == tick:
+            groups.append(heapq.heappop(self.run_queue)[1])
+
+        self.set_current_tick(tick)
+
+        if len(groups) == 1:
+            group.runnables = self.step_runnables(group.runnables)
+        else:
+            running = self.step_runnables(
+                sorted(r for group in groups for r in group.runnables)
+            )
+            for group in groups:
+                group.runnables = [r for r in group.runnables if r in running]
+
+        for group in groups:
+            group.next_tick = tick + group.ticks
+            if group.runnables and group.ticks:
+                heapq.heappush(self.run_queue, (group.next_tick, group))
+            else:
+                self.rate_groups.remove(group)
+
+        return bool(self.run_queue)
+
+    def get_next_tick(self):
+        """
+        Gets the tick at which the next call to step steps runnables.
+
+        :return: Next tick, or None once all runnables have completed.
+        :rtype: int
+        """
+
+        if not self.rate_groups:
+            return None
+        elif len(self.rate_groups) == 1:
+            return self.rate_groups[0].next_tick
         else:
-            return True
+            return self.run_queue[0][0]
 
-    def run(self):
+    def set_current_tick(self, tick):
+        """
+        Sets the current time and delivers the delayed events due by then.
+
+        :param tick: Current tick.
+        :type tick: int
         """
-        Runs the simulation.
+
+        self.current_time = float(tick * self.tick_base)
+        if self.event_queue.active:
+            self.event_queue.advance(self.current_time)
+
+    def step_runnables(self, runnables):
         """
+        Steps runnables once.
 
-        self.init_run()
+        :param runnables: Runnables, in the order they are to be stepped.
+        :type runnables: list(lems.sim.runnable.Runnable)
+
+        :return: The runnables which have not completed.
+        :rtype: list(lems.sim.runnable.Runnable)
+        """
+
+        running = []
+        for runnable in runnables:
+            if runnable.step_plan is None:
+                dt = runnable.single_step(runnable.time_step)
+            else:
+                dt = runnable.single_step_plan(runnable.time_step)
+            if dt > 0:
+                running.append(runnable)
+        return running
+
+    def start(self):
+        """
+        Starts a run: initializes the simulation, unless it was restored
+        from a checkpoint, and opens the output writers. Called by run,
+        run_until, run_for and iter_steps when no run is in progress.
+        """
+
+        if self.restored:
+            self.restored = False
+        else:
+            self.init_run()
         if self.debug:
             self.dump("AfterInit: ")
+
+        for writer in self.output_writers:
+            writer.open(self)
+
+        self.stop_time = get_exact_time(self.current_time)
+        self.started = True
+
+    def finish(self):
+        """
+        Ends the run in progress and closes the output writers. Called once
+        all runnables have completed; a run stopped earlier must be finished
+        for its output files to be complete.
+        """
+
+        for writer in self.output_writers:
+            writer.close()
+        self.started = False
+
+    def run(self):
+        """
+        Runs the simulation, or the rest of the run in progress.
+        """
+
+        if not self.started:
+            self.start()
+
+        writers = self.output_writers
+
         # print("++++++++++++++++ Time: %f"%self.current_time)
-        while self.step():
-            # self.dump("Time: %f"%self.current_time)
-            # print("++++++++++++++++ Time: %f"%self.current_time)
-            pass
+        if writers:
+            while self.step():
+                for writer in writers:
+                    writer.poll()
+        else:
+            while self.step():
+                # self.dump("Time: %f"%self.current_time)
+                # print("++++++++++++++++ Time: %f"%self.current_time)
+                pass
+
+        self.finish()
+
+    def run_until(self, time):
+        """
+        Runs the simulation until the steps due at or before a time have
+        been made. The run can then be continued by another call to
+        run_until, run_for, iter_steps or run.
+
+        :param time: Time in seconds.
+        :type time: Number
+
+        :return: False once all runnables have completed, and the run has
+        been finished.
+        :rtype: Boolean
+        """
+
+        if not self.started:
+            self.start()
+
+        limit = get_exact_time(time)
+        last_tick = math.floor(limit / self.tick_base)
+        writers = self.output_writers
+
+        tick = self.get_next_tick()
+        while tick is not None and tick <= last_tick:
+            self.step()
+            for writer in writers:
+                writer.poll()
+            tick = self.get_next_tick()
+
+        self.stop_time = max(self.stop_time, limit)
+        if tick is None:
+            self.finish()
+            return False
+        return True
+
+    def run_for(self, duration):
+        """
+        Runs the simulation for a duration, from the time reached by the
+        last call to run_until or run_for, or from the start of the run.
+
+        :param duration: Duration in seconds.
+        :type duration: Number
+
+        :return: False once all runnables have completed, and the run has
+        been finished.
+        :rtype: Boolean
+        """
+
+        if not self.started:
+            self.start()
+        return self.run_until(self.stop_time + get_exact_time(duration))
+
+    def iter_steps(self, every=1, variables=None, keep_recordings=True):
+        """
+        Runs the simulation step by step, yielding the values of some
+        variables every few steps, so that they can be used while the
+        simulation runs. The run is finished once all runnables have
+        completed; stopping the iteration earlier leaves it in progress.
+
+        :param every: Number of steps between two snapshots. A snapshot is
+        also taken after the last step.
+        :type every: int
+
+        :param variables: Paths of the variables in the snapshots, see
+        resolve_variable.
+        :type variables: list(string)
+
+        :param keep_recordings: If False, samples of the recordings which
+        are not saved by an output writer are discarded at each snapshot,
+        so that memory use does not grow with the length of the run.
+        :type keep_recordings: Boolean
+
+        :return: Iterator over snapshots, as (time of the last step, values
+        of the variables in order).
+        :rtype: iterator((float, list(Number)))
+
+        :raises SimError: Raised if every is not positive or a variable
+        cannot be found.
+        """
+
+        if every < 1:
+            raise SimError("Snapshots must be taken every step or less often")
+        if not self.started:
+            self.start()
+
+        readers = [self.resolve_variable(path) for path in variables or []]
+        writers = self.output_writers
+
+        dropped = []
+        if not keep_recordings:
+            saved = set(id(writer.data_output) for writer in writers)
+            for recording in self.get_recordings():
+                if id(recording.data_output) not in saved:
+                    dropped.append(recording)
+
+        count = 0
+        running = self.get_next_tick() is not None
+        while running:
+            running = self.step()
+            for writer in writers:
+                writer.poll()
+            count += 1
+            if count < every and running:
+                continue
+
+            count = 0
+            for recording in dropped:
+                recording.drop(len(recording))
+                recording.time_axis.drop(len(recording.time_axis))
+            self.stop_time = get_exact_time(self.current_time)
+            if not running:
+                self.finish()
+            yield (
+                self.current_time,
+                [getattr(runnable, name) for (runnable, name) in readers],
+            )
+
+    def resolve_variable(self, path):
+        """
+        Finds the runnable holding a variable.
+
+        :param path: Path of the variable, relative to a top level
+        runnable, as the quantities recorded by <Line> and <OutputColumn>
+        elements (e.g. "p3[0]/v"), or starting with the id of a top level
+        runnable (e.g. "net1_sim1/p3[0]/v"). Relative paths are resolved
+        from the first top level runnable in which they are found.
+        :type path: string
+
+        :return: Runnable and name of the variable.
+        :rtype: (lems.sim.runnable.Runnable, string)
+
+        :raises SimError: Raised if the variable cannot be found, or is a
+        derived variable no longer computed because nothing reads it in a
+        demand-driven simulation.
+        """
+
+        if "/" in path:
+            (runnable_path, name) = path.rsplit("/", 1)
+        else:
+            (runnable_path, name) = ("", path)
+
+        roots = [(r, runnable_path) for r in sorted(self.runnables.values())]
+        (first, _, rest) = runnable_path.partition("/")
+        if first in self.runnables:
+            roots.insert(0, (self.runnables[first], rest))
+
+        for (root, relative_path) in roots:
+            try:
+                runnable = root.resolve_path(relative_path)
+            except (SimBuildError, IndexError):
+                continue
+            if name in self.skipped_derived_variables.get(runnable.uid, ()):
+                raise SimError(
+                    "'{0}' is not computed in demand-driven simulations, "
+                    "as nothing reads it".format(path)
+                )
+            if (
+                name in runnable.instance_variables
+                or name in runnable.derived_variables
+            ):
+                return (runnable, name)
+
+        raise SimError("Unable to find the variable '{0}'".format(path))
 
     def push_state(self):
         for id in self.runnables:
@@ -108,13 +726,113 @@ class Simulation(LEMSBase):
         for id in self.runnables:
             self.runnables[id].pop_state()
 
+    def save_checkpoint(self, path):
+        """
+        Saves the state of the simulation to a file: the variables, shadow
+        buffers, regimes and event counters of all runnables, the time, the
+        pending delayed events and the state of the random number
+        generators. Recordings are not saved.
+
+        Checkpoints are JSON files, so loading them cannot run any code.
+
+        :param path: Name of the checkpoint file.
+        :type path: string
+        """
+
+        state = {
+            "version": checkpoint_version,
+            "current_time": self.current_time,
+            "schedule": [
+                (group.ticks, group.next_tick, [r.id for r in group.runnables])
+                for group in self.rate_groups
+            ],
+            "ids": [],
+            "runnables": [],
+            "event_queue": self.event_queue.get_state(self.delayed_fanouts),
+            "random": random.getstate(),
+            "numpy_random": numpy.random.get_state() if numpy else None,
+        }
+        for runnable in self.iter_runnables():
+            state["ids"].append(runnable.id)
+            state["runnables"].append(runnable.get_state())
+
+        # Written to a temporary file first so that an interrupted save
+        # leaves any earlier checkpoint intact.
+        with open(path + ".tmp", "w") as f:
+            json.dump(encode_state(state), f)
+        os.replace(path + ".tmp", path)
+
+    def load_checkpoint(self, path):
+        """
+        Restores a state saved by save_checkpoint into this simulation, which
+        must have been built from the same model but not run. A subsequent
+        call to run continues the simulation from the restored time, with
+        empty recordings.
+
+        :param path: Name of the checkpoint file.
+        :type path: string
+
+        :raises SimError: Raised if the file is not a checkpoint or does
+        not match the simulation.
+        """
+
+        try:
+            with open(path) as f:
+                state = decode_state(json.load(f))
+        except (ValueError, TypeError, KeyError) as e:
+            raise SimError("Unsupported checkpoint file '{0}': {1}".format(path, e))
+
+        if not isinstance(state, dict) or state.get("version") != checkpoint_version:
+            raise SimError("Unsupported checkpoint file '{0}'".format(path))
+
+        self.init_run()
+
+        runnables = list(self.iter_runnables())
+        if [r.id for r in runnables] != state["ids"]:
+            raise SimError(
+                "Checkpoint '{0}' was saved from a different model".format(path)
+            )
+        for runnable, runnable_state in zip(runnables, state["runnables"]):
+            runnable.set_state(runnable_state)
+
+        self.current_time = state["current_time"]
+        self.set_schedule(
+            [
+                RateGroup(ticks, [self.runnables[id] for id in ids], next_tick)
+                for ticks, next_tick, ids in state["schedule"]
+            ]
+        )
+
+        self.event_queue.set_state(state["event_queue"], self.delayed_fanouts)
+
+        random.setstate(state["random"])
+        if numpy and state["numpy_random"] is not None:
+            numpy.random.set_state(state["numpy_random"])
+
+        for recording in self.get_recordings():
+            recording.drop(len(recording))
+            recording.time_axis.drop(len(recording.time_axis))
+
+        self.restored = True
+
     def enable_plasticity(self):
         for id in self.runnables:
             self.runnables[id].plastic = True
+        self.reset_step_plans()
 
     def disable_plasticity(self):
         for id in self.runnables:
             self.runnables[id].plastic = False
+        self.reset_step_plans()
+
+    def reset_step_plans(self):
+        """
+        Rebuilds the step plans that have already been built.
+        """
+
+        for id in self.runnables:
+            if self.runnables[id].step_plan is not None:
+                self.runnables[id].init_step_plan()
 
     def dump_runnable(self, runnable, prefix="."):
         r = runnable
@@ -0,0 +1,355 @@
+"""
+Parameter sweeps: simulations of one resolved model for several sets of
+parameter values, run in parallel worker processes or as the trials of a
+single ensemble simulation.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from lems.base.errors import SimError
+from lems.sim.build import SimulationBuilder
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def find_component(model, component_id):
+    """
+    Finds a component of a resolved model by id, including child components.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param component_id: Id of the component.
+    :type component_id: string
+
+    :return: Fat component.
+    :rtype: lems.model.component.FatComponent
+
+    :raises SimError: Raised if there is no such component.
+    """
+
+    if component_id in model.fat_components:
+        return model.fat_components[component_id]
+
+    cq = list(model.fat_components)
+    while cq:
+        component = cq.pop(0)
+        if component.id == component_id:
+            return component
+        cq.extend(component.child_components)
+
+    raise SimError("Unable to find component '{0}'".format(component_id))
+
+
+def get_parameter(component, name):
+    """
+    Gets a parameter of a component.
+
+    :raises SimError: Raised if the parameter does not exist.
+    """
+
+    if name not in component.parameters:
+        raise SimError(
+            "Unable to find parameter '{0}' in component '{1}'".format(
+                name, component.id
+            )
+        )
+    return component.parameters[name]
+
+
+def get_numeric_value(model, parameter, value):
+    """
+    Converts a parameter value to a number in SI units.
+
+    :param value: Number in SI units or string with units, such as "-40mV".
+    :type value: float or string
+
+    :rtype: float
+    """
+
+    if isinstance(value, str):
+        return model.get_numeric_value(value, parameter.dimension)
+    else:
+        return float(value)
+
+
+def set_parameters(model, parameters):
+    """
+    Overrides parameter values of the components of a resolved model.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param parameters: New values by parameter name, by component id. Values
+    are numbers in SI units or strings with units, such as "-40mV".
+    :type parameters: dict(string, dict(string, float or string))
+
+    :return: Previous values, to be passed to restore_parameters.
+    :rtype: list((lems.model.component.Parameter, string, float))
+
+    :raises SimError: Raised if a component or parameter does not exist.
+    """
+
+    previous = []
+    try:
+        for component_id, values in parameters.items():
+            component = find_component(model, component_id)
+            for name, value in values.items():
+                parameter = get_parameter(component, name)
+                previous.append((parameter, parameter.value, parameter.numeric_value))
+
+                numeric_value = get_numeric_value(model, parameter, value)
+                parameter.value = str(value)
+                parameter.numeric_value = numeric_value
+    except BaseException:
+        restore_parameters(previous)
+        raise
+
+    return previous
+
+
+def restore_parameters(previous):
+    """
+    Restores parameter values overridden by set_parameters.
+
+    :param previous: Previous values returned by set_parameters.
+    :type previous: list((lems.model.component.Parameter, string, float))
+    """
+
+    for parameter, value, numeric_value in reversed(previous):
+        parameter.value = value
+        parameter.numeric_value = numeric_value
+
+
+def copy_buffer(view):
+    """
+    Copies a recording buffer view into an array owning its data.
+    """
+
+    if numpy is not None:
+        return numpy.array(view)
+    else:
+        return array("d", view)
+
+
+def simulate(model, parameters={}, vectorize=False, integrator="euler"):
+    """
+    Builds and runs the simulation of a resolved model with overridden
+    parameter values. The model is left unchanged.
+
+    Output files are not written; all recordings are returned instead.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param parameters: Parameter values, see set_parameters.
+    :type parameters: dict(string, dict(string, float or string))
+
+    :param vectorize: Simulate populations of simple components as arrays.
+    :type vectorize: Boolean
+
+    :param integrator: Method integrating time derivatives, see
+    lems.sim.integrators.integration_methods.
+    :type integrator: string
+
+    :return: Sample times and values (NumPy arrays if NumPy is installed) by
+    recorded quantity.
+    :rtype: dict(string, (numpy.ndarray, numpy.ndarray))
+    """
+
+    previous = set_parameters(model, parameters)
+    try:
+        sim = SimulationBuilder(
+            model, vectorize=vectorize, integrator=integrator
+        ).build()
+    finally:
+        restore_parameters(previous)
+
+    sim.run()
+
+    results = {}
+    for recording in sim.get_recordings():
+        results[recording.full_path] = (
+            copy_buffer(recording.get_times()),
+            copy_buffer(recording.get_values()),
+        )
+    return results
+
+
+sweep_model = None
+""" Resolved model simulated by the worker processes of a sweep. """
+
+sweep_vectorize = False
+""" Vectorization setting of the worker processes of a sweep. """
+
+sweep_integrator = "euler"
+""" Integration method of the worker processes of a sweep. """
+
+
+def init_worker(model, vectorize, integrator):
+    """
+    Initializes a sweep worker process. With the fork start method the
+    model is inherited from the parent process rather than pickled.
+    """
+
+    global sweep_model, sweep_vectorize, sweep_integrator
+    sweep_model = model
+    sweep_vectorize = vectorize
+    sweep_integrator = integrator
+
+
+def run_worker(parameters):
+    return simulate(sweep_model, parameters, sweep_vectorize, sweep_integrator)
+
+
+def run_sweep(
+    model, parameter_sets, processes=None, vectorize=False, integrator="euler"
+):
+    """
+    Simulates a resolved model once for each set of parameter values, in a
+    pool of worker processes.
+
+    The model is parsed and resolved only once, by the caller. Where the
+    platform supports it, workers are forked so that they share the
+    resolved model with the calling process; otherwise it is pickled once
+    per worker.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param parameter_sets: Parameter values for each simulation, see
+    set_parameters.
+    :type parameter_sets: list(dict(string, dict(string, float or string)))
+
+    :param processes: Number of worker processes. Defaults to the number of
+    CPUs. With a single process, simulations are run in the calling
+    process.
+    :type processes: int
+
+    :param vectorize: Simulate populations of simple components as arrays.
+    :type vectorize: Boolean
+
+    :param integrator: Method integrating time derivatives, see
+    lems.sim.integrators.integration_methods.
+    :type integrator: string
+
+    :return: Recordings of each simulation (see simulate), in the order of
+    the parameter sets.
+    :rtype: list(dict(string, (numpy.ndarray, numpy.ndarray)))
+    """
+
+    parameter_sets = list(parameter_sets)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(parameter_sets)))
+
+    if processes == 1:
+        return [simulate(model, p, vectorize, integrator) for p in parameter_sets]
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(model, vectorize, integrator),
+    ) as executor:
+        return list(executor.map(run_worker, parameter_sets))
+
+
+def set_trial_parameters(model, sim, trial, parameters):
+    """
+    Overrides parameter values in one trial of an ensemble simulation (see
+    lems.sim.build.SimulationBuilder). The values of all instances of the
+    components are set.
+
+    Parameters are only overridden in the dynamics: values used while
+    building the simulation, such as population sizes or connection delays,
+    are the same in all trials.
+
+    :param model: Resolved model the simulation was built from.
+    :type model: lems.model.model.Model
+
+    :param sim: Ensemble simulation.
+    :type sim: lems.sim.sim.Simulation
+
+    :param trial: Index of the trial.
+    :type trial: int
+
+    :param parameters: Parameter values, see set_parameters.
+    :type parameters: dict(string, dict(string, float or string))
+
+    :raises SimError: Raised if a component or parameter does not exist or
+    if a component is not simulated.
+    """
+
+    runnables = list(sim.iter_runnables())
+
+    for component_id, values in parameters.items():
+        component = find_component(model, component_id)
+        instances = [r for r in runnables if r.component.id == component_id]
+        if not instances:
+            raise SimError(
+                "Component '{0}' is not part of the simulation".format(component_id)
+            )
+
+        for name, value in values.items():
+            numeric_value = get_numeric_value(
+                model, get_parameter(component, name), value
+            )
+            for runnable in instances:
+                runnable.set_trial_value(name, trial, numeric_value)
+
+
+def run_ensemble(model, parameter_sets, integrator="euler"):
+    """
+    Simulates a resolved model once for each set of parameter values, as
+    the trials of a single ensemble simulation in the calling process. Each
+    step advances all trials at once.
+
+    :param model: Resolved model.
+    :type model: lems.model.model.Model
+
+    :param parameter_sets: Parameter values of each trial, see
+    set_trial_parameters.
+    :type parameter_sets: list(dict(string, dict(string, float or string)))
+
+    :param integrator: Method integrating time derivatives, see
+    lems.sim.integrators.integration_methods.
+    :type integrator: string
+
+    :return: Recordings of each trial, as returned by run_sweep.
+    :rtype: list(dict(string, (numpy.ndarray, numpy.ndarray)))
+    """
+
+    parameter_sets = list(parameter_sets)
+
+    sim = SimulationBuilder(
+        model, ensemble=len(parameter_sets), integrator=integrator
+    ).build()
+    for trial, parameters in enumerate(parameter_sets):
+        set_trial_parameters(model, sim, trial, parameters)
+
+    sim.run()
+
+    results = [{} for parameters in parameter_sets]
+    for recording in sim.get_recordings():
+        times = recording.get_times()
+        for trial, result in enumerate(results):
+            result[recording.full_path] = (
+                numpy.array(times),
+                numpy.array(recording.get_trial_values(trial)),
+            )
+    return results
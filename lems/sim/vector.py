@@ -0,0 +1,589 @@
+"""
+Vectorized (struct-of-arrays) runnable components.
+
+:author: PyLEMS authors and contributors
+:organization: LEMS (https://github.com/organizations/LEMS)
+"""
+
+import math
+from functools import partial
+
+from lems.base.base import LEMSBase
+from lems.base.errors import SimBuildError
+from lems.sim.events import PopulationFanout, EnsembleFanout
+from lems.sim.integrators import vector_exp_euler_factor
+from lems.sim.recording import Recording, EnsembleRecording
+from lems.sim.runnable import Runnable
+from lems.model.dynamics import OnStart, OnCondition, OnEvent
+from lems.model.dynamics import StateAssignment, EventOut
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def require_numpy():
+    """
+    Raises a SimBuildError if NumPy is not available.
+    """
+
+    if numpy is None:
+        raise SimBuildError("Vectorized simulation requires NumPy to be installed")
+
+
+def make_vector_namespace():
+    """
+    Builds the globals used by methods generated for vectorized runnables.
+
+    Mathematical functions are mapped onto their NumPy (element-wise)
+    equivalents so that the expressions generated by
+    lems.sim.build.SimulationBuilder.build_expression_from_tree can be
+    evaluated over whole arrays.
+
+    :return: Dictionary of names available to generated vector code.
+    :rtype: dict
+    """
+
+    require_numpy()
+
+    return {
+        "numpy": numpy,
+        "where": numpy.where,
+        "exp": numpy.exp,
+        "log": numpy.log,
+        "sqrt": numpy.sqrt,
+        "sin": numpy.sin,
+        "cos": numpy.cos,
+        "tan": numpy.tan,
+        "sinh": numpy.sinh,
+        "cosh": numpy.cosh,
+        "tanh": numpy.tanh,
+        "abs": numpy.abs,
+        "ceil": numpy.ceil,
+        "factorial": numpy.vectorize(math.factorial, otypes=[float]),
+        "heaviside_step": lambda x: numpy.heaviside(x, 0.5),
+        "exp_euler_factor": vector_exp_euler_factor,
+        "masked_errors": masked_errors,
+    }
+
+
+def masked_errors():
+    """
+    Ignores the floating point errors of a statement selecting values with
+    where: both sides are computed for all members, including those whose
+    values are discarded, such as the members not handling an event.
+
+    :rtype: numpy.errstate
+    """
+
+    return numpy.errstate(divide="ignore", over="ignore", invalid="ignore")
+
+
+def is_vectorizable(component):
+    """
+    Checks if all instances of a component can be simulated as a single
+    vectorized population.
+
+    Only flat components are supported: no children, structure, attachments,
+    requirements, regimes, kinetic schemes, select/reduce derived variables or
+    simulation specifications. Event handlers may only contain state
+    assignments and event outputs.
+
+    :param component: Component to be checked.
+    :type component: lems.model.component.FatComponent
+
+    :return: True if the component can be vectorized.
+    :rtype: Boolean
+    """
+
+    if (
+        component.child_components
+        or component.children
+        or component.attachments
+        or component.requirements
+        or component.component_requirements
+        or component.instance_requirements
+        or component.properties
+    ):
+        return False
+
+    structure = component.structure
+    if (
+        structure.child_instances
+        or structure.multi_instantiates
+        or structure.for_eachs
+        or structure.event_connections
+    ):
+        return False
+
+    simulation = component.simulation
+    if (
+        simulation.runs
+        or simulation.records
+        or simulation.event_records
+        or simulation.data_displays
+        or simulation.data_writers
+        or simulation.event_writers
+    ):
+        return False
+
+    dynamics = component.dynamics
+    if dynamics.regimes or dynamics.kinetic_schemes:
+        return False
+
+    for dv in dynamics.derived_variables:
+        if dv.select:
+            return False
+
+    for eh in dynamics.event_handlers:
+        if not isinstance(eh, (OnStart, OnCondition, OnEvent)):
+            return False
+        for action in eh.actions:
+            if not isinstance(action, (StateAssignment, EventOut)):
+                return False
+
+    return True
+
+
+class VectorRunnable(Runnable):
+    """
+    Runnable storing the state of a whole population of identical components
+    as NumPy arrays, one array per variable.
+
+    The generated methods operate on whole arrays, so each simulation step
+    costs a fixed number of Python calls regardless of the population size.
+    Variables which are uniform across the population may be held as
+    scalars, which NumPy broadcasts as needed.
+
+    Individual members are exposed through lems.sim.vector.InstanceView
+    objects, which are placed in the array of the parent runnable so that
+    paths such as pop[3]/v resolve as they do for scalar instances. Since
+    all members are stepped together, events emitted by a member are seen
+    by other members of the same population in the following step.
+    """
+
+    vectorized = True
+
+    method_globals = None
+
+    def __init__(self, id_, component, size, parent=None):
+        require_numpy()
+        if VectorRunnable.method_globals is None:
+            VectorRunnable.method_globals = make_vector_namespace()
+
+        Runnable.__init__(self, id_, component, parent)
+
+        self.size = size
+        """ Number of members in the population.
+
+        :type: int """
+
+        self.views = [InstanceView(self, i) for i in range(size)]
+        """ Per-member views onto the population state.
+
+        :type: list(lems.sim.vector.InstanceView) """
+
+        self.recorders = []
+        """ List of (member index, variable, recording) tuples.
+
+        :type: list((int, string, lems.sim.recording.Recording)) """
+
+    def __str__(self):
+        return "VectorRunnable, id: {0} ({1}, {2}), size: {3}, component: ({4})".format(
+            self.id, self.uid, id(self), self.size, self.component
+        )
+
+    def add_instance_variable(self, variable, initial_value):
+        self.instance_variables.append(variable)
+
+        value = numpy.full(self.size, initial_value, dtype=float)
+        self.__dict__[variable] = value
+        self.shadow[self.shadow_index(variable)] = value
+
+    def add_derived_variable(self, variable):
+        self.derived_variables.append(variable)
+
+        value = numpy.zeros(self.size)
+        self.__dict__[variable] = value
+        self.shadow[self.shadow_index(variable)] = value
+
+    def add_event_in_port(self, port):
+        self.event_in_ports.append(port)
+        if port not in self.event_in_counters:
+            self.event_in_counters[port] = numpy.zeros(self.size, dtype=int)
+
+    def add_event_out_port(self, port):
+        self.event_out_ports.append(port)
+        if port not in self.event_out_fanouts:
+            fanout = PopulationFanout(self.size)
+            self.event_out_fanouts[port] = fanout
+            for view in self.views:
+                view.event_out_callbacks[port] = fanout.callbacks[view.index]
+
+    def random_uniform(self, high):
+        """
+        Draws one uniform random number in [0, high) per member.
+        """
+
+        return numpy.random.uniform(0, high, self.size)
+
+    def emit(self, port, fired):
+        """
+        Delivers the events emitted by the members that fired.
+
+        :param port: Event out port.
+        :type port: string
+
+        :param fired: Boolean mask or per-member event counts.
+        :type fired: numpy.ndarray
+        """
+
+        self.event_out_fanouts[port](fired)
+
+    def get_state(self):
+        state = Runnable.get_state(self)
+        counters = dict((port, numpy.copy(c)) for port, c in state[4].items())
+        return state[:4] + (counters,) + state[5:]
+
+    def set_event_counters(self, counters):
+        # Counter arrays are shared with the fanouts delivering events.
+        for port in counters:
+            self.event_in_counters[port][:] = counters[port]
+
+    def build_step_plan(self, plan, clocks):
+        # The population advances its own time.
+        plan.append(partial(self.single_step, self.time_step))
+
+    def record_variables(self):
+        for index, variable, recording in self.recorders:
+            value = self.__dict__[variable]
+            if numpy.ndim(value):
+                value = value[index]
+            recording.add_value(self.time_completed, float(value))
+
+    def copy(self):
+        raise SimBuildError(
+            "Vectorized population '{0}' cannot be copied".format(self.id)
+        )
+
+
+class EnsembleRunnable(VectorRunnable):
+    """
+    Runnable simulating a number of independent trials of the same
+    component at once. Every variable holds one value per trial, so that a
+    single Python-level step advances all trials.
+
+    Unlike a vectorized population, an ensemble runnable takes the place of
+    a scalar runnable in the tree: it has children, arrays and attachments,
+    and its events are delivered to the same trial of the connected
+    runnables. Regimes are tracked per trial; the methods generated for a
+    regime only update the trials in that regime (see in_regime).
+    """
+
+    def __init__(self, id_, component, size, parent=None):
+        require_numpy()
+        if VectorRunnable.method_globals is None:
+            VectorRunnable.method_globals = make_vector_namespace()
+
+        Runnable.__init__(self, id_, component, parent)
+
+        self.size = size
+        """ Number of trials.
+
+        :type: int """
+
+        self.views = []
+        self.recorders = []
+
+        self.regime_names = []
+        """ Names of the regimes, by regime index.
+
+        :type: list(string) """
+
+        self.current_regime = numpy.full(size, -1)
+        self.new_regime = numpy.full(size, -1)
+        self.last_regime = numpy.full(size, -1)
+
+        self.in_regime = numpy.ones(size, dtype=bool)
+        """ Mask of the trials in the regime whose methods are running.
+
+        :type: numpy.ndarray """
+
+    def __str__(self):
+        return (
+            "EnsembleRunnable, id: {0} ({1}, {2}), size: {3}, component: ({4})"
+        ).format(self.id, self.uid, id(self), self.size, self.component)
+
+    def make_copy(self):
+        r = EnsembleRunnable(self.id, self.component, self.size, self.parent)
+        r.regime_names = self.regime_names
+        return r
+
+    copy = Runnable.copy
+
+    build_step_plan = Runnable.build_step_plan
+
+    record_variables = Runnable.record_variables
+
+    def add_event_out_port(self, port):
+        self.event_out_ports.append(port)
+        if port not in self.event_out_fanouts:
+            self.event_out_fanouts[port] = EnsembleFanout(self.size)
+            self.event_out_callbacks[port] = self.event_out_fanouts[port].callbacks
+
+    def add_variable_recorder2(self, data_output, recorder, path, full_path):
+        if "/" in path:
+            Runnable.add_variable_recorder2(
+                self, data_output, recorder, path, full_path
+            )
+        else:
+            self.recorded_variables.append(
+                EnsembleRecording(path, full_path, data_output, recorder, self.size)
+            )
+
+    def set_trial_value(self, variable, trial, value):
+        """
+        Sets the value of a variable in one trial.
+
+        :param variable: Variable name.
+        :type variable: string
+
+        :param trial: Index of the trial.
+        :type trial: int
+
+        :param value: New value.
+        :type value: float
+        """
+
+        # Copies of a runnable share their arrays, so write to a new one.
+        values = numpy.array(
+            numpy.broadcast_to(self.__dict__[variable], (self.size,)), dtype=float
+        )
+        values[trial] = value
+        self.__dict__[variable] = values
+        if variable in self.shadow_indices:
+            self.shadow[self.shadow_indices[variable]] = values
+
+    def regime_index(self, name):
+        """
+        Returns the index identifying a regime in the regime arrays,
+        allocating one if needed.
+
+        :param name: Regime name.
+        :type name: string
+
+        :return: Regime index.
+        :rtype: int
+        """
+
+        if name not in self.regime_names:
+            self.regime_names.append(name)
+        return self.regime_names.index(name)
+
+    def set_initial_regime(self, name):
+        index = self.regime_index(name)
+        self.current_regime = numpy.full(self.size, index)
+        self.new_regime = numpy.full(self.size, index)
+
+    def run_regimes(self, method_name, args, entered=None):
+        """
+        Runs a generated method of each regime for the trials in that
+        regime, then updates the shadow variables.
+
+        :param method_name: Name of the regime method.
+        :type method_name: string
+
+        :param args: Arguments following the runnable.
+        :type args: tuple
+
+        :param entered: Mask restricting the trials, if given.
+        :type entered: numpy.ndarray
+        """
+
+        for name, regime in self.regimes.items():
+            method = getattr(regime, method_name, None)
+            if method is None:
+                continue
+            in_regime = self.current_regime == self.regime_index(name)
+            if entered is not None:
+                in_regime &= entered
+            if in_regime.any():
+                self.in_regime = in_regime
+                method(self, *args)
+
+        self.update_shadow_variables()
+
+    def step_regime(self, dt):
+        self.run_regimes("run_preprocessing_event_handlers", ())
+        self.run_regimes("update_derived_variables", ())
+        self.run_regimes("update_state_variables", (dt,))
+        self.run_regimes("run_postprocessing_event_handlers", ())
+
+        entered = self.new_regime >= 0
+        if entered.any():
+            self.current_regime = numpy.where(
+                entered, self.new_regime, self.current_regime
+            )
+            self.new_regime = numpy.full(self.size, -1)
+            self.run_regimes("run_preprocessing_event_handlers", (), entered)
+
+
+class InstanceView(LEMSBase):
+    """
+    View onto a single member of a vectorized population.
+
+    Reading a variable returns the member's element of the population array.
+    The view otherwise behaves like a leaf runnable for path resolution,
+    recording and event connections; stepping is done by the population.
+    """
+
+    def __init__(self, population, index):
+        self.__dict__["population"] = population
+        self.__dict__["index"] = index
+        self.__dict__["id"] = "{0}{1}".format(population.id, index)
+        self.__dict__["parent"] = population.parent
+        self.__dict__["children"] = {}
+        self.__dict__["array"] = []
+        self.__dict__["recorded_variables"] = []
+        self.__dict__["event_out_callbacks"] = {}
+
+    def __str__(self):
+        return "InstanceView, id: {0}, index: {1} of {2}".format(
+            self.id, self.index, self.population.id
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __getattr__(self, name):
+        population = self.__dict__.get("population")
+        if population is None:
+            raise AttributeError(name)
+        value = getattr(population, name)
+        if (
+            name in population.instance_variables
+            or name in population.derived_variables
+        ) and numpy.ndim(value):
+            return value[self.__dict__["index"]]
+        return value
+
+    def __setattr__(self, name, value):
+        population = self.population
+        if (
+            name in population.instance_variables
+            or name in population.derived_variables
+        ):
+            # Generated code never modifies state arrays in place, so shadow
+            # values may alias them. Copy before writing a single element.
+            values = numpy.array(
+                numpy.broadcast_to(population.__dict__[name], (population.size,)),
+                dtype=float,
+            )
+            values[self.index] = value
+            population.__dict__[name] = values
+        else:
+            self.__dict__[name] = value
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+    def single_step(self, dt):
+        return dt
+
+    def do_startup(self):
+        pass
+
+    def configure_time(self, time_step, time_total):
+        pass
+
+    def reset_time(self):
+        pass
+
+    def push_state(self):
+        pass
+
+    def pop_state(self):
+        pass
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+    def record_variables(self):
+        pass
+
+    def build_step_plan(self, plan, clocks):
+        pass
+
+    def inc_event_in(self, port):
+        self.population.event_in_counters[port][self.index] += 1
+
+    def connect_event_out(self, port, runnable, remote_port, delay=0):
+        if port in self.population.event_out_fanouts:
+            self.population.event_out_fanouts[port].connect(
+                self.index, runnable, remote_port, delay
+            )
+        else:
+            raise SimBuildError(
+                "No event out port '{0}' in " "component '{1}'".format(port, self.id)
+            )
+
+    def register_event_out_callback(self, port, callback):
+        if port in self.event_out_callbacks:
+            self.event_out_callbacks[port].append(callback)
+        else:
+            raise SimBuildError(
+                "No event out port '{0}' in " "component '{1}'".format(port, self.id)
+            )
+
+    def resolve_path(self, path):
+        if path == "" or path == "this":
+            return self
+        elif path[0] == "/":
+            return self.parent.resolve_path(path)
+        elif path.find("../") == 0:
+            return self.parent.resolve_path(path[3:])
+        elif path.find("..") == 0 or path == "parent":
+            return self.parent
+        else:
+            raise SimBuildError(
+                "Unable to find child '{0}' in " "'{1}'".format(path, self.id)
+            )
+
+    def add_variable_recorder(self, data_output, recorder):
+        self.add_variable_recorder2(
+            data_output, recorder, recorder.quantity, recorder.quantity
+        )
+
+    def add_variable_recorder2(self, data_output, recorder, path, full_path):
+        if path[0] == "/":
+            self.parent.add_variable_recorder2(data_output, recorder, path, full_path)
+        elif path.find("../") == 0:
+            self.parent.add_variable_recorder2(
+                data_output, recorder, path[3:], full_path
+            )
+        elif path.find("/") >= 1:
+            raise SimBuildError(
+                "Unable to find a child '{0}' in " "'{1}'".format(path, self.id)
+            )
+        else:
+            recording = Recording(path, full_path, data_output, recorder)
+            self.recorded_variables.append(recording)
+            self.population.recorders.append((self.index, path, recording))
+
+    def add_child(self, id_, runnable):
+        raise SimBuildError(
+            "Cannot add child {0} to vectorized population member {1}".format(
+                runnable.id, self.id
+            )
+        )
+
+    def add_attachment(self, runnable, container=None):
+        raise SimBuildError(
+            "Cannot attach {0} to vectorized population member {1}".format(
+                runnable.id, self.id
+            )
+        )
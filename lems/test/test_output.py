@@ -0,0 +1,152 @@
+"""
+Tests for the writers saving recordings during a simulation.
+
+File: test_output.py
+
+Copyright 2023 LEMS contributors
+"""
+
+
+import unittest
+import os
+import tempfile
+
+from lems.model.simulation import DataWriter
+from lems.run import run
+from lems.sim.output import TextOutputWriter, get_output_format
+from lems.sim.output import NpyOutputWriter, NpzOutputWriter, HDF5OutputWriter
+from lems.sim.recording import Recording
+from lems.sim.runnable import Runnable
+from lems.sim.sim import Simulation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class OutputWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.dir.name, "out.dat")
+
+        self.data_writer = DataWriter(".", self.file_name)
+        self.sim = Simulation()
+        runnable = Runnable("r", None)
+        runnable.recorded_variables = [
+            Recording("u", "u", self.data_writer, None),
+            Recording("v", "v", self.data_writer, None),
+        ]
+        self.sim.add_runnable(runnable)
+        self.recordings = runnable.recorded_variables
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def record(self, writer, steps):
+        samples = []
+        time = 0
+        for i in range(steps):
+            samples.append((time, i, 0.5 * i))
+            self.recordings[0].add_value(time, i)
+            self.recordings[1].add_value(time, 0.5 * i)
+            writer.poll()
+            time += 0.25
+        return samples
+
+
+class TestTextOutputWriter(OutputWriterTestCase):
+
+    """Test streaming text output"""
+
+    def test_format(self):
+        writer = TextOutputWriter(self.data_writer, self.file_name, ["v", "u"], 4)
+        writer.open(self.sim)
+        samples = self.record(writer, 10)
+        writer.close()
+
+        expected = ""
+        for t, u, v in samples:
+            expected += "{0}   {1}   {2}   \n".format(t, v, u)
+        with open(self.file_name) as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(writer.rows_written, 10)
+
+    def test_bounded_buffers(self):
+        writer = TextOutputWriter(self.data_writer, self.file_name, ["u", "v"], 3)
+        writer.open(self.sim)
+        self.record(writer, 20)
+        for recording in self.recordings:
+            self.assertLess(len(recording), 3)
+        writer.close()
+        for recording in self.recordings:
+            self.assertEqual(len(recording), 0)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestBinaryOutputWriters(OutputWriterTestCase):
+
+    """Test binary output formats"""
+
+    def write(self, writer_class, file_name):
+        writer = writer_class(self.data_writer, file_name, ["v", "u"], 4)
+        writer.open(self.sim)
+        samples = self.record(writer, 10)
+        writer.close()
+        return numpy.array([(t, v, u) for t, u, v in samples])
+
+    def test_npy(self):
+        file_name = os.path.join(self.dir.name, "out.npy")
+        expected = self.write(NpyOutputWriter, file_name)
+        data = numpy.load(file_name, mmap_mode="r")
+        self.assertTrue(numpy.array_equal(data, expected))
+
+    def test_npz(self):
+        file_name = os.path.join(self.dir.name, "out.npz")
+        expected = self.write(NpzOutputWriter, file_name)
+        with numpy.load(file_name) as archive:
+            self.assertTrue(numpy.array_equal(archive["data"], expected))
+            self.assertEqual(list(archive["columns"]), ["t", "v", "u"])
+        self.assertEqual(os.listdir(self.dir.name), ["out.npz"])
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_hdf5(self):
+        file_name = os.path.join(self.dir.name, "out.h5")
+        expected = self.write(HDF5OutputWriter, file_name)
+        with h5py.File(file_name, "r") as f:
+            self.assertTrue(numpy.array_equal(f["data"][:], expected))
+
+    def test_format_selection(self):
+        self.assertEqual(get_output_format("a.dat"), ("text", "a.dat"))
+        self.assertEqual(get_output_format("a.npy"), ("npy", "a.npy"))
+        self.assertEqual(get_output_format("a.hdf5"), ("hdf5", "a.hdf5"))
+        self.assertEqual(get_output_format("a.dat", "npz"), ("npz", "a.npz"))
+        self.assertEqual(get_output_format("a.dat", "hdf5"), ("hdf5", "a.h5"))
+        self.assertEqual(get_output_format("a.npy", "text"), ("text", "a.npy"))
+
+    def test_forced_format(self):
+        # Files streamed in a forced format are not saved again as text.
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        cwd = os.getcwd()
+        os.chdir(self.dir.name)
+        try:
+            run(
+                os.path.join(test_dir, "../../examples/SimpleTest.xml"),
+                include_dirs=[os.path.join(test_dir, "NeuroML2CoreTypes")],
+                nogui=True,
+                format="npy",
+            )
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["simp.npy"])
+        data = numpy.load(os.path.join(self.dir.name, "simp.npy"))
+        self.assertEqual(data.shape, (5, 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
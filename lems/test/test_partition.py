@@ -0,0 +1,295 @@
+"""
+Tests for partitioned simulations.
+
+File: test_partition.py
+
+Copyright 2023 LEMS contributors
+"""
+
+
+import unittest
+import multiprocessing
+import os
+import socket
+import tempfile
+
+from lems.base.errors import SimError
+from lems.model.model import Model
+from lems.sim.build import SimulationBuilder
+from lems.sim.comm import Communicator, SocketCommunicator, route
+from lems.sim.partition import (
+    Partition,
+    assign_parts,
+    get_runs,
+    run_partitioned,
+    run_shard,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def load_network(delay, size=6):
+    """
+    Loads example 7 with delayed connections, a larger target population
+    and a recording of each of its members.
+    """
+
+    examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+    with open(examples + "/example7.xml") as f:
+        xml = f.read()
+    xml = xml.replace(
+        '<EventConnection from="a" to="b"/>',
+        '<EventConnection from="a" to="b" delay="delay"/>',
+    )
+    xml = xml.replace(
+        '<ComponentType name="AllAll" extends="ConnectionPattern">',
+        '<ComponentType name="AllAll" extends="ConnectionPattern">'
+        '<Parameter name="delay" dimension="time"/>',
+    )
+    xml = xml.replace(
+        '<Connections type="AllAll"/>',
+        '<Connections type="AllAll" delay="{0}"/>'.format(delay),
+    )
+    xml = xml.replace('iaf3cpt" size="3"', 'iaf3cpt" size="{0}"'.format(size))
+    lines = "".join(
+        '<Line id="v{0}" quantity="p3[{0}]/v" scale="1mV" timeScale="1ms" '
+        'color="#000000"/>'.format(i)
+        for i in range(1, size)
+    )
+    xml = xml.replace("</Display>", lines + "</Display>")
+
+    with tempfile.TemporaryDirectory() as d:
+        file_name = os.path.join(d, "example7_network.xml")
+        with open(file_name, "w") as f:
+            f.write(xml)
+        model = Model()
+        model.add_include_directory(examples)
+        model.import_from_file(file_name)
+    return model.resolve()
+
+
+def load_runs():
+    """
+    Loads a set of two simulations, each running a bouncing ball of
+    example bounce-conditional with its own time step.
+    """
+
+    examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+    with open(examples + "/bounce-conditional.xml") as f:
+        xml = f.read()
+    xml = xml[: xml.index('<ball id="ball"')]
+    xml = xml.replace('<Target component="sim"/>', '<Target component="set"/>')
+    xml += """
+    <ball id="ball1" fbounce="0.9" y0="5m" t1="5s" t2="10s"/>
+    <ball id="ball2" fbounce="0.7" y0="3m" t1="4s" t2="8s"/>
+    <Include file="MultiRunSimulation.xml"/>
+    <SimulationSet id="set">
+        <Display id="d1" title="Balls" xmin="0" xmax="20" ymin="-1" ymax="6"/>
+        <Simulation id="sim1" length="20s" step="0.01s" target="ball1" display="d1">
+            <DisplayList id="l1" title="Ball 1" timeScale="1s" display="d1">
+                <Line id="h1" quantity="height" scale="1m" timeScale="1s" color="#0000f0"/>
+            </DisplayList>
+        </Simulation>
+        <Simulation id="sim2" length="10s" step="0.005s" target="ball2" display="d1">
+            <DisplayList id="l2" title="Ball 2" timeScale="1s" display="d1">
+                <Line id="h2" quantity="height" scale="1m" timeScale="1s" color="#00f000"/>
+            </DisplayList>
+        </Simulation>
+    </SimulationSet>
+</Lems>
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        file_name = os.path.join(d, "runs.xml")
+        with open(file_name, "w") as f:
+            f.write(xml)
+        model = Model()
+        model.add_include_directory(examples)
+        model.import_from_file(file_name)
+    return model.resolve()
+
+
+def collect_recordings(sim):
+    return dict(
+        (r.full_path, (r.get_time_list(), r.get_value_list()))
+        for r in sim.get_recordings()
+    )
+
+
+def run_socket_shard(model, part, size, address, authkey):
+    communicator = SocketCommunicator(part, size, address, authkey)
+    try:
+        run_shard(model, communicator)
+    finally:
+        communicator.close()
+
+
+class FailingCommunicator(Communicator):
+    def fail(self, message):
+        self.message = message
+
+
+class TestPartition(unittest.TestCase):
+    """Test dividing simulations between processes"""
+
+    def test_assign_parts(self):
+        self.assertEqual(assign_parts([1, 1, 1, 1], 2), [0, 0, 1, 1])
+        self.assertEqual(assign_parts([10, 1, 1], 3), [0, 1, 2])
+        self.assertEqual(assign_parts([1, 1, 1, 10], 2), [0, 0, 0, 1])
+        self.assertEqual(assign_parts([5], 1), [0])
+
+    def test_delayed(self):
+        partition = Partition(SimulationBuilder(load_network("2ms")).build(), 3)
+        self.assertEqual(partition.size, 3)
+        # 2ms in steps of 0.05ms
+        self.assertEqual(partition.sync_steps, 40)
+        self.assertEqual(partition.owners, sorted(partition.owners))
+        self.assertEqual(
+            [unit.id for unit in partition.units[:3]],
+            ["p1__gen1__0", "p1__gen1__1", "p3__iaf3cpt__0"],
+        )
+
+    def test_zero_delay(self):
+        # Generators are stepped before the cells they send events to.
+        partition = Partition(SimulationBuilder(load_network("0ms")).build(), 3)
+        self.assertIsNone(partition.sync_steps)
+        self.assertEqual(len(set(partition.owners[:-1])), 1)
+
+    def test_same_results(self):
+        model = load_network("2ms")
+        sim = SimulationBuilder(model).build()
+        sim.run()
+
+        partitioned = run_partitioned(model, processes=3)
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+    def test_builder_options(self):
+        # The processes build their parts with all options, such as compact.
+        model = load_network("2ms")
+        options = {"compact": True, "integrator": "rk4"}
+        sim = SimulationBuilder(model, **options).build()
+        sim.run()
+
+        partitioned = run_partitioned(model, processes=3, options=options)
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+    def test_independent_runs(self):
+        sim = SimulationBuilder(load_runs()).build()
+        self.assertEqual([r.id for r in get_runs(sim)], ["ball1_sim1", "ball2_sim2"])
+
+        partition = Partition(sim, 4, independent=True)
+        self.assertEqual(partition.size, 2)
+        self.assertIsNone(partition.sync_steps)
+        # Each ball is kept with the simulation component running it.
+        owners = dict(
+            (unit.id, owner) for (unit, owner) in zip(partition.units, partition.owners)
+        )
+        self.assertEqual(owners["ball1_sim1"], owners["sim1"])
+        self.assertEqual(owners["ball2_sim2"], owners["sim2"])
+        self.assertNotEqual(owners["sim1"], owners["sim2"])
+
+    def test_independent_network(self):
+        # All cells of the network exchange events.
+        sim = SimulationBuilder(load_network("2ms")).build()
+        self.assertEqual(Partition(sim, 3, independent=True).size, 1)
+
+    def test_runs_same_results(self):
+        model = load_runs()
+        sim = SimulationBuilder(model).build()
+        sim.run()
+
+        partitioned = run_partitioned(model, processes=2, independent=True)
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_vectorized(self):
+        model = load_network("1ms")
+        sim = SimulationBuilder(model, vectorize=True).build()
+        sim.run()
+
+        partitioned = run_partitioned(model, processes=2, options={"vectorize": True})
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+
+@unittest.skipIf(
+    "fork" not in multiprocessing.get_all_start_methods(),
+    "Processes cannot be forked",
+)
+class TestSocketCommunicator(unittest.TestCase):
+    """Test running the parts of a simulation connected by sockets"""
+
+    def run_shards(self, model, size, address):
+        communicator = SocketCommunicator(0, size, address)
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(
+                target=run_socket_shard,
+                args=(
+                    model,
+                    part,
+                    size,
+                    communicator.address,
+                    communicator.authkey,
+                ),
+            )
+            for part in range(1, size)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            return run_shard(model, communicator)
+        finally:
+            communicator.close()
+            for worker in workers:
+                worker.join()
+
+    def test_route(self):
+        messages = [
+            ([[], [(1, 0, 2)], [(1, 1, 1)]], True),
+            ([[(3, 2, 1)], [], [(2, 1, 1)]], False),
+            ([[], [], []], True),
+        ]
+        self.assertEqual(
+            route(messages),
+            [
+                ([(3, 2, 1)], False),
+                ([(1, 0, 2)], False),
+                ([(1, 1, 1), (2, 1, 1)], False),
+            ],
+        )
+
+    def test_tcp(self):
+        model = load_network("2ms")
+        sim = SimulationBuilder(model).build()
+        sim.run()
+
+        partitioned = self.run_shards(model, 3, ("localhost", 0))
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+    @unittest.skipIf(not hasattr(socket, "AF_UNIX"), "Unix sockets are not available")
+    def test_unix(self):
+        model = load_network("1ms")
+        sim = SimulationBuilder(model).build()
+        sim.run()
+
+        with tempfile.TemporaryDirectory() as d:
+            partitioned = self.run_shards(model, 2, os.path.join(d, "socket"))
+        self.assertEqual(collect_recordings(partitioned), collect_recordings(sim))
+
+    def test_authkey_required(self):
+        self.assertRaises(SimError, SocketCommunicator, 1, 2, ("localhost", 0))
+
+    def test_cannot_divide(self):
+        # Without delays, the network is stepped by one part, and the
+        # other components by another.
+        communicator = FailingCommunicator(0, 3)
+        with self.assertRaises(SimError):
+            run_shard(load_network("0ms"), communicator)
+        self.assertIn("cannot be divided", communicator.message)
+
+
+if __name__ == "__main__":
+    unittest.main()
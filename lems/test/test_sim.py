@@ -0,0 +1,889 @@
+"""
+Simulation engine tests.
+
+File: test_sim.py
+
+Copyright 2023 LEMS contributors
+"""
+
+import unittest
+import os
+import math
+import pickle
+import tempfile
+import sys
+import tracemalloc
+from fractions import Fraction
+
+from lems.base.errors import SimBuildError, SimError
+from lems.model.model import Model
+from lems.sim.build import SimulationBuilder
+from lems.sim.runnable import Prototype, Reflective, Runnable
+from lems.sim.recording import Recording
+from lems.sim.events import EventFanout, EventQueue
+from lems.sim.integrators import exp_euler_factor
+from lems.sim.reduction import Reduction
+from lems.sim.vector import VectorRunnable
+from lems.sim.sim import Simulation, checkpoint_version, get_tick_base
+from lems.parser.expr import ExprParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def load_example(file_name):
+    model = Model()
+    model.import_from_file(
+        os.path.dirname(os.path.abspath(__file__)) + "/../../examples/" + file_name
+    )
+    return model.resolve()
+
+
+def load_delayed_example(delay):
+    examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+    with open(examples + "/example7.xml") as f:
+        xml = f.read()
+    xml = xml.replace(
+        '<EventConnection from="a" to="b"/>',
+        '<EventConnection from="a" to="b" delay="delay"/>',
+    )
+    xml = xml.replace(
+        '<ComponentType name="AllAll" extends="ConnectionPattern">',
+        '<ComponentType name="AllAll" extends="ConnectionPattern">'
+        '<Parameter name="delay" dimension="time"/>',
+    )
+    xml = xml.replace(
+        '<Connections type="AllAll"/>',
+        '<Connections type="AllAll" delay="{0}"/>'.format(delay),
+    )
+
+    with tempfile.TemporaryDirectory() as d:
+        file_name = os.path.join(d, "example7_delay.xml")
+        with open(file_name, "w") as f:
+            f.write(xml)
+        model = Model()
+        model.add_include_directory(examples)
+        model.import_from_file(file_name)
+    return model.resolve()
+
+
+oscillator_model = """
+<Lems>
+    <Target component="sim1"/>
+    <Dimension name="time" t="1"/>
+    <Dimension name="per_time" t="-1"/>
+    <ComponentType name="Oscillator">
+        <Parameter name="k" dimension="per_time"/>
+        <Parameter name="inf" dimension="none"/>
+        <Dynamics>
+            <StateVariable name="x" dimension="none"/>
+            <StateVariable name="y" dimension="none"/>
+            <StateVariable name="q" dimension="none"/>
+            <OnStart>
+                <StateAssignment variable="x" value="1"/>
+            </OnStart>
+            <TimeDerivative variable="x" value="-k * y"/>
+            <TimeDerivative variable="y" value="k * x"/>
+            <TimeDerivative variable="q" value="(inf - q) * k"/>
+            <DerivedVariable name="energy" dimension="none" value="x * x + y * y"/>
+        </Dynamics>
+    </ComponentType>
+    <ComponentType name="Simulation">
+        <Parameter name="length" dimension="time"/>
+        <Parameter name="step" dimension="time"/>
+        <ComponentReference name="target" type="Component"/>
+        <Dynamics>
+            <StateVariable name="t" dimension="time"/>
+        </Dynamics>
+        <Simulation>
+            <Run component="target" variable="t" increment="step" total="length"/>
+        </Simulation>
+    </ComponentType>
+    <Oscillator id="osc" k="1000" inf="0.5"/>
+    <Simulation id="sim1" length="{0}" step="{1}" target="osc"/>
+</Lems>
+"""
+
+
+def load_oscillator(length, step):
+    with tempfile.TemporaryDirectory() as d:
+        file_name = os.path.join(d, "oscillator.xml")
+        with open(file_name, "w") as f:
+            f.write(oscillator_model.format(length, step))
+        model = Model()
+        model.import_from_file(file_name)
+    return model.resolve()
+
+
+def collect_recordings(sim):
+    recordings = {}
+    rq = list(sim.runnables.values())
+    while rq:
+        runnable = rq.pop(0)
+        rq.extend(runnable.children.values())
+        rq.extend(runnable.array)
+        for recording in runnable.recorded_variables:
+            recordings[recording.full_path] = list(recording.values)
+    return recordings
+
+
+class TestKernelCache(unittest.TestCase):
+    """Test sharing of compiled generated methods between runnables"""
+
+    def setUp(self):
+        Reflective.clear_kernel_cache()
+
+    def test_methods_shared(self):
+        SimulationBuilder(load_example("example7.xml")).build()
+        info = Reflective.kernel_cache_info()
+        self.assertGreater(info["misses"], 0)
+        self.assertEqual(info["size"], info["misses"])
+
+        # Building the same model again compiles nothing new
+        SimulationBuilder(load_example("example7.xml")).build()
+        again = Reflective.kernel_cache_info()
+        self.assertEqual(again["misses"], info["misses"])
+        self.assertEqual(again["hits"] - info["hits"], info["misses"] + info["hits"])
+
+    def test_bounded(self):
+        size = Reflective.kernel_cache_size
+        Reflective.kernel_cache_size = 2
+        try:
+            sim = SimulationBuilder(load_example("example7.xml")).build()
+            self.assertEqual(Reflective.kernel_cache_info()["size"], 2)
+            sim.run()
+        finally:
+            Reflective.kernel_cache_size = size
+
+    def test_globals(self):
+        # Methods compiled against other globals are not reused.
+        SimulationBuilder(load_example("example7.xml")).build()
+        misses = Reflective.kernel_cache_info()["misses"]
+        Reflective.method_globals = dict(vars(sys.modules[Reflective.__module__]))
+        try:
+            SimulationBuilder(load_example("example7.xml")).build()
+        finally:
+            Reflective.method_globals = None
+        self.assertEqual(Reflective.kernel_cache_info()["misses"], 2 * misses)
+
+    def test_clear(self):
+        SimulationBuilder(load_example("example7.xml")).build()
+        Reflective.clear_kernel_cache()
+        self.assertEqual(
+            Reflective.kernel_cache_info(), {"hits": 0, "misses": 0, "size": 0}
+        )
+
+
+class TestStepPlan(unittest.TestCase):
+    """Test stepping runnables with flat step plans"""
+
+    def run_example(self, file_name, use_step_plan):
+        sim = SimulationBuilder(load_example(file_name)).build()
+        sim.use_step_plan = use_step_plan
+        sim.run()
+        return sim
+
+    def test_same_results(self):
+        for file_name in ["example2.xml", "example6.xml", "bounce-conditional.xml"]:
+            planned = self.run_example(file_name, True)
+            for runnable in planned.runnables.values():
+                self.assertTrue(runnable.step_plan)
+            recursive = self.run_example(file_name, False)
+            self.assertEqual(collect_recordings(planned), collect_recordings(recursive))
+
+
+class TestShadowBuffer(unittest.TestCase):
+    """Test the shadow buffers of runnables"""
+
+    def test_shadow_follows_state(self):
+        sim = SimulationBuilder(load_example("example6.xml")).build()
+        sim.init_run()
+        for i in range(10):
+            sim.step()
+
+        rq = list(sim.runnables.values())
+        checked = 0
+        while rq:
+            runnable = rq.pop(0)
+            rq.extend(runnable.uchildren.values())
+            rq.extend(runnable.array)
+            for variable in runnable.instance_variables:
+                index = runnable.shadow_indices[variable]
+                self.assertEqual(runnable.shadow[index], getattr(runnable, variable))
+                checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_push_pop_state(self):
+        sim = SimulationBuilder(load_example("example6.xml")).build()
+        sim.init_run()
+        sim.step()
+        rq = list(sim.runnables.values())
+        runnable = rq.pop(0)
+        while not runnable.instance_variables:
+            rq.extend(runnable.uchildren.values())
+            rq.extend(runnable.array)
+            runnable = rq.pop(0)
+        sim.push_state()
+        state = [getattr(runnable, v) for v in runnable.instance_variables]
+        shadow = list(runnable.shadow)
+        for i in range(10):
+            sim.step()
+        sim.pop_state()
+        self.assertEqual(
+            state, [getattr(runnable, v) for v in runnable.instance_variables]
+        )
+        self.assertEqual(shadow, runnable.shadow)
+
+
+class TestEventConnections(unittest.TestCase):
+    """Test event connections between runnables"""
+
+    def test_all_to_all(self):
+        sim = SimulationBuilder(load_example("example7.xml")).build()
+        sources = []
+        targets = set()
+        rq = list(sim.runnables.values())
+        while rq:
+            runnable = rq.pop(0)
+            rq.extend(runnable.uchildren.values())
+            rq.extend(runnable.array)
+            if runnable.id.startswith("p1__"):
+                sources.append(runnable)
+            elif runnable.id.startswith("p3__"):
+                targets.add(runnable)
+
+        self.assertEqual(len(sources), 2)
+        self.assertEqual(len(targets), 3)
+        for source in sources:
+            fanout = source.event_out_fanouts["a"]
+            self.assertEqual(set(link[0] for link in fanout.links), targets)
+            self.assertEqual(len(fanout.links), 3)
+
+    def test_delivery(self):
+        source = Runnable("s", None)
+        source.add_event_out_port("out")
+        targets = [Runnable("t{0}".format(i), None) for i in range(3)]
+        for target in targets:
+            target.add_event_in_port("in")
+            source.connect_event_out("out", target, "in")
+        source.connect_event_out("out", targets[0], "in")
+
+        source.event_out_fanouts["out"]()
+        source.event_out_fanouts["out"]()
+        self.assertEqual([t.event_in_counters["in"] for t in targets], [4, 2, 2])
+
+        source.register_event_out_callback("out", lambda: targets[1].inc_event_in("in"))
+        source.event_out_fanouts["out"]()
+        self.assertEqual([t.event_in_counters["in"] for t in targets], [6, 4, 3])
+
+
+class TestEventQueue(unittest.TestCase):
+    """Test delayed event delivery"""
+
+    def get_spike_steps(self, model):
+        sim = SimulationBuilder(model).build()
+        sim.run()
+        values = [v for t, v in collect_recordings(sim)["p3[0]/v"]]
+        return [i for i in range(1, len(values)) if values[i] - values[i - 1] > 0.01]
+
+    def test_delay(self):
+        immediate = self.get_spike_steps(load_example("example7.xml"))
+        delayed = self.get_spike_steps(load_delayed_example("2ms"))
+        self.assertTrue(immediate)
+        # Step of 0.05ms
+        self.assertEqual(delayed, [i + 40 for i in immediate])
+
+    def test_batching(self):
+        target = Runnable("t", None)
+        target.add_event_in_port("in")
+        queue = EventQueue()
+        queue.reset(0.1)
+        fanout = EventFanout()
+        fanout.connect(target, "in", 0.3)
+        fanout.set_queue(queue)
+
+        fanout()
+        queue.advance(0.1)
+        fanout()
+        fanout()
+        self.assertEqual(len(queue.slots[3]), 1)
+        queue.advance(0.3)
+        self.assertEqual(target.event_in_counters["in"], 1)
+        queue.advance(0.4)
+        self.assertEqual(target.event_in_counters["in"], 3)
+        self.assertEqual(queue.pending, 0)
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Test saving and restoring simulation checkpoints"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.dir.name, "checkpoint")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assert_resumes(self, load, steps):
+        sim = SimulationBuilder(load()).build()
+        sim.init_run()
+        for i in range(steps):
+            sim.step()
+        sim.save_checkpoint(self.file_name)
+        while sim.step():
+            pass
+
+        restored = SimulationBuilder(load()).build()
+        restored.load_checkpoint(self.file_name)
+        restored.run()
+
+        full = collect_recordings(sim)
+        resumed = collect_recordings(restored)
+        self.assertEqual(set(full), set(resumed))
+        for path in full:
+            self.assertEqual(len(full[path]), len(resumed[path]) + steps)
+            self.assertEqual(full[path][steps:], resumed[path])
+
+    def test_resume(self):
+        for file_name in ["example2.xml", "bounce-conditional.xml"]:
+            self.assert_resumes(lambda: load_example(file_name), 137)
+
+    def test_pending_events(self):
+        # Spikes sent at step 599 are delivered 40 steps later
+        self.assert_resumes(lambda: load_delayed_example("2ms"), 610)
+
+    def test_different_model(self):
+        sim = SimulationBuilder(load_example("example2.xml")).build()
+        sim.init_run()
+        sim.save_checkpoint(self.file_name)
+        other = SimulationBuilder(load_example("example6.xml")).build()
+        self.assertRaises(SimError, other.load_checkpoint, self.file_name)
+
+    def test_not_checkpoint(self):
+        # Checkpoints are plain JSON, never unpickled.
+        with open(self.file_name, "wb") as f:
+            pickle.dump({"version": checkpoint_version}, f)
+        sim = SimulationBuilder(load_example("example2.xml")).build()
+        self.assertRaises(SimError, sim.load_checkpoint, self.file_name)
+
+
+class TestScheduler(unittest.TestCase):
+    """Test stepping runnables with different time steps"""
+
+    def build(self, time_steps, time_total):
+        sim = Simulation()
+        for i, time_step in enumerate(time_steps):
+            runnable = Runnable("r{0}".format(i), None)
+            runnable.configure_time(time_step, time_total)
+            sim.add_runnable(runnable)
+        return sim
+
+    def run_steps(self, sim):
+        sim.init_run()
+        steps = []
+        running = True
+        while running:
+            before = dict((r.id, r.time_completed) for r in sim.runnables.values())
+            running = sim.step()
+            steps.append(
+                sorted(
+                    r.id
+                    for r in sim.runnables.values()
+                    if r.time_completed != before[r.id]
+                )
+            )
+        return steps
+
+    def test_tick_base(self):
+        self.assertEqual(get_tick_base([0.1, 0.25]), Fraction(1, 20))
+        self.assertEqual(get_tick_base([5e-05, 0.0001]), Fraction(1, 20000))
+        self.assertEqual(get_tick_base([0.3]), Fraction(3, 10))
+
+    def test_single_rate(self):
+        sim = self.build([0.1, 0.1], 1.0)
+        steps = self.run_steps(sim)
+        self.assertEqual(steps, [["r0", "r1"]] * len(steps))
+        self.assertEqual(sim.run_queue, [])
+        self.assertAlmostEqual(sim.current_time, 0.1 * (len(steps) - 1))
+
+    def test_simultaneous_steps(self):
+        # 0.1 + 0.1 + 0.1 != 0.3, but the runnables are stepped together.
+        sim = self.build([0.1, 0.3], 0.6)
+        steps = self.run_steps(sim)
+        self.assertEqual(steps[0], ["r0", "r1"])
+        self.assertEqual(steps[1:3], [["r0"], ["r0"]])
+        self.assertEqual(steps[3], ["r0", "r1"])
+        self.assertAlmostEqual(sim.current_time, 0.1 * (len(steps) - 1))
+
+
+class TestIncrementalRun(unittest.TestCase):
+    """Test running simulations in several calls"""
+
+    def test_run_until(self):
+        model = load_delayed_example("2ms")
+        full = SimulationBuilder(model).build()
+        full.run()
+
+        sim = SimulationBuilder(model).build()
+        self.assertTrue(sim.run_until(0.01))
+        self.assertEqual(sim.current_time, 0.01)
+        self.assertTrue(sim.run_for(0.005))
+        self.assertTrue(sim.run_for(0.005))
+        self.assertEqual(sim.current_time, 0.02)
+        self.assertFalse(sim.run_until(1))
+        self.assertFalse(sim.started)
+        self.assertEqual(collect_recordings(sim), collect_recordings(full))
+
+    def test_exact_times(self):
+        # 0.1 + 0.1 + 0.1 > 0.3, but the step at 0.3 is made.
+        sim = TestScheduler().build([0.1, 0.3], 0.6)
+        sim.run_until(0.3)
+        self.assertEqual(sim.current_time, 0.3)
+        sim.run_for(0.2)
+        self.assertEqual(sim.current_time, 0.5)
+
+    def test_iter_steps(self):
+        model = load_delayed_example("2ms")
+        full = SimulationBuilder(model).build()
+        full.run()
+        recordings = collect_recordings(full)
+
+        sim = SimulationBuilder(model).build()
+        snapshots = list(sim.iter_steps(every=100, variables=["p3[0]/v", "sim1/t"]))
+        # 1601 steps, the last one included
+        self.assertEqual(len(snapshots), 17)
+        (time, values) = snapshots[2]
+        self.assertAlmostEqual(time, 299 * 5e-05)
+        self.assertEqual(values[0], recordings["p3[0]/v"][299][1])
+        self.assertEqual(snapshots[-1][1][0], recordings["p3[0]/v"][-1][1])
+        self.assertEqual(collect_recordings(sim), recordings)
+
+    def test_stop_early(self):
+        model = load_delayed_example("2ms")
+        full = SimulationBuilder(model).build()
+        full.run()
+
+        sim = SimulationBuilder(model).build()
+        for (time, values) in sim.iter_steps(keep_recordings=False):
+            if time >= 0.01:
+                break
+        self.assertTrue(sim.started)
+        self.assertEqual(len(sim.get_recordings()[0]), 0)
+        sim.run()
+        self.assertEqual(
+            collect_recordings(sim)["p3[0]/v"],
+            collect_recordings(full)["p3[0]/v"][201:],
+        )
+
+    def test_unknown_variable(self):
+        sim = SimulationBuilder(load_delayed_example("2ms")).build()
+        self.assertRaises(SimError, next, sim.iter_steps(variables=["p3[0]/w"]))
+
+    def test_unrecorded_derived_variable(self):
+        # The time since the last spike of the generators is not recorded.
+        model = load_example("example2.xml")
+        sim = SimulationBuilder(model).build()
+        snapshots = list(sim.iter_steps(every=2000, variables=["p2[0]/tsince"]))
+        self.assertAlmostEqual(snapshots[1][1][0], 0.00799, 5)
+
+        sim = SimulationBuilder(model, demand_driven=True).build()
+        self.assertRaises(SimError, next, sim.iter_steps(variables=["p2[0]/tsince"]))
+
+
+class TestIntegrators(unittest.TestCase):
+    """Test the methods integrating time derivatives"""
+
+    def get_errors(self, integrator, step, length=0.002):
+        # Rounding can add a step: errors are computed at the time reached.
+        sim = SimulationBuilder(
+            load_oscillator(length, step), integrator=integrator
+        ).build()
+        sim.run()
+        osc = sim.runnables["osc_sim1"]
+        t = osc.time_completed
+        return (
+            abs(osc.x - math.cos(1000 * t)),
+            abs(osc.q - 0.5 * (1 - math.exp(-1000 * t))),
+        )
+
+    def test_unknown_method(self):
+        self.assertRaises(
+            SimBuildError,
+            SimulationBuilder,
+            load_oscillator(0.001, 0.0001),
+            integrator="euler2",
+        )
+
+    def test_exp_euler_factor(self):
+        self.assertEqual(exp_euler_factor(0), 1.0)
+        self.assertAlmostEqual(exp_euler_factor(-1e-9), 1.0)
+        self.assertAlmostEqual(exp_euler_factor(-2.0), (1 - math.exp(-2.0)) / 2.0)
+
+    def test_exponential_euler(self):
+        # Exact for time derivatives linear in their variable
+        euler_x, euler_q = self.get_errors("euler", 0.001)
+        x, q = self.get_errors("expeuler", 0.001)
+        self.assertGreater(euler_q, 0.01)
+        self.assertLess(q, 1e-12)
+        self.assertEqual(x, euler_x)
+
+    def test_order(self):
+        for integrator, order in [("euler", 1), ("rk2", 2), ("rk4", 4)]:
+            coarse = self.get_errors(integrator, 0.0001)[0]
+            fine = self.get_errors(integrator, 0.00005)[0]
+            self.assertGreater(coarse / fine, 0.8 * 2**order)
+
+        self.assertLess(self.get_errors("rk4", 0.0001)[0], 1e-5)
+
+    def test_events(self):
+        for file_name in ["example3.xml", "example7.xml"]:
+            model = load_example(file_name)
+            paths = set(collect_recordings(SimulationBuilder(model).build()))
+            results = []
+            for use_step_plan in [True, False]:
+                sim = SimulationBuilder(model, integrator="rk4").build()
+                sim.use_step_plan = use_step_plan
+                sim.run()
+                results.append(collect_recordings(sim))
+                self.assertEqual(set(results[-1]), paths)
+            self.assertEqual(results[0], results[1])
+
+
+class TestDemandDriven(unittest.TestCase):
+    """Test computing only the derived variables that are read"""
+
+    def test_same_results(self):
+        for file_name in ["example2.xml", "example6.xml", "example7.xml"]:
+            model = load_example(file_name)
+            results = []
+            for demand_driven in [True, False]:
+                sim = SimulationBuilder(model, demand_driven=demand_driven).build()
+                sim.run()
+                results.append(collect_recordings(sim))
+            self.assertEqual(results[0], results[1])
+
+    def test_unread_variable(self):
+        # The energy of the oscillator is never read
+        model = load_oscillator(0.001, 0.0001)
+        for demand_driven in [True, False]:
+            sim = SimulationBuilder(model, demand_driven=demand_driven).build()
+            sim.run()
+            osc = sim.runnables["osc_sim1"]
+            if demand_driven:
+                self.assertEqual(osc.energy, 0)
+            else:
+                self.assertGreater(osc.energy, 1)
+
+    def test_default(self):
+        # Only enabled by default when pruning, which requires it.
+        model = load_oscillator(0.001, 0.0001)
+        self.assertFalse(SimulationBuilder(model).demand_driven)
+        self.assertTrue(SimulationBuilder(model, prune=True).demand_driven)
+
+
+class TestPruning(unittest.TestCase):
+    """Test removing runnables which cannot affect any recording"""
+
+    def test_same_results(self):
+        for file_name in ["example2.xml", "example3.xml", "example7.xml"]:
+            model = load_example(file_name)
+            pruned = SimulationBuilder(model, prune=True).build()
+            pruned.run()
+            full = SimulationBuilder(model).build()
+            full.run()
+            self.assertEqual(collect_recordings(pruned), collect_recordings(full))
+            self.assertLess(
+                len(list(pruned.iter_runnables())), len(list(full.iter_runnables()))
+            )
+
+    def test_report(self):
+        # Only the first cell of p3 is recorded; the others receive events
+        # from p1 but do not affect it.
+        builder = SimulationBuilder(load_example("example7.xml"), prune=True)
+        sim = builder.build()
+        report = builder.pruning_report
+        self.assertIn("sim1.net1_sim1.p3.p3__iaf3cpt__1", report.runnables)
+        self.assertIn("sim1.net1_sim1.p3.p3__iaf3cpt__2", report.runnables)
+        self.assertNotIn("sim1.net1_sim1.p3.p3__iaf3cpt__0", report.runnables)
+        self.assertEqual(report.event_connections, 4)
+        self.assertIn("sim1.d0", str(report))
+
+        ids = set(r.id for r in sim.iter_runnables())
+        self.assertIn("p3__iaf3cpt__0", ids)
+        self.assertNotIn("p3__iaf3cpt__1", ids)
+
+    def test_requires_demand_driven(self):
+        self.assertRaises(
+            SimBuildError,
+            SimulationBuilder,
+            load_example("example7.xml"),
+            demand_driven=False,
+            prune=True,
+        )
+
+
+class TestExpressionOptimization(unittest.TestCase):
+    """Test inlining, folding and sharing subexpressions in generated code"""
+
+    def build(self, expression, inline_parameters=True):
+        builder = SimulationBuilder(
+            load_oscillator(0.001, 0.0001), inline_parameters=inline_parameters
+        )
+        sim = builder.build()
+        osc = sim.runnables["osc_sim1"]
+        tree = ExprParser(expression).parse()
+        code = builder.build_expression_from_tree(osc, osc.component.dynamics, tree)
+        return (code, osc)
+
+    def test_folding(self):
+        code, osc = self.build("2 * 3 * k + x")
+        self.assertEqual(
+            code, "6000.0 + self.shadow[{0}]".format(osc.shadow_index("x"))
+        )
+        code, osc = self.build("-(2 * k)")
+        self.assertEqual(code, "-2000.0")
+
+        code, osc = self.build("2 * 3 * k + x", inline_parameters=False)
+        self.assertIn("self.shadow[{0}]".format(osc.shadow_index("k")), code)
+
+    def test_default(self):
+        # Parameters may be changed after building unless inlined.
+        model = load_oscillator(0.001, 0.0001)
+        self.assertFalse(SimulationBuilder(model).inline_parameters)
+
+    def test_common_subexpressions(self):
+        code, osc = self.build("-(x + y) * (x + y) ^ 2")
+        self.assertEqual(code.count("+"), 1)
+        self.assertNotIn("0 -", code)
+        osc.shadow[osc.shadow_index("x")] = 0.5
+        osc.shadow[osc.shadow_index("y")] = 1.5
+        self.assertEqual(eval(code, {"self": osc}), -8.0)
+
+    def test_bytecode(self):
+        def get_length(inline_parameters):
+            sim = SimulationBuilder(
+                load_oscillator(0.001, 0.0001), inline_parameters=inline_parameters
+            ).build()
+            sim.run()
+            osc = sim.runnables["osc_sim1"]
+            return (len(osc.update_state_variables.__code__.co_code), osc.x, osc.q)
+
+        inlined, x, q = get_length(True)
+        loaded, x2, q2 = get_length(False)
+        self.assertLess(inlined, loaded)
+        self.assertEqual((x, q), (x2, q2))
+
+
+class TestRequiredVariables(unittest.TestCase):
+    """Test reading required variables through direct references"""
+
+    def test_direct_reference(self):
+        # The rates of the gates read the membrane potential of the cell,
+        # four levels up
+        sim = SimulationBuilder(load_example("example2.xml")).build()
+        rates = [r for r in sim.iter_runnables() if r.required_variables]
+        self.assertTrue(rates)
+        for rate in rates:
+            self.assertEqual(rate.required_variables, {"v": 4})
+            self.assertIs(rate._required_v, rate.parent.parent.parent.parent)
+            code = rate.update_derived_variables.__code__
+            self.assertNotIn("parent", code.co_names)
+
+
+class TestReduction(unittest.TestCase):
+    """Test select/reduce derived variables"""
+
+    def setUp(self):
+        self.net = Runnable("net", None)
+        for i, (v, kind) in enumerate([(1.0, 1), (2.0, 2), (4.0, 1)]):
+            cell = Runnable("c{0}".format(i), None)
+            cell.add_instance_variable("v", v)
+            cell.add_instance_variable("kind", kind)
+            self.net.add_child_to_group("cells", cell)
+
+    def test_reduce(self):
+        self.assertEqual(Reduction("t", "cells[*]/v", "add").bind(self.net)(), 7.0)
+        self.assertEqual(
+            Reduction("t", "cells[*]/v", "multiply").bind(self.net)(), 8.0
+        )
+        self.net.add_child_typeref("first", self.net.cells[0])
+        self.assertEqual(Reduction("t", "first/v", "add").bind(self.net)(), 1.0)
+
+        # Groups without members are never created
+        self.assertEqual(Reduction("t", "gates[*]/v", "add").bind(self.net)(), 0)
+
+    def test_filter(self):
+        reduction = Reduction("t", "cells[kind=1]/v", "add").bind(self.net)
+        self.assertEqual(len(reduction.members), 2)
+        self.assertEqual(reduction(), 5.0)
+
+    def test_errors(self):
+        self.assertRaises(SimBuildError, Reduction, "t", "cells[0]/v", "add")
+        self.assertRaises(
+            SimBuildError, Reduction("t", "cells[*]/u", "add").bind, self.net
+        )
+        self.assertRaises(
+            SimBuildError, Reduction("t", "child/v", "multiply").bind, self.net
+        )
+        self.assertEqual(
+            Reduction("t", "child/v", "multiply", "false").bind(self.net)(), 1
+        )
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_population(self):
+        population = VectorRunnable("p", None, 4)
+        population.add_instance_variable("v", 0.0)
+        population.v[:] = [8.0, 16.0, 32.0, 64.0]
+        self.net.cells += [population.views[1], population.views[3]]
+
+        reduction = Reduction("t", "cells[*]/v", "add").bind(self.net)
+        self.assertEqual(len(reduction.members), 3)
+        self.assertEqual(reduction(), 87.0)
+
+        holder = Runnable("holder", None)
+        holder.array = list(population.views)
+        self.net.add_child("p", holder)
+        reduction = Reduction("t", "p[*]/v", "add").bind(self.net)
+        self.assertEqual(reduction.populations, [(population, None)])
+        self.assertEqual(reduction(), 120.0)
+
+
+class TestCompact(unittest.TestCase):
+    """Test reducing the memory held by the runnables of a built simulation"""
+
+    def test_same_results(self):
+        for file_name in ["example3.xml", "example6.xml", "example7.xml"]:
+            model = load_example(file_name)
+            compact = SimulationBuilder(model, compact=True).build()
+            compact.run()
+            full = SimulationBuilder(model).build()
+            full.run()
+            self.assertEqual(collect_recordings(compact), collect_recordings(full))
+
+    def test_shared_metadata(self):
+        sim = SimulationBuilder(load_example("example7.xml"), compact=True).build()
+        cells = [r for r in sim.iter_runnables() if r.id.startswith("p3__")]
+        self.assertEqual(len(cells), 3)
+        for cell in cells[1:]:
+            self.assertIs(cell.instance_variables, cells[0].instance_variables)
+            self.assertIs(cell.shadow_indices, cells[0].shadow_indices)
+            self.assertNotIn("children", cell.__dict__)
+            self.assertIsNot(cell.event_in_counters, cells[0].event_in_counters)
+
+        self.assertRaises(TypeError, cells[0].add_child, "c", Runnable("c", None))
+        self.assertRaises(AttributeError, cells[0].add_instance_variable, "u", 0)
+
+    def test_memory(self):
+        examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+        with open(examples + "/example7.xml") as f:
+            xml = f.read().replace('iaf3cpt" size="3"', 'iaf3cpt" size="500"')
+        with tempfile.TemporaryDirectory() as d:
+            file_name = os.path.join(d, "example7_large.xml")
+            with open(file_name, "w") as f:
+                f.write(xml)
+            model = Model()
+            model.add_include_directory(examples)
+            model.import_from_file(file_name)
+        model = model.resolve()
+
+        # Compile the generated methods before measuring
+        SimulationBuilder(model).build()
+
+        sizes = []
+        for compact in [False, True]:
+            tracemalloc.start()
+            sim = SimulationBuilder(model, compact=compact).build()
+            sizes.append(tracemalloc.get_traced_memory()[0])
+            tracemalloc.stop()
+            del sim
+        self.assertLess(sizes[1], 0.6 * sizes[0])
+
+
+class TestPrototype(unittest.TestCase):
+    """Test making copies of a runnable from its prototype"""
+
+    def setUp(self):
+        self.cell = Runnable("cell", None)
+        self.cell.add_instance_variable("v", -0.07)
+        self.cell.add_event_in_port("in")
+        self.cell.add_event_out_port("spike")
+        self.cell.add_child("soma", Runnable("soma", None))
+        self.cell.add_child_to_group("synapses", Runnable("syn", None))
+        self.cell.label = "iaf"
+
+    def test_instances(self):
+        prototype = Prototype(self.cell)
+        (a, b) = (prototype.instantiate(), prototype.instantiate())
+
+        self.assertNotEqual(a.uid, b.uid)
+        self.assertNotIn(a.uid, [self.cell.uid, self.cell.soma.uid])
+        self.assertEqual((a.v, a.label, a.event_in_counters), (-0.07, "iaf", {"in": 0}))
+        self.assertIsNot(a.instance_variables, b.instance_variables)
+        self.assertIsNot(a.event_out_fanouts["spike"], b.event_out_fanouts["spike"])
+        self.assertIs(
+            a.event_out_callbacks["spike"], a.event_out_fanouts["spike"].callbacks
+        )
+
+        self.assertIsNot(a.soma, self.cell.soma)
+        self.assertIs(a.children["soma"], a.soma)
+        self.assertIs(a.soma.parent, a)
+        self.assertEqual(len(a.synapses), 1)
+        self.assertIsNot(a.synapses[0], b.synapses[0])
+        self.assertIs(a.synapses[0].parent, a)
+
+        a.v = 0
+        a.synapses.append(Runnable("syn", None))
+        self.assertEqual((b.v, len(b.synapses), self.cell.v), (-0.07, 1, -0.07))
+
+    def test_multi_instantiate(self):
+        sim = SimulationBuilder(load_example("example7.xml")).build()
+        cells = [r for r in sim.iter_runnables() if r.id.startswith("p3__")]
+        self.assertEqual(
+            [c.id for c in cells], ["p3__iaf3cpt__%d" % i for i in range(3)]
+        )
+        self.assertEqual(len(set(c.uid for c in cells)), 3)
+        self.assertEqual(len(set(id(c.event_in_counters) for c in cells)), 3)
+
+
+class TestRecording(unittest.TestCase):
+    """Test recording buffers"""
+
+    def test_growth(self):
+        recording = Recording("v", "v", None, None)
+        recording.reserve(2)
+        for i in range(10):
+            recording.add_value(i * 0.5, i * 2.0)
+        self.assertEqual(len(recording), 10)
+        self.assertEqual(list(recording.get_times()), [i * 0.5 for i in range(10)])
+        self.assertEqual(list(recording.get_values()), [i * 2.0 for i in range(10)])
+
+    def test_exact_values(self):
+        recording = Recording("v", "v", None, None)
+        recording.add_value(0, 1.5)
+        recording.add_value(0.1, 0)
+        self.assertEqual(recording.values, [(0, 1.5), (0.1, 0)])
+        self.assertEqual(str(recording.get_time_list()[0]), "0")
+        self.assertEqual(str(recording.get_value_list()[1]), "0")
+
+    def test_shared_time_axis(self):
+        sim = SimulationBuilder(load_example("example2.xml")).build()
+        sim.run()
+        recordings = []
+        rq = list(sim.runnables.values())
+        while rq:
+            runnable = rq.pop(0)
+            rq.extend(runnable.uchildren.values())
+            rq.extend(runnable.array)
+            recordings += runnable.recorded_variables
+        self.assertGreater(len(recordings), 1)
+        for recording in recordings:
+            self.assertIs(recording.time_axis, recordings[0].time_axis)
+            self.assertEqual(len(recording), len(recording.time_axis))
+            # Buffers were sized for the whole run
+            self.assertIn(len(recording.data) - len(recording), (0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Tests for parameter sweeps.
+
+File: test_sweep.py
+
+Copyright 2023 LEMS contributors
+"""
+
+
+import unittest
+import os
+import tempfile
+
+from lems.base.errors import SimError
+from lems.model.model import Model
+from lems.sim.sweep import run_sweep, run_ensemble, simulate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def load_example(file_name):
+    model = Model()
+    model.import_from_file(
+        os.path.dirname(os.path.abspath(__file__)) + "/../../examples/" + file_name
+    )
+    return model.resolve()
+
+
+def load_regime_example():
+    # Regimes cannot contain OnEvent handlers yet.
+    examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+    with open(examples + "/example8.xml") as f:
+        xml = f.read()
+    start = xml.index('<OnEvent port="in">')
+    end = xml.index("</OnEvent>", start) + len("</OnEvent>")
+    xml = xml[:start] + xml[end:]
+
+    with tempfile.TemporaryDirectory() as d:
+        file_name = os.path.join(d, "example8_regimes.xml")
+        with open(file_name, "w") as f:
+            f.write(xml)
+        model = Model()
+        model.add_include_directory(examples)
+        model.import_from_file(file_name)
+    return model.resolve()
+
+
+class TestSweep(unittest.TestCase):
+
+    """Test running simulations for several parameter sets"""
+
+    def setUp(self):
+        self.model = load_example("example7.xml")
+        self.parameter_sets = [
+            {"iaf3cpt": {"leakReversal": "-50mV"}},
+            {"iaf3cpt": {"leakReversal": -0.04}},
+            {"iaf3cpt": {"leakReversal": "-50mV"}},
+        ]
+
+    def assert_same_recordings(self, a, b):
+        self.assertEqual(set(a), set(b))
+        for path in a:
+            self.assertEqual(list(a[path][0]), list(b[path][0]))
+            self.assertEqual(list(a[path][1]), list(b[path][1]))
+
+    def test_parameters(self):
+        results = run_sweep(self.model, self.parameter_sets, processes=1)
+        self.assert_same_recordings(results[0], results[2])
+        self.assertNotEqual(
+            list(results[0]["p3[0]/v"][1]), list(results[1]["p3[0]/v"][1])
+        )
+
+        # The model itself is unchanged
+        self.assert_same_recordings(results[0], simulate(self.model))
+        parameter = self.model.fat_components["iaf3cpt"].parameters["leakReversal"]
+        self.assertAlmostEqual(parameter.numeric_value, -0.05)
+
+    def test_processes(self):
+        serial = run_sweep(self.model, self.parameter_sets, processes=1)
+        parallel = run_sweep(self.model, self.parameter_sets, processes=2)
+        self.assertEqual(len(parallel), len(self.parameter_sets))
+        for a, b in zip(serial, parallel):
+            self.assert_same_recordings(a, b)
+
+    def test_unknown_parameter(self):
+        self.assertRaises(
+            SimError, simulate, self.model, {"iaf3cpt": {"nonexistent": 1.0}}
+        )
+        self.assertRaises(SimError, simulate, self.model, {"nonexistent": {"v": 1.0}})
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestEnsemble(unittest.TestCase):
+
+    """Test running parameter sets as the trials of an ensemble"""
+
+    def assert_same_trials(self, model, parameter_sets):
+        ensemble = run_ensemble(model, parameter_sets)
+        sweep = run_sweep(model, parameter_sets, processes=1)
+        self.assertEqual(len(ensemble), len(parameter_sets))
+        for a, b in zip(ensemble, sweep):
+            self.assertEqual(set(a), set(b))
+            for path in b:
+                self.assertTrue(numpy.array_equal(a[path][0], b[path][0]))
+                self.assertTrue(numpy.allclose(a[path][1], b[path][1], rtol=1e-9))
+        return ensemble
+
+    def test_parameters(self):
+        results = self.assert_same_trials(
+            load_example("example7.xml"),
+            [
+                {"iaf3cpt": {"leakReversal": "-50mV"}},
+                {"iaf3cpt": {"leakReversal": -0.04}},
+            ],
+        )
+        self.assertFalse(
+            numpy.array_equal(results[0]["p3[0]/v"][1], results[1]["p3[0]/v"][1])
+        )
+
+    def test_regimes(self):
+        # Trials spike at different times and spend different times in the
+        # refractory regime.
+        self.assert_same_trials(
+            load_regime_example(),
+            [
+                {"multiregime": {"current": "0.001nA"}},
+                {"multiregime": {"current": "0.002nA", "refractoryPeriod": "5ms"}},
+                {},
+            ],
+        )
+
+    def test_unknown_parameter(self):
+        model = load_example("example7.xml")
+        self.assertRaises(
+            SimError, run_ensemble, model, [{"iaf3cpt": {"nonexistent": 1.0}}]
+        )
+        self.assertRaises(SimError, run_ensemble, model, [{"nonexistent": {"v": 1}}])
+
+
+if __name__ == "__main__":
+    unittest.main()
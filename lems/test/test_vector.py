@@ -0,0 +1,217 @@
+"""
+Tests for the vectorized simulation of populations.
+
+File: test_vector.py
+
+Copyright 2023 LEMS contributors
+"""
+
+
+import unittest
+import os
+import tempfile
+import warnings
+
+from lems.base.errors import SimBuildError
+from lems.model.model import Model
+from lems.sim.build import SimulationBuilder
+from lems.sim.runnable import Runnable
+from lems.sim.vector import VectorRunnable, EnsembleRunnable, make_vector_namespace
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def simulate(file_name, **kwargs):
+    model = Model()
+    model.import_from_file(
+        os.path.dirname(os.path.abspath(__file__)) + "/../../examples/" + file_name
+    )
+    sim = SimulationBuilder(model.resolve(), **kwargs).build()
+    sim.run()
+    return sim
+
+
+def collect_recordings(sim):
+    recordings = {}
+    rq = list(sim.runnables.values())
+    while rq:
+        runnable = rq.pop(0)
+        rq.extend(runnable.children.values())
+        rq.extend(runnable.array)
+        for recording in runnable.recorded_variables:
+            recordings[recording.full_path] = [
+                (float(t), float(v)) for t, v in recording.values
+            ]
+    return recordings
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestVectorize(unittest.TestCase):
+
+    """Test the vectorized simulation of MultiInstantiate populations"""
+
+    def assert_same_results(self, file_name):
+        scalar = collect_recordings(simulate(file_name))
+        vector = collect_recordings(simulate(file_name, vectorize=True))
+        self.assertTrue(scalar)
+        self.assertEqual(set(scalar), set(vector))
+        for path in scalar:
+            self.assertEqual(len(scalar[path]), len(vector[path]))
+            for (ts, vs), (tv, vv) in zip(scalar[path], vector[path]):
+                self.assertEqual(ts, tv)
+                self.assertAlmostEqual(vs, vv, delta=1e-9 * max(1.0, abs(vs)))
+
+    def test_populations_vectorized(self):
+        sim = simulate("example7.xml", vectorize=True)
+        populations = []
+        rq = list(sim.runnables.values())
+        while rq:
+            runnable = rq.pop(0)
+            rq.extend(runnable.children.values())
+            for child in runnable.uchildren.values():
+                if child.vectorized:
+                    populations.append(child)
+        self.assertTrue(populations)
+        for population in populations:
+            self.assertEqual(len(population.views), population.size)
+
+    def test_example3(self):
+        self.assert_same_results("example3.xml")
+
+    def test_example7(self):
+        self.assert_same_results("example7.xml")
+
+    def test_masked_errors(self):
+        # Dividing by zero in a case that is not selected is no error.
+        examples = os.path.dirname(os.path.abspath(__file__)) + "/../../examples"
+        with open(examples + "/example7.xml") as f:
+            xml = f.read()
+        rate = """
+            <ComponentType name="rateGenerator" extends="spikeGenerator">
+                <Exposure name="rate" dimension="per_time"/>
+                <Dynamics>
+                    <ConditionalDerivedVariable name="rate" exposure="rate" dimension="per_time">
+                        <Case condition="tsince .gt. 0" value="1 / tsince"/>
+                        <Case value="0"/>
+                    </ConditionalDerivedVariable>
+                </Dynamics>
+            </ComponentType>
+            <Component id="gen1" type="rateGenerator" """
+        xml = xml.replace('\n    <Component id="gen1" type="spikeGenerator"', rate)
+        with tempfile.TemporaryDirectory() as d:
+            file_name = os.path.join(d, "example7_rate.xml")
+            with open(file_name, "w") as f:
+                f.write(xml)
+            model = Model()
+            model.add_include_directory(examples)
+            model.import_from_file(file_name)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            sim = SimulationBuilder(model.resolve(), vectorize=True).build()
+            sim.run()
+        (population,) = [
+            r for r in sim.iter_runnables() if r.vectorized and "rate" in r.__dict__
+        ]
+        self.assertEqual(population.size, 2)
+        self.assertTrue(numpy.all(population.rate > 0))
+
+    def test_masked_errors_nested(self):
+        # Masked statements can be indented into other blocks.
+        code = SimulationBuilder(Model(), vectorize=True).mask_errors(["x = 1 / y"])
+        namespace = make_vector_namespace()
+        namespace["y"] = numpy.zeros(2)
+        exec("if True:\n" + "".join("    " + line + "\n" for line in code), namespace)
+        self.assertTrue(numpy.all(numpy.isinf(namespace["x"])))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestPopulationEvents(unittest.TestCase):
+
+    """Test delivering the events emitted by a population"""
+
+    def test_scatter(self):
+        source = VectorRunnable("s", None, 3)
+        source.add_event_out_port("out")
+        target = VectorRunnable("t", None, 4)
+        target.add_event_in_port("in")
+        scalar = Runnable("r", None)
+        scalar.add_event_in_port("in")
+
+        source.views[0].connect_event_out("out", target.views[1], "in")
+        source.views[0].connect_event_out("out", target.views[1], "in")
+        source.views[0].connect_event_out("out", target.views[3], "in")
+        source.views[2].connect_event_out("out", target.views[0], "in")
+        source.views[2].connect_event_out("out", scalar, "in")
+
+        source.emit("out", numpy.array([2, 0, 1]))
+        self.assertEqual(list(target.event_in_counters["in"]), [1, 4, 0, 2])
+        self.assertEqual(scalar.event_in_counters["in"], 1)
+
+        source.emit("out", numpy.array([False, True, False]))
+        self.assertEqual(list(target.event_in_counters["in"]), [1, 4, 0, 2])
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestEnsemble(unittest.TestCase):
+
+    """Test simulating trials of a whole model at once"""
+
+    def test_trials(self):
+        scalar = collect_recordings(simulate("example7.xml"))
+        sim = simulate("example7.xml", ensemble=3)
+
+        recordings = sim.get_recordings()
+        self.assertEqual(set(r.full_path for r in recordings), set(scalar))
+        for recording in recordings:
+            values = recording.get_values()
+            self.assertEqual(values.shape, (len(scalar[recording.full_path]), 3))
+            for (t, v), row in zip(scalar[recording.full_path], values):
+                for value in row:
+                    self.assertAlmostEqual(v, value, delta=1e-9 * max(1.0, abs(v)))
+
+        for runnable in sim.iter_runnables():
+            self.assertIsInstance(runnable, EnsembleRunnable)
+
+    def test_events(self):
+        source = EnsembleRunnable("s", None, 3)
+        source.add_event_out_port("out")
+        target = EnsembleRunnable("t", None, 3)
+        target.add_event_in_port("in")
+        source.connect_event_out("out", target, "in")
+
+        source.emit("out", numpy.array([True, False, True]))
+        source.emit("out", numpy.array([2, 0, 0]))
+        self.assertEqual(list(target.event_in_counters["in"]), [3, 0, 1])
+
+    def test_copies_share_no_values(self):
+        model = Model()
+        model.import_from_file(
+            os.path.dirname(os.path.abspath(__file__)) + "/../../examples/example7.xml"
+        )
+        sim = SimulationBuilder(model.resolve(), ensemble=2).build()
+        instances = [r for r in sim.iter_runnables() if r.component.id == "iaf3cpt"]
+        self.assertGreater(len(instances), 1)
+
+        value = instances[0].leakReversal[1]
+        instances[0].set_trial_value("leakReversal", 1, 0.0)
+        self.assertEqual(list(instances[0].leakReversal), [value, 0.0])
+        self.assertIs(
+            instances[0].shadow[instances[0].shadow_index("leakReversal")],
+            instances[0].leakReversal,
+        )
+        for instance in instances[1:]:
+            self.assertEqual(list(instance.leakReversal), [value, value])
+
+    def test_vectorize(self):
+        model = Model()
+        self.assertRaises(
+            SimBuildError, SimulationBuilder, model, vectorize=True, ensemble=2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()